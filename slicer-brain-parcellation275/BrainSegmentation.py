@@ -1,53 +1,17 @@
 import os
-import numpy as np
-import nibabel as nib
-from nibabel import processing
-import PyTorchUtils
-torch = PyTorchUtils.PyTorchUtilsLogic().torch
-import glob
+import json
+import shutil
+import sys
 
 import slicer
 from slicer.ScriptedLoadableModule import ScriptedLoadableModule, ScriptedLoadableModuleWidget, ScriptedLoadableModuleLogic
 import qt
-from tqdm import tqdm as std_tqdm
-from functools import partial
-from utils.cropping import cropping
-from utils.hemisphere import hemisphere
-from utils.load_model import load_model
-from utils.make_csv import make_csv
-from utils.parcellation import parcellation
-from utils.postprocessing import postprocessing
-from utils.preprocessing import preprocessing
-from utils.stripping import stripping
-
-import argparse
+from utils import cli
+from utils.cli import PROGRESS
+from utils.pipeline import STAGES
 
 from utils.update_segment_name import update_segment_names
 
-# This wraps tqdm for progress bar
-tqdm = partial(std_tqdm, dynamic_ncols=True)
-
-def create_parser(args_list):
-    parser = argparse.ArgumentParser(
-        description="Use this to run inference with OpenMAP-T1."
-    )
-    parser.add_argument(
-        "-i",
-        required=True,
-        help="Input folder. Specifies the folder containing the input brain MRI images.",
-    )
-    parser.add_argument(
-        "-o",
-        required=True,
-        help="Output folder. Difines the output folder where the results will be saved. If the specified folder does not exist, it will be automatically created.",
-    )
-    parser.add_argument(
-        "-m",
-        required=True,
-        help="Folder of pretrained models. Indicates the location of the pretrained models to be used for processing.",
-    )
-    return parser.parse_args(args_list)
-
 class BrainSegmentation(ScriptedLoadableModule):
     """Define the module metadata."""
     def __init__(self, parent):
@@ -84,6 +48,18 @@ class BrainSegmentationWidget(ScriptedLoadableModuleWidget):
         self.applyButton.clicked.connect(self.onApplySegmentation)
         self.layout.addRow(self.applyButton)
 
+        self.cancelButton = qt.QPushButton("Cancel Segmentation")
+        self.cancelButton.toolTip = "Stop the running segmentation after its current stage"
+        self.cancelButton.enabled = False
+        self.cancelButton.clicked.connect(self.onCancelSegmentation)
+        self.layout.addRow(self.cancelButton)
+
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.visible = False
+        self.layout.addRow(self.progressBar)
+        self.statusLabel = qt.QLabel("")
+        self.layout.addRow(self.statusLabel)
+
         self.subfolderComboBox = qt.QComboBox()
         self.subfolderComboBox.setToolTip("Select a subfolder from the output directory")
         self.subfolderComboBox.currentIndexChanged.connect(self.onSubfolderSelected)
@@ -104,8 +80,21 @@ class BrainSegmentationWidget(ScriptedLoadableModuleWidget):
         self.currentVolumeNode = None
         self.currentSegmentationNode = None
 
+        # Long-lived worker (utils/cli.py --serve): its model registry keeps
+        # the networks loaded from one Apply to the next.
+        self.process = None
+        self.running = False
+        self.cancelFile = None
+
         self.parent.layout().addLayout(self.layout)
 
+    def cleanup(self):
+        if self.process is not None:
+            self.process.closeWriteChannel()
+            if not self.process.waitForFinished(3000):
+                self.process.kill()
+                self.process.waitForFinished()
+
     def onSelectInputFolder(self):
         folderDialog = qt.QFileDialog()
         folderDialog.setFileMode(qt.QFileDialog.Directory)
@@ -204,7 +193,7 @@ class BrainSegmentationWidget(ScriptedLoadableModuleWidget):
         if selectedSubfolder:
             subfolderPath = os.path.join(self.outputFolder, selectedSubfolder)
 
-            niiFiles = [f for f in os.listdir(subfolderPath) if f.endswith('.nii') or f.endswith('.seg.nrrd')]
+            niiFiles = [f for f in os.listdir(subfolderPath) if f.endswith(('.nii', '.nii.gz', '.seg.nrrd'))]
 
             if niiFiles:
                 self.niiFileComboBox.addItems(niiFiles)
@@ -227,7 +216,7 @@ class BrainSegmentationWidget(ScriptedLoadableModuleWidget):
 
         if selectedSubfolder:
             subfolderPath = os.path.join(self.outputFolder, selectedSubfolder)
-            niiFiles = [f for f in os.listdir(subfolderPath) if f.endswith('.nii') or f.endswith(".seg.nrrd")]
+            niiFiles = [f for f in os.listdir(subfolderPath) if f.endswith(('.nii', '.nii.gz', '.seg.nrrd'))]
 
             if niiFiles:
                 self.niiFileComboBox.addItems(niiFiles)
@@ -239,63 +228,131 @@ class BrainSegmentationWidget(ScriptedLoadableModuleWidget):
             slicer.util.errorDisplay("Please select an input folder and output folder.")
             return
 
-        logic = BrainSegmentationLogic()
-        logic.run(self.inputFile, self.outputFolder)
+        if self.running:
+            return
 
-        update_segment_names(self.outputFolder)
+        # The pipeline runs in a separate Python process so Slicer stays
+        # responsive; it reports its progress as lines on stdout.
+        self.cancelFile = os.path.join(self.outputFolder, ".cancel")
+        if os.path.exists(self.cancelFile):
+            os.remove(self.cancelFile)
+        logic = BrainSegmentationLogic()
+        args = logic.arguments(self.inputFile, self.outputFolder, ["--progress", "--cancel-file", self.cancelFile])
+
+        self.subjects = []
+        self.completed = 0
+        self.stagesSeen = 0
+        self.cancelled = False
+
+        if self.process is None:
+            command = logic.workerCommand()
+            print("Starting: " + " ".join(command))
+            self.outputBuffer = ""
+            self.process = qt.QProcess()
+            self.process.readyReadStandardOutput.connect(self.onProcessOutput)
+            self.process.readyReadStandardError.connect(self.onProcessError)
+            self.process.connect("finished(int,QProcess::ExitStatus)", self.onProcessFinished)
+            self.process.start(command[0], command[1:])
+            self.statusLabel.setText("Loading models...")
+        else:
+            self.statusLabel.setText("Starting...")
+        print("Running: " + " ".join(args))
+        self.process.write((json.dumps(args) + "\n").encode())
+        self.running = True
+
+        self.applyButton.enabled = False
+        self.cancelButton.enabled = True
+        self.progressBar.visible = True
+        self.progressBar.setRange(0, 0)
+
+    def onCancelSegmentation(self):
+        if not self.running:
+            return
+        open(self.cancelFile, "w").close()
+        self.cancelButton.enabled = False
+        self.statusLabel.setText("Cancelling after the current stage...")
+
+    def onProcessOutput(self):
+        self.outputBuffer += bytes(self.process.readAllStandardOutput()).decode(errors="replace")
+        *lines, self.outputBuffer = self.outputBuffer.split("\n")
+        for line in lines:
+            line = line.rstrip("\r")
+            if line.startswith(PROGRESS):
+                self.onProgress(json.loads(line[len(PROGRESS):]))
+            elif line:
+                print(line)
+
+    def onProcessError(self):
+        text = bytes(self.process.readAllStandardError()).decode(errors="replace")
+        if text:
+            print(text, end="")
+
+    def onProgress(self, event):
+        if event["event"] == "start":
+            self.subjects = event["subjects"]
+            self.progressBar.setRange(0, max(1, len(self.subjects) * len(STAGES)))
+            self.progressBar.setValue(0)
+            self.statusLabel.setText(f"{len(self.subjects)} subjects to segment")
+            self.updateComboBoxes()
+        elif event["event"] == "stage":
+            self.stagesSeen += 1
+            self.progressBar.setValue(self.stagesSeen)
+            self.statusLabel.setText(
+                f"{event['subject']}: {event['stage']} ({self.completed}/{len(self.subjects)} subjects done)"
+            )
+        elif event["event"] == "done":
+            self.completed += 1
+            update_segment_names(self.outputFolder, subfolders=[event["subject"]])
+            self.updateComboBoxes()
+        elif event["event"] == "cancelled":
+            self.cancelled = True
+        elif event["event"] == "exit":
+            self.onRunFinished(event["code"])
+
+    def onProcessFinished(self, exitCode, exitStatus):
+        # The worker only exits on its own when it crashed.
+        self.onProcessOutput()
+        self.onProcessError()
+        self.process = None
+        if self.running:
+            self.onRunFinished(exitCode or 1)
+
+    def onRunFinished(self, exitCode):
+        self.running = False
+        if os.path.exists(self.cancelFile):
+            os.remove(self.cancelFile)
+
+        self.applyButton.enabled = True
+        self.cancelButton.enabled = False
+        self.progressBar.visible = False
         self.updateComboBoxes()
-        slicer.util.infoDisplay("Segmentation completed successfully!")
 
-class BrainSegmentationLogic:
-    def run(self, inputFile, outputFolder):
-        print(f"Running segmentation with input: {inputFile} and output: {outputFolder}")
-
-
-        print(f"Input file: {inputFile}")
-        print(f"Output folder: {outputFolder}")
+        summary = f"{self.completed}/{len(self.subjects)} subjects segmented"
+        self.statusLabel.setText(summary)
+        if self.cancelled:
+            slicer.util.infoDisplay(f"Segmentation cancelled: {summary}.")
+        elif exitCode == 0:
+            slicer.util.infoDisplay("Segmentation completed successfully!")
+        else:
+            slicer.util.errorDisplay(f"Segmentation failed (exit code {exitCode}): {summary}. See the Python console for details.")
 
+class BrainSegmentationLogic:
+    def arguments(self, inputFile, outputFolder, extraArgs=None):
+        """Arguments of utils/cli.py for a run on `inputFile` into `outputFolder`."""
         script_dir = os.path.dirname(os.path.realpath(__file__))
+        return [
+            "-i", inputFile,
+            "-o", outputFolder,
+            "-m", os.path.join(script_dir, "MODEL_FOLDER"),
+        ] + list(extraArgs or [])
+
+    def workerCommand(self):
+        """Command line of the worker process onApplySegmentation sends its runs to."""
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        python = shutil.which("PythonSlicer") or sys.executable
+        return [python, os.path.join(script_dir, "utils", "cli.py"), "--serve"]
 
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        model_folder= os.path.join(script_dir, "MODEL_FOLDER")
-        args_list = ['-i', inputFile, '-o', outputFolder, '-m', model_folder]
-        opt = create_parser(args_list)
-        device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
-        cnet, ssnet, pnet_c, pnet_s, pnet_a, hnet_c, hnet_a = load_model(opt, device)
-
-        print("load complete !!")
-        pathes = sorted(glob.glob(os.path.join(opt.i, "**/*.nii"), recursive=True))
-
-        for path in tqdm(pathes):
-            save = os.path.splitext(os.path.basename(path))[0]
-            output_dir = f"{opt.o}/{save}"
-            os.makedirs(output_dir, exist_ok=True)
-
-            odata = nib.squeeze_image(nib.as_closest_canonical(nib.load(path)))
-            nii = nib.Nifti1Image(odata.get_fdata().astype(np.float32), affine=odata.affine)
-            nib.save(nii, os.path.join(output_dir, f"{save}.nii"))
-
-            odata, data = preprocessing(path, save)
-            cropped = cropping(data, cnet, device)
-            stripped, shift = stripping(cropped, data, ssnet, device)
-            parcellated = parcellation(stripped, pnet_c, pnet_s, pnet_a, device)
-            separated = hemisphere(stripped, hnet_c, hnet_a, device)
-            output = postprocessing(parcellated, separated, shift, device)
-
-            df = make_csv(output, save)
-            df.to_csv(os.path.join(output_dir, f"{save}_volume.csv"), index=False)
-
-            nii = nib.Nifti1Image(output.astype(np.uint16), affine=data.affine)
-            header = odata.header
-            nii = processing.conform(
-                nii,
-                out_shape=(header["dim"][1], header["dim"][2], header["dim"][3]),
-                voxel_size=(header["pixdim"][1], header["pixdim"][2], header["pixdim"][3]),
-                order=0,
-            )
-
-            output_path = os.path.join(output_dir, f"{save}_280.nii")
-            nib.save(nii, output_path)
-
-            del odata, data
-            os.remove(f"N4/{save}.nii")
+    def run(self, inputFile, outputFolder, extraArgs=None):
+        """Segment in this process, as utils/cli.py does; returns its exit code."""
+        print(f"Running segmentation with input: {inputFile} and output: {outputFolder}")
+        return cli.main(self.arguments(inputFile, outputFolder, extraArgs))
@@ -0,0 +1,98 @@
+"""Time saved by low-resolution cropping and its effect on the stripped volume.
+
+Runs cropping() at full resolution and at each `--resolutions` value, then
+stripping() on every resulting head mask, and compares the stripped brains
+with the full-resolution one:
+
+    python Testing/Python/benchmark_cropping.py -m MODEL_FOLDER -i T1.nii --resolutions 128 192
+
+Without -m/-i it uses the synthetic head and random networks of
+benchmark_pipeline.py, which only exercises the code path.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from benchmark_pipeline import random_models, synthetic_head  # noqa: E402
+from utils.cropping import cropping  # noqa: E402
+from utils.load_model import MODELS, build_model  # noqa: E402
+from utils.preprocessing import preprocessing  # noqa: E402
+from utils.stripping import stripping  # noqa: E402
+
+
+def load_networks(model_folder, device):
+    networks = {}
+    for name in ("cnet", "ssnet"):
+        path, ch_in, ch_out = MODELS[name]
+        networks[name] = build_model(os.path.join(model_folder, path), ch_in, ch_out, device)
+    return networks
+
+
+def run(data, networks, device, resolution, batch):
+    start = time.perf_counter()
+    cropped = cropping(data, networks["cnet"], device, batch, resolution)
+    crop_s = time.perf_counter() - start
+    start = time.perf_counter()
+    stripped, shift = stripping(cropped, data, networks["ssnet"], device, batch)
+    strip_s = time.perf_counter() - start
+    return {"cropping_s": crop_s, "stripping_s": strip_s, "head_voxels": int(np.count_nonzero(cropped))}, stripped, shift
+
+
+def compare(reference, stripped, reference_shift, shift):
+    a, b = reference != 0, stripped != 0
+    return {
+        "shift": list(shift),
+        "shift_changed": list(shift) != list(reference_shift),
+        "brain_voxels": int(b.sum()),
+        "brain_volume_change": float(b.sum() / max(a.sum(), 1) - 1),
+        "brain_dice": float(2 * (a & b).sum() / max(a.sum() + b.sum(), 1)),
+        "max_abs_difference": float(np.abs(reference - stripped).max()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-m", default=None, help="Folder of pretrained models; random networks without it.")
+    parser.add_argument("-i", default=None, help="T1 volume; a synthetic head without it.")
+    parser.add_argument("-o", "--output", default="benchmark_cropping.json")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[128])
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("-b", "--batch-size", type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    networks = load_networks(args.m, device) if args.m else random_models()
+    _, data = preprocessing(args.i if args.i else synthetic_head(), "benchmark")
+
+    results = {}
+    reference, stripped, shift = run(data, networks, device, 256, args.batch_size)
+    results[256] = reference
+    print(f"256^3: cropping {reference['cropping_s']:.1f} s, stripping {reference['stripping_s']:.1f} s", flush=True)
+    for resolution in args.resolutions:
+        result, low_stripped, low_shift = run(data, networks, device, resolution, args.batch_size)
+        result.update(compare(stripped, low_stripped, shift, low_shift))
+        result["cropping_speedup"] = reference["cropping_s"] / result["cropping_s"]
+        results[resolution] = result
+        print(
+            f"{resolution}^3: cropping {result['cropping_s']:.1f} s ({result['cropping_speedup']:.1f}x), "
+            f"brain Dice {result['brain_dice']:.4f}, volume change {result['brain_volume_change']:+.2%}, "
+            f"shift {'changed' if result['shift_changed'] else 'unchanged'}",
+            flush=True,
+        )
+
+    with open(args.output, "w") as f:
+        json.dump({"input": args.i or "synthetic", "models": args.m or "random", "resolutions": results}, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
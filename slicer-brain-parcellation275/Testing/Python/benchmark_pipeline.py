@@ -0,0 +1,180 @@
+"""Per-stage benchmark of the segmentation pipeline on synthetic data.
+
+Uses a synthetic 256^3 head volume and randomly initialised UNets, so it
+needs neither pretrained weights nor a GPU. Every stage is timed on the
+output of the previous one; results are written as JSON and can be compared
+with an earlier run:
+
+    python Testing/Python/benchmark_pipeline.py -o after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import nibabel as nib
+import numpy as np
+import torch
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.cropping import cropping  # noqa: E402
+from utils.functions import peak_rss_since_reset, reset_peak_rss  # noqa: E402
+from utils.hemisphere import hemisphere  # noqa: E402
+from utils.load_model import COMPILE_MODES, optimize_model  # noqa: E402
+from utils.make_csv import make_csv  # noqa: E402
+from utils.network import UNet  # noqa: E402
+from utils.parcellation import parcellation  # noqa: E402
+from utils.postprocessing import postprocessing  # noqa: E402
+from utils.preprocessing import preprocessing  # noqa: E402
+from utils.resample import to_native  # noqa: E402
+from utils.stripping import stripping  # noqa: E402
+
+STAGES = [
+    "preprocessing",
+    "cropping",
+    "stripping",
+    "parcellation",
+    "hemisphere",
+    "postprocessing",
+    "make_csv",
+    "conform",
+]
+
+# Slices pushed through a network by each stage, for slices/s.
+SLICES = {
+    "cropping": 2 * 256,
+    "stripping": 3 * 256,
+    "parcellation": 224 + 192 + 192,
+    "hemisphere": 224 + 192,
+}
+
+
+def synthetic_head(size=256, seed=0):
+    """Noisy ellipsoid with a smooth bias field, stored like a T1 scan."""
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, size)] * 3, indexing="ij"))
+    radius = (grid[0] / 0.7) ** 2 + (grid[1] / 0.85) ** 2 + (grid[2] / 0.75) ** 2
+    head = (radius < 1).astype(np.float32)
+    brain = (radius < 0.6).astype(np.float32)
+    voxels = head * 150 + brain * 250 + rng.normal(0, 10, head.shape) * head
+    voxels *= 1 + 0.2 * grid[0]
+    affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    affine[:3, 3] = -size / 2
+    return nib.Nifti1Image(voxels.astype(np.int16), affine)
+
+
+def random_models(seed=0, compile="none"):
+    torch.manual_seed(seed)
+    models = {
+        "cnet": UNet(1, 1),
+        "ssnet": UNet(1, 1),
+        "pnet_c": UNet(3, 142),
+        "pnet_s": UNet(3, 142),
+        "pnet_a": UNet(3, 142),
+        "hnet_c": UNet(1, 3),
+        "hnet_a": UNet(1, 3),
+    }
+    with torch.no_grad():
+        # Random masks could come out empty, which stripping() cannot centre;
+        # bias the mask networks towards foreground instead.
+        for name in ("cnet", "ssnet"):
+            models[name].dconv0.bias.fill_(5.0)
+    return {name: optimize_model(model.eval(), compile) for name, model in models.items()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=module_dir, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    device = torch.device(args.device)
+    models = {name: model.to(device) for name, model in random_models(compile=args.compile).items()}
+    dtype = getattr(torch, args.parcellation_dtype)
+    state = {"image": synthetic_head()}
+
+    steps = {
+        "preprocessing": lambda s: s.update(zip(("odata", "data"), preprocessing(s["image"], "benchmark"))),
+        "cropping": lambda s: s.update(cropped=cropping(s["data"], models["cnet"], device, args.batch_size)),
+        "stripping": lambda s: s.update(zip(("stripped", "shift"), stripping(s["cropped"], s["data"], models["ssnet"], device, args.batch_size))),
+        "parcellation": lambda s: s.update(parcellated=parcellation(
+            s["stripped"], models["pnet_c"], models["pnet_s"], models["pnet_a"], device, args.batch_size, dtype)),
+        "hemisphere": lambda s: s.update(separated=hemisphere(s["stripped"], models["hnet_c"], models["hnet_a"], device, args.batch_size)),
+        "postprocessing": lambda s: s.update(output=postprocessing(s["parcellated"], s["separated"], device)),
+        "make_csv": lambda s: s.update(df=make_csv(s["output"], "benchmark")),
+        "conform": lambda s: s.update(native=to_native(s["output"], s["shift"], s["odata"], s["data"])),
+    }
+
+    results = {}
+    for name in STAGES:
+        per_stage_peak = reset_peak_rss()
+        start = time.perf_counter()
+        steps[name](state)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        wall = time.perf_counter() - start
+        result = {"wall_s": wall, "peak_rss_mib": peak_rss_since_reset(), "peak_is_per_stage": per_stage_peak}
+        if name in SLICES:
+            result["slices"] = SLICES[name]
+            result["slices_per_s"] = SLICES[name] / wall
+        results[name] = result
+        print(f"{name:15s} {wall:9.2f} s  {result['peak_rss_mib'] or 0:8.0f} MiB"
+              + (f"  {result['slices_per_s']:7.1f} slices/s" if name in SLICES else ""), flush=True)
+
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "device": str(device),
+        "batch_size": args.batch_size,
+        "parcellation_dtype": args.parcellation_dtype,
+        "compile": args.compile,
+        "stages": results,
+    }
+
+
+def compare(current, baseline):
+    print(f"\n{'stage':15s} {'before':>9s} {'after':>9s} {'speedup':>8s}")
+    for name, result in current["stages"].items():
+        before = baseline["stages"].get(name)
+        if before is None:
+            continue
+        print(f"{name:15s} {before['wall_s']:9.2f} {result['wall_s']:9.2f} "
+              f"{before['wall_s'] / result['wall_s']:7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-o", "--output", default="benchmark.json", help="Where to write the JSON results.")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare against.")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("-b", "--batch-size", type=int, default=0)
+    parser.add_argument("--parcellation-dtype", choices=["float32", "float16", "bfloat16"], default="float32")
+    parser.add_argument("--compile", choices=COMPILE_MODES, default="none")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads; 0 keeps the default.")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    results = run(args)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Benchmark the lookup-table relabeling against the per-key loop it replaced.
+
+    python Testing/Python/benchmark_postprocessing.py [--repeat 3]
+"""
+import argparse
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", ".."))
+
+from utils.postprocessing import load_lut, relabel, split_map_path  # noqa: E402
+
+
+def loop_relabel(hmap, pmap, dictionary):
+    combined = torch.stack((torch.flatten(hmap), torch.flatten(pmap)), axis=-1)
+    output = torch.zeros_like(hmap).ravel()
+    for key, value in dictionary.items():
+        key = torch.tensor(key, requires_grad=False)
+        mask = torch.all(combined == key, axis=1)
+        output[mask] = value
+    return output.reshape(hmap.shape)
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    separated = rng.integers(0, 3, size=(192, 224, 192)).astype("int16")
+    parcellated = rng.integers(0, 142, size=(192, 224, 192)).astype("int16")
+    hmap, pmap = torch.from_numpy(separated), torch.from_numpy(parcellated)
+    with open(split_map_path, "rb") as tf:
+        dictionary = pickle.load(tf)
+
+    start = time.perf_counter()
+    lut = load_lut()
+    compile_time = time.perf_counter() - start
+
+    loop_time, expected = timed(lambda: loop_relabel(hmap, pmap, dictionary), args.repeat)
+    torch_time, got_torch = timed(lambda: relabel(hmap, pmap, lut), args.repeat)
+    numpy_time, got_numpy = timed(lambda: relabel(separated, parcellated, lut), args.repeat)
+
+    assert torch.equal(expected, got_torch), "torch lookup table differs from the loop"
+    assert np.array_equal(expected.numpy(), got_numpy), "NumPy lookup table differs from the loop"
+
+    print(f"compile lut    {compile_time * 1e3:9.2f} ms")
+    print(f"per-key loop   {loop_time * 1e3:9.2f} ms")
+    print(f"lut (torch)    {torch_time * 1e3:9.2f} ms  x{loop_time / torch_time:.0f}")
+    print(f"lut (numpy)    {numpy_time * 1e3:9.2f} ms  x{loop_time / numpy_time:.0f}")
+
+
+if __name__ == "__main__":
+    main()
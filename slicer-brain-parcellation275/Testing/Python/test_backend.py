@@ -0,0 +1,47 @@
+"""ONNX export and the onnxruntime backend against the PyTorch UNet.
+
+    python -m unittest Testing/Python/test_backend.py
+"""
+import os
+import sys
+import tempfile
+import unittest
+from functools import partial
+
+import numpy as np
+import torch
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.backend import OnnxModel, ort  # noqa: E402
+from utils.export_onnx import check, export  # noqa: E402
+from utils.inference import infer  # noqa: E402
+from utils.network import UNet  # noqa: E402
+
+
+@unittest.skipIf(ort is None, "onnxruntime is not installed")
+class OnnxBackendTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = UNet(3, 142).eval().fuse()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "PNet", "coronal.onnx")
+        export(self.model, 3, self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_export_matches_torch(self):
+        self.assertLess(check(self.model, self.path, 3), 1e-4)
+
+    def test_infer_with_dynamic_batch(self):
+        voxel = np.random.default_rng(0).standard_normal((5, 3, 48, 32)).astype(np.float32)
+        activation = partial(torch.softmax, dim=1)
+        expected = infer(voxel, self.model, "cpu", activation, torch.zeros(5, 142, 48, 32), batch=2)
+        actual = infer(voxel, OnnxModel(self.path), "cpu", activation, torch.zeros(5, 142, 48, 32), batch=2)
+        torch.testing.assert_close(actual, expected, atol=1e-5, rtol=1e-4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+"""Worker mode (--serve) of utils/cli.py, as the Slicer widget drives it.
+
+    python -m unittest Testing/Python/test_cli.py
+"""
+import io
+import json
+import os
+import sys
+import unittest
+from contextlib import redirect_stderr, redirect_stdout
+from unittest import mock
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils import cli  # noqa: E402
+from utils.cli import PROGRESS, serve  # noqa: E402
+
+
+class ServeTest(unittest.TestCase):
+    def serve(self, lines, results):
+        out = io.StringIO()
+        with mock.patch.object(cli, "main", side_effect=results) as main, redirect_stdout(out), redirect_stderr(io.StringIO()):
+            self.assertEqual(serve(lines), 0)
+        events = [json.loads(line[len(PROGRESS):]) for line in out.getvalue().splitlines() if line.startswith(PROGRESS)]
+        return main, events
+
+    def test_one_run_per_line(self):
+        runs = [["-i", "a", "-o", "b", "-m", "c"], ["-i", "d", "-o", "e", "-m", "f", "--progress"]]
+        main, events = self.serve([json.dumps(run) + "\n" for run in runs] + ["\n"], [0, 1])
+        self.assertEqual([c.args[0] for c in main.call_args_list], runs)
+        self.assertEqual(events, [{"event": "exit", "code": 0}, {"event": "exit", "code": 1}])
+
+    def test_failed_runs_keep_the_worker(self):
+        main, events = self.serve(['["-i"]\n', "[]\n", "[]\n"], [SystemExit(2), RuntimeError("boom"), 0])
+        self.assertEqual(main.call_count, 3)
+        self.assertEqual([event["code"] for event in events], [2, 1, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+"""Batched slice inference of utils/inference.py against the per-slice loop
+the stages ran before.
+
+    python -m unittest Testing/Python/test_inference.py
+"""
+import os
+import sys
+import unittest
+from functools import partial
+from unittest import mock
+
+import numpy as np
+import torch
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils import parcellation as module  # noqa: E402
+from utils.inference import SkipCounter, SliceWindows, counting, infer  # noqa: E402
+from utils.network import UNet  # noqa: E402
+from utils.parcellation import parcellation  # noqa: E402
+from utils.trace import Tracer, activate, summarize  # noqa: E402
+from utils.volume import Volume  # noqa: E402
+
+
+def unet(ch_in, ch_out, seed):
+    """Randomly initialised UNet with logits large enough to rank the classes."""
+    torch.manual_seed(seed)
+    model = UNet(ch_in, ch_out)
+    for module in model.modules():
+        if isinstance(module, (torch.nn.Conv2d, torch.nn.ConvTranspose2d)):
+            module.reset_parameters()
+    with torch.no_grad():
+        # Spatially varying rather than bias-dominated classes.
+        model.dconv0.bias.zero_()
+        model.dconv0.weight.mul_(100)
+    return model.eval()
+
+
+def per_slice(stack, model, activation, context=0):
+    """Predictions of `model` one slice at a time, with `context` neighbours on each side."""
+    padded = np.pad(stack, [(context, context), (0, 0), (0, 0)], "constant", constant_values=stack.min())
+    outputs = []
+    with torch.inference_mode():
+        for i in range(len(stack)):
+            image = padded[i : i + 2 * context + 1]
+            outputs.append(activation(model(torch.tensor(image[None]))))
+    return torch.cat(outputs)
+
+
+def per_view(volume, pnet_c, pnet_s, pnet_a):
+    """Labels from one probability box per view, summed as (coronal + sagittal) + axial."""
+    softmax = partial(torch.softmax, dim=1)
+    out_c = per_slice(volume.stack("coronal"), pnet_c, softmax, context=1).permute(1, 3, 0, 2)
+    out_s = per_slice(volume.stack("sagittal"), pnet_s, softmax, context=1).permute(1, 0, 2, 3)
+    out_a = per_slice(volume.stack("axial"), pnet_a, softmax, context=1).permute(1, 3, 2, 0)
+    return torch.argmax((out_c + out_s) + out_a, 0).numpy()
+
+
+def head(shape, seed=0):
+    """Random foreground in the middle of a zero background."""
+    rng = np.random.default_rng(seed)
+    voxel = np.zeros(shape)
+    inner = tuple(slice(size // 4, size - size // 4) for size in shape)
+    voxel[inner] = rng.uniform(1, 100, voxel[inner].shape)
+    return voxel
+
+
+class InferTest(unittest.TestCase):
+    def setUp(self):
+        self.volume = Volume(head((16, 32, 16)))
+
+    def test_batches_match_per_slice_loop(self):
+        # CNet / SSNet: one slice in, sigmoid out.
+        stack = self.volume.stack("coronal")
+        model = unet(1, 1, 0)
+        expected = per_slice(stack, model, torch.sigmoid)
+        for batch in (1, 3, 7, 64):
+            output = infer(stack, model, "cpu", torch.sigmoid, torch.zeros(len(stack), 1, 16, 16), batch)
+            torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-6, msg=f"batch {batch}")
+
+    def test_windows_match_per_slice_loop(self):
+        # PNet: three neighbouring slices in, softmax out.
+        softmax = partial(torch.softmax, dim=1)
+        model = unet(3, 5, 1)
+        expected = per_slice(self.volume.stack("axial"), model, softmax, context=1)
+        for windows in (self.volume.windows("axial"), SliceWindows(self.volume.stack("axial"))):
+            output = infer(windows, model, "cpu", softmax, torch.zeros(16, 5, 32, 16), batch=5)
+            torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-6)
+
+    def test_skip_empty_matches_per_slice_loop(self):
+        # Windows outside the foreground get the prediction of one background window.
+        softmax = partial(torch.softmax, dim=1)
+        model = unet(3, 5, 1)
+        for view in ("coronal", "sagittal", "axial"):
+            stack = self.volume.stack(view)
+            expected = per_slice(stack, model, softmax, context=1)
+            tracer, counter = Tracer("s"), SkipCounter()
+            with activate(tracer), counting(counter):
+                output = infer(self.volume.windows(view), model, "cpu", softmax, torch.zeros(expected.shape), 3, skip_empty=True)
+            self.assertGreater(counter.skipped, 0)
+            # Counted with tracing off too, as the tracer counts them.
+            self.assertEqual(counter.skipped, tracer.summary()["skip_empty"]["skipped_slices"])
+            self.assertEqual(counter.slices, len(stack))
+            torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-6, msg=view)
+
+    def test_skipped_fraction_counts_every_slice(self):
+        # The second stack has foreground in every slice and skips none.
+        model = unet(1, 1, 0)
+        full = np.random.default_rng(2).uniform(1, 100, (12, 16, 16))
+        tracer, counter = Tracer("s"), SkipCounter()
+        with activate(tracer), counting(counter):
+            for stack in (self.volume.stack("coronal"), full):
+                infer(stack, model, "cpu", torch.sigmoid, torch.zeros(len(stack), 1, 16, 16), 4, skip_empty=True)
+        self.assertEqual(tracer.summary()["skip_empty"]["count"], 2)
+        skip = summarize({"s": tracer.summary()})["stages"]["skip_empty"]
+        self.assertEqual(skip["slices"], counter.slices)
+        self.assertEqual(skip["slices"], len(self.volume.stack("coronal")) + len(full))
+        self.assertEqual(skip["skipped_fraction"], counter.skipped / counter.slices)
+
+
+class ParcellationTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(module, "CLASSES", 5)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.volume = Volume(head((16, 32, 16), seed=1))
+        self.pnets = [unet(3, 5, seed) for seed in (2, 3, 4)]
+
+    def test_streamed_matches_per_view_boxes(self):
+        # The three views add into one accumulator through permuted views.
+        expected = per_view(self.volume, *self.pnets)
+        np.testing.assert_array_equal(parcellation(self.volume, *self.pnets, "cpu", batch=6), expected)
+
+    def test_skip_empty_matches_every_slice(self):
+        expected = per_view(self.volume, *self.pnets)
+        tracer = Tracer("s")
+        with activate(tracer):
+            labels = parcellation(self.volume, *self.pnets, "cpu", batch=6, skip_empty=True)
+        self.assertEqual(tracer.summary()["skip_empty"]["count"], 3)
+        np.testing.assert_array_equal(labels, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
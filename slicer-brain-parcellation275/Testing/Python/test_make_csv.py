@@ -0,0 +1,81 @@
+"""Region volume tables of utils/make_csv.py.
+
+    python -m unittest Testing/Python/test_make_csv.py
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.make_csv import append_csv, count_regions, level_path, make_csv, region_table, write_rows  # noqa: E402
+
+
+def per_label_csv(parcellation, save):
+    """The per-label loop make_csv() used before counting with bincount."""
+    df = pd.read_table(level_path, names=["number", "region"]).astype("str").set_index("number")
+    for i in range(280):
+        i += 1
+        volume = np.count_nonzero(parcellation == i)
+        df.loc[str(i), save] = volume
+    df = df.set_index("region").T.reset_index().rename(columns={"index": "uid"})
+    return df
+
+
+class MakeCsvTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        # Every label present, some far more often than others, and a few absent.
+        self.labels = rng.integers(0, 281, (48, 56, 40)).astype(np.uint16)
+        self.labels[self.labels == 7] = 0
+        self.labels[:10] = 42
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_matches_per_label_loop(self):
+        old = per_label_csv(self.labels, "sub0").to_csv(index=False)
+        self.assertEqual(make_csv(self.labels, "sub0").to_csv(index=False), old)
+        self.assertEqual(region_table(count_regions(self.labels), "sub0").to_csv(index=False), old)
+
+    def test_mm3(self):
+        zooms = (0.9, 1.0, 1.2)
+        voxels = region_table(count_regions(self.labels), "sub0")
+        mm3 = region_table(count_regions(self.labels), "sub0", zooms)
+        self.assertEqual(list(mm3.columns), list(voxels.columns))
+        np.testing.assert_allclose(
+            mm3.iloc[0, 1:].to_numpy(float), voxels.iloc[0, 1:].to_numpy(float) * 0.9 * 1.0 * 1.2
+        )
+
+    def test_cohort_appends_write_one_header(self):
+        path = os.path.join(self.tmp.name, "cohort.csv")
+        counts = count_regions(self.labels)
+        for save in ("sub0", "sub1", "sub2"):
+            append_csv(region_table(counts, save), path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(sum(line.startswith("uid,") for line in lines), 1)
+        table = pd.read_csv(path, dtype={"uid": str})
+        self.assertEqual(list(table["uid"]), ["sub0", "sub1", "sub2"])
+        np.testing.assert_array_equal(table.iloc[:, 1:].to_numpy(), np.tile(counts[1:], (3, 1)))
+
+    def test_cohort_rewrites_repeated_subject(self):
+        path = os.path.join(self.tmp.name, "cohort.csv")
+        counts = count_regions(self.labels)
+        write_rows(region_table(counts, "sub0"), path)
+        write_rows(region_table(counts, "sub1"), path)
+        write_rows(region_table(counts * 2, "sub0"), path)
+        table = pd.read_csv(path, dtype={"uid": str})
+        self.assertEqual(sorted(table["uid"]), ["sub0", "sub1"])
+        np.testing.assert_array_equal(table.set_index("uid").loc["sub0"].to_numpy(), counts[1:] * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
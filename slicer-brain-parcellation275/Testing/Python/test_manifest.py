@@ -0,0 +1,201 @@
+"""Per-stage fingerprints and skip-unchanged reruns of utils/manifest.py.
+
+    python -m unittest Testing/Python/test_manifest.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils import make_csv, manifest, pipeline  # noqa: E402
+from utils.cli import create_parser  # noqa: E402
+from utils.load_model import MODELS  # noqa: E402
+from utils.manifest import Fingerprints  # noqa: E402
+from utils.pipeline import is_complete, mark_complete, pending, read_manifest, refresh_tables  # noqa: E402
+from utils.region_stats import read_stats, region_stats, stats_table  # noqa: E402
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        self.models = os.path.join(root, "MODEL_FOLDER")
+        for path, _, _ in MODELS.values():
+            os.makedirs(os.path.dirname(os.path.join(self.models, path)), exist_ok=True)
+            with open(os.path.join(self.models, path), "wb") as f:
+                f.write(path.encode())
+        self.input = os.path.join(root, "in", "sub0.nii")
+        os.makedirs(os.path.dirname(self.input))
+        with open(self.input, "wb") as f:
+            f.write(b"input")
+        self.out = os.path.join(root, "out")
+        self.output_dir = os.path.join(self.out, "sub0")
+        os.makedirs(self.output_dir)
+        self.level = os.path.join(root, "Level5.txt")
+        shutil.copy(make_csv.level_path, self.level)
+        patch = mock.patch.object(manifest, "level_path", self.level)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.counts = np.bincount(np.random.default_rng(0).integers(0, 281, 5000), minlength=281)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def opt(self, *args):
+        return create_parser(["-i", os.path.dirname(self.input), "-o", self.out, "-m", self.models, *args])
+
+    def complete(self, opt):
+        """Write sub0 as the pipeline would under `opt`."""
+        for name in (f"sub0_280{opt.label_format}", "sub0_volume.csv"):
+            with open(os.path.join(self.output_dir, name), "w"):
+                pass
+        mark_complete(self.output_dir, "sub0", self.input, Fingerprints(opt).manifest(self.input, self.counts, (1.0, 1.0, 1.0)))
+
+    def stale(self, opt):
+        return Fingerprints(opt).stale(self.input, read_manifest(self.output_dir), self.output_dir, "sub0")
+
+    def test_unchanged(self):
+        opt = self.opt()
+        self.complete(opt)
+        self.assertEqual(self.stale(opt), [])
+        self.assertEqual(pending([self.input], opt, Fingerprints(opt)), [])
+
+    def test_input_changes(self):
+        opt = self.opt()
+        self.complete(opt)
+        # Touched but identical: not stale.
+        os.utime(self.input, (0, 0))
+        self.assertEqual(self.stale(opt), [])
+        with open(self.input, "ab") as f:
+            f.write(b"changed")
+        self.assertEqual(self.stale(opt), ["labels", "make_csv"])
+        self.assertEqual(pending([self.input], opt, Fingerprints(opt)), [self.input])
+
+    def test_weights_and_options_change_labels(self):
+        opt = self.opt()
+        self.complete(opt)
+        self.assertEqual(self.stale(self.opt("--parcellation-dtype", "float16")), ["labels", "make_csv"])
+        with open(os.path.join(self.models, MODELS["pnet_a"][0]), "ab") as f:
+            f.write(b"retrained")
+        self.assertEqual(self.stale(opt), ["labels", "make_csv"])
+
+    def test_performance_options_do_not_count(self):
+        opt = self.opt()
+        self.complete(opt)
+        self.assertEqual(self.stale(self.opt("-b", "4", "--workers", "2", "--sequential-stages")), [])
+        self.assertEqual(self.stale(self.opt("--no-skip-empty")), [])
+        self.assertEqual(self.stale(self.opt("--input-copy", "symlink", "--compile", "torchscript")), [])
+
+    def test_missing_output(self):
+        opt = self.opt()
+        self.complete(opt)
+        os.remove(os.path.join(self.output_dir, "sub0_volume.csv"))
+        self.assertEqual(self.stale(opt), ["make_csv"])
+        self.assertEqual(self.stale(self.opt("--label-format", ".nii.gz")), ["labels", "make_csv"])
+
+    def test_region_stats(self):
+        opt = self.opt()
+        self.complete(opt)
+        stats = self.opt("--region-stats", "csv")
+        self.assertEqual(self.stale(stats), ["region_stats"])
+        # Left to refresh_tables(), not segmented again.
+        self.assertEqual(pending([self.input], stats, Fingerprints(stats)), [])
+        self.assertFalse(is_complete(self.output_dir, "sub0", self.input, Fingerprints(self.opt("--crop-resolution", "128"))))
+        self.complete(stats)
+        self.assertEqual(self.stale(stats), ["region_stats"])
+        with open(os.path.join(self.output_dir, "sub0_stats.csv"), "w"):
+            pass
+        self.assertEqual(self.stale(stats), [])
+        # Turning them off again reruns nothing.
+        self.assertEqual(self.stale(opt), [])
+
+    def test_region_stats_only(self):
+        rng = np.random.default_rng(2)
+        affine = np.diag([1.2, 1.0, 0.9, 1.0])
+        nib.save(nib.Nifti1Image(rng.normal(300, 40, (12, 10, 8)).astype(np.float32), affine), self.input)
+        opt = self.opt()
+        self.complete(opt)
+        labels = rng.integers(0, 281, (12, 10, 8)).astype(np.uint16)
+        nib.save(nib.Nifti1Image(labels, affine), os.path.join(self.output_dir, "sub0_280.nii"))
+        stats = self.opt("--region-stats", "csv")
+        self.assertEqual(self.stale(stats), ["region_stats"])
+        # The label map is read back instead of segmenting again; N4 is left out here.
+        with mock.patch.object(pipeline, "bias_corrected", side_effect=lambda image, *args: image) as n4:
+            self.assertEqual(refresh_tables([self.input], stats, Fingerprints(stats)), ["sub0"])
+        self.assertEqual(n4.call_count, 1)
+        self.assertEqual(self.stale(stats), [])
+        expected = stats_table(region_stats(labels, np.asanyarray(nib.load(self.input).dataobj), affine), "sub0")
+        pd.testing.assert_frame_equal(read_stats(os.path.join(self.output_dir, "sub0_stats.csv")), expected)
+
+    def test_legacy_marker(self):
+        opt = self.opt()
+        mark_complete(self.output_dir, "sub0", self.input)
+        self.assertIsNone(self.stale(opt))
+        self.assertTrue(is_complete(self.output_dir, "sub0", self.input, Fingerprints(opt)))
+
+    def test_make_csv_only(self):
+        opt = self.opt()
+        self.complete(opt)
+        with open(self.level, "a") as f:
+            f.write("281\tExtra\n")
+        load_regions = make_csv.load_regions
+        with mock.patch.object(make_csv, "load_regions", lambda: load_regions(self.level)):
+            self.assertEqual(self.stale(opt), ["make_csv"])
+            self.assertEqual(pending([self.input], opt, Fingerprints(opt)), [])
+            self.assertEqual(refresh_tables([self.input], opt, Fingerprints(opt)), ["sub0"])
+            table = pd.read_csv(os.path.join(self.output_dir, "sub0_volume.csv"))
+            self.assertEqual(self.stale(opt), [])
+        self.assertEqual(table.loc[0, "Extra"], 0)
+        numbers, regions = load_regions(self.level)
+        np.testing.assert_array_equal(table[list(regions[:-1])].to_numpy()[0], self.counts[list(numbers[:-1])])
+
+    def test_cohort_csv(self):
+        cohort = os.path.join(self.tmp.name, "cohort.csv")
+        opt = self.opt("--cohort-csv", cohort)
+        for save in ("other", "sub0"):
+            make_csv.append_csv(make_csv.region_table(self.counts, save), cohort)
+        self.complete(opt)
+        for unit in ("mm3", "voxel"):
+            opt = self.opt("--cohort-csv", cohort, "--volume-unit", unit)
+            self.assertEqual(refresh_tables([self.input], opt, Fingerprints(opt)), ["sub0"])
+        table = pd.read_csv(cohort)
+        self.assertEqual(list(table["uid"]), ["other", "sub0"])
+
+        with open(self.level, "a") as f:
+            f.write("281\tExtra\n")
+        load_regions = make_csv.load_regions
+        with mock.patch.object(make_csv, "load_regions", lambda: load_regions(self.level)):
+            self.assertEqual(refresh_tables([self.input], opt, Fingerprints(opt)), ["sub0"])
+        table = pd.read_csv(cohort)
+        self.assertEqual(list(table["uid"]), ["other", "sub0"])
+        self.assertEqual(list(table.columns), ["uid", *load_regions(self.level)[1]])
+        self.assertEqual(table.loc[1, "Extra"], 0)
+
+    def test_cohort_csv_resume(self):
+        # The row was written, but the run stopped before marking sub0 complete.
+        cohort = os.path.join(self.tmp.name, "cohort.csv")
+        opt = self.opt("--cohort-csv", cohort)
+        pipeline.write_table(make_csv.region_table(self.counts, "other"), self.out, "other", opt)
+        for _ in range(2):
+            pipeline.write_table(make_csv.region_table(self.counts, "sub0"), self.output_dir, "sub0", opt)
+        self.assertEqual(list(pd.read_csv(cohort)["uid"]), ["other", "sub0"])
+
+    def test_region_table_matches_make_csv(self):
+        labels = np.random.default_rng(1).integers(0, 281, (20, 30, 40)).astype(np.uint16)
+        pd.testing.assert_frame_equal(
+            make_csv.make_csv(labels, "s", (1.0, 1.2, 0.9)),
+            make_csv.region_table(make_csv.count_regions(labels), "s", (1.0, 1.2, 0.9)),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
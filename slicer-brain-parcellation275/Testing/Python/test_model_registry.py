@@ -0,0 +1,100 @@
+"""Lazy loading and least-recently-used eviction of utils/load_model.ModelRegistry.
+
+    python -m unittest Testing/Python/test_model_registry.py
+"""
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils import load_model  # noqa: E402
+from utils.cli import create_parser  # noqa: E402
+from utils.load_model import MODELS, ModelRegistry, model_bytes  # noqa: E402
+
+# float32 elements of each stand-in network; cnet and ssnet weigh 400 bytes.
+SIZES = {"cnet": 100, "ssnet": 100, "pnet_c": 300, "pnet_s": 300, "pnet_a": 300, "hnet_c": 50, "hnet_a": 50}
+
+
+class Weights(torch.nn.Module):
+    def __init__(self, n):
+        super(Weights, self).__init__()
+        self.weight = torch.nn.Parameter(torch.zeros(n))
+        self.register_buffer("scale", torch.ones(1, dtype=torch.float64))
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.built = []
+
+        def build_model(path, ch_in, ch_out, device, compile="none"):
+            name = next(name for name, (file, _, _) in MODELS.items() if path.endswith(file))
+            self.built.append(name)
+            return Weights(SIZES[name])
+
+        patch = mock.patch.object(load_model, "build_model", side_effect=build_model)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_byte_count(self):
+        self.assertEqual(model_bytes(Weights(100)), 100 * 4 + 8)
+        registry = ModelRegistry("models", "cpu")
+        registry.get("cnet")
+        registry.get("pnet_c")
+        self.assertEqual(registry.nbytes(), 408 + 1208)
+
+    def test_lazy_and_resident(self):
+        registry = ModelRegistry("models", "cpu")
+        self.assertEqual(len(registry), 0)
+        first = registry.get("hnet_c")
+        self.assertIs(registry.get("hnet_c"), first)
+        self.assertEqual(self.built, ["hnet_c"])
+        self.assertIn("hnet_c", registry)
+        self.assertNotIn("hnet_a", registry)
+
+    def test_evicts_least_recently_used(self):
+        # Room for cnet, ssnet and one of the hemisphere networks.
+        registry = ModelRegistry("models", "cpu", max_bytes=408 * 2 + 208)
+        for name in ("cnet", "ssnet", "hnet_c"):
+            registry.get(name)
+        registry.get("cnet")
+        registry.get("hnet_a")
+        self.assertEqual(list(registry._models), ["hnet_c", "cnet", "hnet_a"])
+        self.assertLessEqual(registry.nbytes(), registry.max_bytes)
+        registry.get("ssnet")
+        self.assertEqual(list(registry._models), ["cnet", "hnet_a", "ssnet"])
+        self.assertEqual(self.built, ["cnet", "ssnet", "hnet_c", "hnet_a", "ssnet"])
+
+    def test_keeps_requested_network_above_cap(self):
+        registry = ModelRegistry("models", "cpu", max_bytes=500)
+        registry.get("cnet")
+        model = registry.get("pnet_a")
+        self.assertEqual(list(registry._models), ["pnet_a"])
+        self.assertIs(registry.get("pnet_a"), model)
+        self.assertGreater(registry.nbytes(), registry.max_bytes)
+
+    def test_lowering_cap_evicts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = load_model.get_registry(tmp, "cpu")
+            self.addCleanup(load_model._registries.clear)
+            for name in ("hnet_c", "hnet_a", "cnet"):
+                registry.get(name)
+            self.assertIs(load_model.get_registry(tmp, "cpu", max_bytes=500), registry)
+            self.assertEqual(list(registry._models), ["cnet"])
+
+    def test_load_model_is_lazy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.addCleanup(load_model._registries.clear)
+            opt = create_parser(["-i", tmp, "-o", tmp, "-m", tmp, "--model-memory", "1"])
+            registry = load_model.load_model(opt, "cpu")
+            self.assertEqual(self.built, [])
+            self.assertEqual(registry.max_bytes, 1024**2)
+
+
+if __name__ == "__main__":
+    unittest.main()
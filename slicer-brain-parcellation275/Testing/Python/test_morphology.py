@@ -0,0 +1,53 @@
+"""The bounding-box/slab morphology matches scipy.ndimage exactly.
+
+    python -m unittest Testing/Python/test_morphology.py
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+from scipy.ndimage import binary_closing, binary_dilation, gaussian_filter
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.morphology import close_cube, dilate_cross  # noqa: E402
+
+
+def masks(seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(6):
+        noise = gaussian_filter(rng.standard_normal((48, 37, 33)), 2)
+        yield noise > np.quantile(noise, rng.uniform(0.5, 0.97))
+    yield np.zeros((20, 20, 20), dtype=bool)
+    yield np.ones((20, 20, 20), dtype=bool)
+    corner = np.zeros((30, 20, 20), dtype=bool)
+    corner[0, 0, 0] = corner[-1, 5, -1] = True
+    corner[15, :, 3] = True
+    yield corner
+    # Slab windows in the gap hold no mask voxel at all.
+    gap = np.zeros((200, 40, 40), dtype=bool)
+    gap[0, 20, 20] = gap[-1, 10, 30] = True
+    yield gap
+
+
+class MorphologyTest(unittest.TestCase):
+    def test_dilate_cross(self):
+        for i, mask in enumerate(masks()):
+            for workers in (1, 3, 8):
+                with self.subTest(mask=i, workers=workers):
+                    np.testing.assert_array_equal(dilate_cross(mask, 5, workers), binary_dilation(mask, iterations=5))
+
+    def test_close_cube(self):
+        selem = np.ones((3, 3, 3), dtype=bool)
+        for i, mask in enumerate(masks()):
+            for workers in (1, 3, 8):
+                with self.subTest(mask=i, workers=workers):
+                    np.testing.assert_array_equal(
+                        close_cube(mask, 3, workers), binary_closing(mask, structure=selem, iterations=3)
+                    )
+
+
+if __name__ == "__main__":
+    unittest.main()
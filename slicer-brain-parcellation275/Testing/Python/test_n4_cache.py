@@ -0,0 +1,145 @@
+"""Content-addressed cache of N4-corrected volumes, utils/n4_cache.py.
+
+    python -m unittest Testing/Python/test_n4_cache.py
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils import n4_cache  # noqa: E402
+from utils.n4_cache import N4Cache  # noqa: E402
+from utils.outputs import tmp_path  # noqa: E402
+from utils.preprocessing import N4_PARAMS, preprocessing  # noqa: E402
+
+
+def small_image(value, shape=(6, 5, 4)):
+    image = sitk.GetImageFromArray(np.full(shape, value, dtype=np.float32))
+    image.SetSpacing((0.9, 1.1, 1.3))
+    image.SetOrigin((10.0, -20.0, 30.0))
+    return image
+
+
+class N4CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.root = os.path.join(self.dir, "cache")
+        self.input = os.path.join(self.dir, "in.nii")
+        with open(self.input, "wb") as f:
+            f.write(b"input")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def age(self, cache, keys):
+        """Give the entries of `keys` increasing mtimes, oldest first, well in the past."""
+        now = time.time()
+        for i, key in enumerate(keys):
+            os.utime(cache.path(key), (now - 1000 + i, now - 1000 + i))
+
+    def test_key(self):
+        cache = N4Cache(self.root)
+        key = cache.key(self.input, N4_PARAMS)
+        copy = os.path.join(self.dir, "copy.nii")
+        with open(copy, "wb") as f:
+            f.write(b"input")
+        self.assertEqual(cache.key(copy, N4_PARAMS), key)
+        self.assertEqual(cache.key(self.input, dict(reversed(list(N4_PARAMS.items())))), key)
+        self.assertNotEqual(cache.key(self.input, dict(N4_PARAMS, shrink_factor=2)), key)
+        with mock.patch.object(n4_cache.sitk, "Version_VersionString", return_value="0.0.0"):
+            self.assertNotEqual(cache.key(self.input, N4_PARAMS), key)
+        with open(copy, "wb") as f:
+            f.write(b"other")
+        self.assertNotEqual(cache.key(copy, N4_PARAMS), key)
+
+    def test_hits_and_misses(self):
+        cache = N4Cache(self.root)
+        self.assertIsNone(cache.get("a"))
+        stored = cache.put("a", small_image(3))
+        image = cache.get("a")
+        np.testing.assert_array_equal(stored.affine, image.affine)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        np.testing.assert_array_equal(np.asanyarray(image.dataobj), np.full((4, 5, 6), 3, dtype=np.float32))
+        np.testing.assert_allclose(image.header.get_zooms(), (0.9, 1.1, 1.3), rtol=1e-6)
+
+    def test_evicts_least_recently_used(self):
+        cache = N4Cache(self.root)
+        for key in "abc":
+            cache.put(key, small_image(1))
+        size = os.path.getsize(cache.path("a"))
+        self.age(cache, "abc")
+        cache.get("a")
+        # Room for three entries: "b", read longest ago, goes first.
+        cache.max_bytes = 3 * size
+        cache.put("d", small_image(1))
+        self.assertEqual(sorted(os.listdir(self.root)), ["a.nii", "c.nii", "d.nii"])
+        self.age(cache, "cad")
+        cache.max_bytes = 2 * size - 1
+        cache.evict()
+        self.assertEqual(os.listdir(self.root), ["d.nii"])
+
+    def test_no_cap(self):
+        cache = N4Cache(self.root, max_bytes=0)
+        for key in "abcd":
+            cache.put(key, small_image(1))
+        self.assertEqual(len(os.listdir(self.root)), 4)
+
+    def test_partial_entries(self):
+        cache = N4Cache(self.root)
+        cache.put("a", small_image(2))
+        # A write in progress on another node, under its temporary name.
+        partial = tmp_path(os.path.join(self.root, "b"), ".tmp.nii")
+        with open(cache.path("a"), "rb") as f:
+            content = f.read()
+        with open(partial, "wb") as f:
+            f.write(content[: len(content) // 2])
+        self.assertIsNone(cache.get("b"))
+        cache.max_bytes = 1
+        cache.evict()
+        self.assertEqual(os.listdir(self.root), [os.path.basename(partial)])
+        cache.max_bytes = None
+        # An entry cut short is a miss, and put() replaces it.
+        with open(cache.path("b"), "wb") as f:
+            f.write(content[: len(content) // 2])
+        self.assertIsNone(cache.get("b"))
+        with open(cache.path("b"), "wb") as f:
+            f.write(content[:100])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+        cache.put("b", small_image(5))
+        self.assertEqual(np.asanyarray(cache.get("b").dataobj).max(), 5)
+
+    def test_hit_matches_miss(self):
+        rng = np.random.default_rng(0)
+        grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in (40, 44, 36)], indexing="ij")
+        voxels = ((sum(g**2 for g in grid) < 0.6) * 400 + 20) * (1 + 0.3 * grid[0]) + rng.normal(0, 5, grid[0].shape)
+        # Oblique, but orthonormal: ITK refuses sform-only files with sheared directions.
+        c, s = np.cos(0.35), np.sin(0.35)
+        affine = np.eye(4)
+        affine[:3, :3] = np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]]) @ np.array([[1, 0, 0], [0, c, s], [0, -s, c]])
+        affine[:3, :3] *= (0.9, 1.1, 1.3)
+        affine[:3, 3] = (90, -120, -70)
+        nib.save(nib.Nifti1Image(voxels.astype(np.float32), affine), self.input)
+        cache = N4Cache(self.root)
+        miss = preprocessing(self.input, "s", cache=cache)
+        hit = preprocessing(self.input, "s", cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        for computed, cached in zip(miss, hit):
+            np.testing.assert_array_equal(cached.affine, computed.affine)
+            self.assertEqual(cached.shape, computed.shape)
+            np.testing.assert_array_equal(np.asanyarray(cached.dataobj), np.asanyarray(computed.dataobj))
+
+
+if __name__ == "__main__":
+    unittest.main()
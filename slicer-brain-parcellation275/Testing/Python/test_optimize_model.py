@@ -0,0 +1,101 @@
+"""Numerical equivalence of the inference-optimised UNet with the original.
+
+    python -m unittest Testing/Python/test_optimize_model.py
+"""
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils import load_model  # noqa: E402
+from utils.load_model import build_model, load_weights, optimize_model  # noqa: E402
+from utils.network import ConvBlock, UNet  # noqa: E402
+
+
+def trained_unet(ch_in, ch_out, seed=0):
+    """UNet with non-trivial BatchNorm statistics, as after training."""
+    torch.manual_seed(seed)
+    model = UNet(ch_in, ch_out)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.uniform_(-0.5, 0.5)
+                module.running_var.uniform_(0.5, 2.0)
+                module.weight.uniform_(0.5, 1.5)
+                module.bias.uniform_(-0.2, 0.2)
+    return model.eval()
+
+
+class OptimizeModelTest(unittest.TestCase):
+    def assertSameOutput(self, reference, optimized, ch_in, atol=1e-5):
+        torch.manual_seed(1)
+        x = torch.randn(3, ch_in, 32, 48)
+        with torch.inference_mode():
+            expected = reference(x)
+            actual = optimized(x)
+        self.assertEqual(actual.shape, expected.shape)
+        torch.testing.assert_close(actual, expected, atol=atol, rtol=1e-4)
+
+    def test_fuse_removes_batchnorm(self):
+        model = trained_unet(1, 3).fuse()
+        blocks = [m for m in model.modules() if isinstance(m, ConvBlock)]
+        self.assertEqual(len(blocks), 9)
+        self.assertFalse(any(isinstance(m, torch.nn.BatchNorm2d) for m in model.modules()))
+        self.assertTrue(all(block.conv1.bias is not None for block in blocks))
+
+    def test_fuse_is_equivalent(self):
+        for ch_in, ch_out in ((1, 1), (1, 3), (3, 142)):
+            with self.subTest(ch_in=ch_in, ch_out=ch_out):
+                reference = trained_unet(ch_in, ch_out)
+                self.assertSameOutput(reference, copy.deepcopy(reference).fuse(), ch_in)
+
+    def test_fuse_twice_is_noop(self):
+        reference = trained_unet(1, 3)
+        self.assertSameOutput(reference, copy.deepcopy(reference).fuse().fuse(), 1)
+
+    def test_channels_last(self):
+        reference = trained_unet(3, 142)
+        optimized = optimize_model(copy.deepcopy(reference))
+        self.assertTrue(optimized.model.econv1.conv.conv1.weight.is_contiguous(memory_format=torch.channels_last))
+        self.assertSameOutput(reference, optimized, 3)
+
+    def test_torchscript(self):
+        reference = trained_unet(1, 3)
+        self.assertSameOutput(reference, optimize_model(copy.deepcopy(reference), "torchscript"), 1)
+
+    @unittest.skipUnless(shutil.which("g++") or shutil.which("c++"), "torch.compile needs a C++ compiler")
+    def test_inductor(self):
+        reference = trained_unet(1, 3)
+        self.assertSameOutput(reference, optimize_model(copy.deepcopy(reference), "inductor"), 1, atol=1e-4)
+
+    def test_unknown_compile_mode(self):
+        with self.assertRaises(ValueError):
+            optimize_model(trained_unet(1, 1), "tensorrt")
+
+    def test_build_model_loads_before_fusing(self):
+        reference = trained_unet(3, 142)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "model.pth")
+            torch.save(reference.state_dict(), path)
+            optimized = build_model(path, 3, 142, "cpu")
+        self.assertSameOutput(reference, optimized, 3)
+
+    def test_weights_are_assigned_not_copied(self):
+        state = trained_unet(1, 3).state_dict()
+        with mock.patch.object(load_model, "load_state", return_value=state):
+            model = load_weights(UNet(1, 3), "model.pth")
+        self.assertEqual(model.econv0.weight.data_ptr(), state["econv0.weight"].data_ptr())
+        self.assertEqual(model.dconv1.conv.batchnorm2.running_var.data_ptr(), state["dconv1.conv.batchnorm2.running_var"].data_ptr())
+        self.assertTrue(model.econv0.weight.requires_grad)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Input copies and parallel-compressed label maps of utils/outputs.py.
+
+    python -m unittest Testing/Python/test_outputs.py
+"""
+import gzip
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils import outputs  # noqa: E402
+from utils.outputs import copy_input, save_nifti  # noqa: E402
+
+
+class OutputsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        rng = np.random.default_rng(0)
+        self.labels = nib.Nifti1Image(rng.integers(0, 281, (40, 48, 36)).astype(np.uint16), np.diag([0.9, 1, 1.2, 1]))
+        raw = nib.Nifti1Image(rng.integers(0, 900, (30, 32, 28)).astype(np.int16), np.diag([-1.0, 1, 1, 1]))
+        raw.header.set_slope_inter(0.5, 3.0)
+        self.input = os.path.join(self.dir, "in.nii")
+        nib.save(raw, self.input)
+        loaded = nib.load(self.input)
+        self.image = nib.Nifti1Image(np.asanyarray(loaded.dataobj, dtype=np.float32), loaded.affine, loaded.header)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_plain_nifti_matches_nibabel(self):
+        save_nifti(self.labels, os.path.join(self.dir, "a.nii"))
+        nib.save(self.labels, os.path.join(self.dir, "b.nii"))
+        self.assertEqual(self.read(os.path.join(self.dir, "a.nii")), self.read(os.path.join(self.dir, "b.nii")))
+
+    def test_gzip_in_parallel_blocks(self):
+        path = os.path.join(self.dir, "a.nii.gz")
+        with mock.patch.object(outputs, "BLOCK_BYTES", 4096):
+            save_nifti(self.labels, path, threads=3)
+        self.assertEqual(gzip.decompress(self.read(path)), self.labels.to_bytes())
+        np.testing.assert_array_equal(np.asanyarray(nib.load(path).dataobj), np.asanyarray(self.labels.dataobj))
+
+    @unittest.skipIf(outputs.pyzstd is None, "pyzstd is not installed")
+    def test_zstd(self):
+        path = os.path.join(self.dir, "a.nii.zst")
+        save_nifti(self.labels, path, threads=2)
+        self.assertEqual(outputs.pyzstd.decompress(self.read(path)), self.labels.to_bytes())
+
+    def test_writers_do_not_share_temporary_files(self):
+        # Two nodes of a --queue cohort writing the same label map.
+        path = os.path.join(self.dir, "s_280.nii")
+        with mock.patch.object(outputs.socket, "gethostname", return_value="b"):
+            other = outputs.tmp_path(path)
+        with open(other, "wb") as f:
+            f.write(b"partial")
+        with mock.patch.object(outputs.socket, "gethostname", return_value="a"):
+            save_nifti(self.labels, path)
+        self.assertEqual(self.read(path), self.labels.to_bytes())
+        self.assertEqual(self.read(other), b"partial")
+        self.assertEqual(sorted(os.listdir(self.dir)), sorted(["in.nii", "s_280.nii", os.path.basename(other)]))
+
+    def test_float32_copy_is_canonical(self):
+        copy_input(self.input, self.image, self.dir, "s")
+        copy = nib.load(os.path.join(self.dir, "s.nii"))
+        canonical = nib.as_closest_canonical(self.image)
+        self.assertEqual(copy.get_data_dtype(), np.float32)
+        np.testing.assert_array_equal(copy.affine, canonical.affine)
+        np.testing.assert_array_equal(np.asanyarray(copy.dataobj), np.asanyarray(canonical.dataobj))
+
+    def test_native_copy_and_links(self):
+        for mode in ("native", "symlink", "hardlink"):
+            with self.subTest(mode=mode):
+                copy_input(self.input, self.image, self.dir, mode, mode)
+                path = os.path.join(self.dir, f"{mode}.nii")
+                self.assertEqual(self.read(path), self.read(self.input))
+                self.assertEqual(os.path.islink(path), mode == "symlink")
+                if mode == "hardlink":
+                    self.assertTrue(os.path.samefile(path, self.input))
+                if mode == "symlink":
+                    self.assertEqual(os.path.realpath(path), os.path.realpath(self.input))
+
+    def test_reference(self):
+        copy_input(self.input, self.image, self.dir, "s", "reference")
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "s.nii")))
+        with open(os.path.join(self.dir, "s.input.json")) as f:
+            self.assertEqual(json.load(f)["input"], os.path.abspath(self.input))
+
+
+if __name__ == "__main__":
+    unittest.main()
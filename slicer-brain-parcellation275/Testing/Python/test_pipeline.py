@@ -0,0 +1,135 @@
+"""Inline and pipelined runs of utils/pipeline.run_pipeline, with stub stages.
+
+The process pool that prepares subjects is swapped for a thread pool, so
+the stubs need not be picklable; the driver sees the same futures.
+
+    python -m unittest Testing/Python/test_pipeline.py
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils import pipeline  # noqa: E402
+from utils.cli import create_parser  # noqa: E402
+from utils.pipeline import COMPLETE_MARKER, find_inputs, read_manifest, run_pipeline  # noqa: E402
+
+SUBJECTS = [f"sub{i}" for i in range(6)]
+# (--workers, --writers, --queue-depth)
+CONFIGS = [(0, 0, 2), (2, 2, 2), (3, 0, 3), (0, 2, 1), (1, 3, 4)]
+
+
+class PipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.tmp.name, "in")
+        os.makedirs(self.input)
+        for i, save in enumerate(SUBJECTS):
+            with open(os.path.join(self.input, f"{save}.nii"), "wb") as f:
+                f.write(bytes([i]) * 16)
+        self.models = os.path.join(self.tmp.name, "models")
+        self.lock = threading.Lock()
+        self.failing = {}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def stub_prepare(self, path, output_dir, save, tmp_dir=None, cache=None, trace_origin=None, input_copy="float32"):
+        index = SUBJECTS.index(save)
+        # Later subjects finish first, so pools complete out of order.
+        time.sleep(0.002 * (len(SUBJECTS) - index))
+        if self.failing.get("prepare") == save:
+            raise RuntimeError(f"prepare {save}")
+        os.makedirs(output_dir, exist_ok=True)
+        data = np.arange(64, dtype=np.int16).reshape(4, 4, 4) + index
+        return data, data, None, None
+
+    def stub_segment(self, data, models, device, opt, on_stage=None):
+        on_stage("cropping")
+        return (data * 3) % 281, (int(data.flat[0]), 0, 0)
+
+    def stub_write(self, output, shift, odata, data, output_dir, save, opt, tracer=None):
+        time.sleep(0.002 * (len(SUBJECTS) - SUBJECTS.index(save)))
+        if self.failing.get("write") == save:
+            raise RuntimeError(f"write {save}")
+        with open(os.path.join(output_dir, f"{save}_280.nii"), "wb") as f:
+            f.write(output.tobytes() + bytes(shift))
+        with self.lock:
+            self.writes.append(save)
+        return np.bincount(output.ravel(), minlength=281), (1.0, 1.0, 1.0)
+
+    def run_cohort(self, workers, writers, depth, out):
+        opt = create_parser([
+            "-i", self.input, "-o", out, "-m", self.models,
+            "--workers", str(workers), "--writers", str(writers), "--queue-depth", str(depth),
+        ])
+        self.writes = []
+        stages = []
+
+        def on_stage(save, stage):
+            stages.append((save, stage))
+
+        with mock.patch.object(pipeline, "prepare", self.stub_prepare), \
+                mock.patch.object(pipeline, "segment", self.stub_segment), \
+                mock.patch.object(pipeline, "write", self.stub_write), \
+                mock.patch.object(pipeline, "ProcessPoolExecutor", ThreadPoolExecutor):
+            done = []
+            for save in run_pipeline(find_inputs(self.input), None, "cpu", opt, on_stage):
+                # Yielded only once written and marked.
+                self.assertTrue(os.path.exists(os.path.join(out, save, COMPLETE_MARKER)))
+                done.append(save)
+        return done, stages
+
+    def outputs(self, out):
+        files = {}
+        for save in sorted(os.listdir(out)):
+            with open(os.path.join(out, save, f"{save}_280.nii"), "rb") as f:
+                files[save] = f.read()
+        return files
+
+    def test_same_outputs_in_same_order(self):
+        reference = None
+        for workers, writers, depth in CONFIGS:
+            with self.subTest(workers=workers, writers=writers, depth=depth):
+                out = os.path.join(self.tmp.name, f"out_{workers}_{writers}_{depth}")
+                done, stages = self.run_cohort(workers, writers, depth, out)
+                self.assertEqual(done, SUBJECTS)
+                self.assertEqual(sorted(self.writes), SUBJECTS)
+                for save in SUBJECTS:
+                    self.assertEqual(
+                        [stage for s, stage in stages if s == save], ["preprocessing", "cropping", "write"]
+                    )
+                    manifest = read_manifest(os.path.join(out, save))
+                    self.assertEqual(manifest["subject"], save)
+                    self.assertEqual(len(manifest["counts"]), 281)
+                # Segmented in input order, whatever order the pools finish in.
+                self.assertEqual([s for s, stage in stages if stage == "cropping"], SUBJECTS)
+                outputs = self.outputs(out)
+                if reference is None:
+                    reference = outputs
+                self.assertEqual(outputs, reference)
+
+    def test_errors_are_raised(self):
+        for stage in ("prepare", "write"):
+            for workers, writers, depth in CONFIGS:
+                with self.subTest(stage=stage, workers=workers, writers=writers):
+                    self.failing = {stage: "sub2"}
+                    out = os.path.join(self.tmp.name, f"{stage}_{workers}_{writers}_{depth}")
+                    with self.assertRaisesRegex(RuntimeError, f"{stage} sub2"):
+                        self.run_cohort(workers, writers, depth, out)
+                    self.assertFalse(os.path.exists(os.path.join(out, "sub2", COMPLETE_MARKER)))
+                    for save in SUBJECTS[:2]:
+                        self.assertTrue(os.path.exists(os.path.join(out, save, f"{save}_280.nii")))
+
+
+if __name__ == "__main__":
+    unittest.main()
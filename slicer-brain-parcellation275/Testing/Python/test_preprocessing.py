@@ -0,0 +1,123 @@
+"""In-memory N4 bridge of utils/preprocessing.py against the sitk.ReadImage/WriteImage round trip.
+
+    python -m unittest Testing/Python/test_preprocessing.py
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.preprocessing import N4_Bias_Field_Correction, bias_corrected, nibabel_to_sitk, sitk_to_nibabel  # noqa: E402
+
+
+def rotation(axis, degrees):
+    c, s = np.cos(np.radians(degrees)), np.sin(np.radians(degrees))
+    i, j = [a for a in range(3) if a != axis]
+    matrix = np.eye(3)
+    matrix[i, i], matrix[i, j], matrix[j, i], matrix[j, j] = c, -s, s, c
+    return matrix
+
+
+def affine(matrix, zooms, origin):
+    result = np.eye(4)
+    result[:3, :3] = matrix * np.asarray(zooms)
+    result[:3, 3] = origin
+    return result
+
+
+OBLIQUE = affine(rotation(2, 20) @ rotation(0, -12), (0.9, 1.1, 1.4), (-80.5, 96.25, -60))
+OTHER = affine(rotation(1, 35), (0.9, 1.1, 1.4), (-70, 90, -55.5))
+SHEAR = OBLIQUE @ np.array([[1, 0.15, 0, 0], [0, 1, 0, 0], [0, 0.1, 1, 0], [0, 0, 0, 1]])
+
+# name -> (qform, qform code, sform, sform code)
+HEADERS = {
+    "anisotropic": (affine(np.diag([-1, 1, 1]), (0.8, 1.0, 1.5), (60, -90, -40)), 1, None, 0),
+    "oblique": (OBLIQUE, 1, OBLIQUE, 1),
+    "qform_differs": (OBLIQUE, 1, OTHER, 1),
+    "sform_only": (None, 0, OBLIQUE, 2),
+    "shear": (OBLIQUE, 1, SHEAR, 1),
+}
+
+
+def head(shape=(32, 36, 28), seed=0):
+    """Bright ellipsoid on a dark background, with a smooth bias field."""
+    rng = np.random.default_rng(seed)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij")
+    inside = sum(g**2 for g in grid) < 0.6
+    bias = 1 + 0.3 * grid[0] + 0.2 * grid[1] * grid[2]
+    return ((inside * 400 + 20) * bias + rng.normal(0, 5, shape)).astype(np.float32)
+
+
+class PreprocessingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def save(self, name, shape=(32, 36, 28)):
+        qform, qcode, sform, scode = HEADERS[name]
+        image = nib.Nifti1Image(head(shape), None)
+        image.header.set_qform(qform, code=qcode)
+        image.header.set_sform(sform, code=scode)
+        path = os.path.join(self.dir, f"{name}.nii")
+        nib.save(image, path)
+        return path
+
+    def decoded(self, path):
+        # As prepare() decodes its input.
+        image = nib.squeeze_image(nib.load(path))
+        return nib.Nifti1Image(np.asanyarray(image.dataobj, dtype=np.float32), image.affine, image.header)
+
+    def assertSameImage(self, memory, disk):
+        self.assertEqual(memory.GetSize(), disk.GetSize())
+        self.assertEqual(memory.GetSpacing(), disk.GetSpacing())
+        self.assertEqual(memory.GetOrigin(), disk.GetOrigin())
+        self.assertEqual(memory.GetDirection(), disk.GetDirection())
+        np.testing.assert_array_equal(sitk.GetArrayFromImage(memory), sitk.GetArrayFromImage(disk))
+
+    def assertCloseNifti(self, memory, disk):
+        # sitk.WriteImage stores oblique directions with its own float32 rounding.
+        np.testing.assert_allclose(memory.affine, disk.affine, rtol=0, atol=1e-5)
+        np.testing.assert_allclose(memory.header.get_zooms(), disk.header.get_zooms(), rtol=1e-6)
+        np.testing.assert_array_equal(np.asanyarray(memory.dataobj), np.asanyarray(disk.dataobj))
+
+    def test_to_sitk_matches_read_image(self):
+        for name in HEADERS:
+            with self.subTest(name):
+                path = self.save(name)
+                self.assertSameImage(nibabel_to_sitk(self.decoded(path), path), sitk.ReadImage(path, sitk.sitkFloat32))
+
+    def test_affine_geometry_without_file(self):
+        path = self.save("anisotropic")
+        self.assertSameImage(nibabel_to_sitk(self.decoded(path)), sitk.ReadImage(path, sitk.sitkFloat32))
+
+    def test_to_nibabel_matches_write_image(self):
+        for name in HEADERS:
+            with self.subTest(name):
+                image = sitk.ReadImage(self.save(name), sitk.sitkFloat32)
+                path = os.path.join(self.dir, f"{name}_written.nii")
+                sitk.WriteImage(image, path)
+                self.assertCloseNifti(sitk_to_nibabel(image), nib.load(path))
+
+    def test_n4_matches_disk_round_trip(self):
+        for name in ("oblique", "qform_differs"):
+            with self.subTest(name):
+                path = self.save(name, (48, 48, 40))
+                disk_path = os.path.join(self.dir, f"{name}_n4.nii")
+                N4_Bias_Field_Correction(path, disk_path)
+                disk = nib.squeeze_image(nib.as_closest_canonical(nib.load(disk_path)))
+                memory = bias_corrected(self.decoded(path), name, geometry=path)
+                self.assertCloseNifti(memory, disk)
+
+
+if __name__ == "__main__":
+    unittest.main()
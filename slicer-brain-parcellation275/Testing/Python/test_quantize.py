@@ -0,0 +1,93 @@
+"""INT8 quantization helpers and the float32 agreement guard.
+
+    python -m unittest Testing/Python/test_quantize.py
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.load_model import ModelRegistry  # noqa: E402
+from utils.network import UNet  # noqa: E402
+from utils.quantize import (  # noqa: E402
+    THRESHOLDS,
+    Recorder,
+    build_quantized,
+    compare,
+    quantize_model,
+    save_report,
+)
+
+
+class QuantizeTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = UNet(1, 3).eval()
+        self.recorder = Recorder(self.model, every=3)
+        for _ in range(4):
+            self.recorder(torch.randn(5, 1, 32, 32))
+
+    def test_recorder_keeps_every_nth_slice(self):
+        self.assertEqual(self.recorder.seen, 20)
+        self.assertEqual(sum(len(s) for s in self.recorder.slices), 7)
+
+    def test_quantized_close_to_float(self):
+        quantized = quantize_model(self.model, self.recorder.batches(4))
+        x = torch.randn(2, 1, 32, 32)
+        with torch.inference_mode():
+            expected, actual = self.model(x), quantized(x)
+        self.assertLess((expected - actual).abs().max().item(), 0.05 * expected.abs().max().item())
+
+    def test_save_and_load(self):
+        quantized = quantize_model(self.model, self.recorder.batches(4))
+        x = torch.randn(2, 1, 32, 32)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "model.pth")
+            torch.save(quantized.state_dict(), path)
+            loaded = build_quantized(path, 1, 3)
+        with torch.inference_mode():
+            self.assertTrue(torch.equal(quantized(x), loaded(x)))
+
+
+class CompareTest(unittest.TestCase):
+    def setUp(self):
+        self.labels = np.random.default_rng(0).integers(0, 281, (64, 64, 64)).astype(np.int16)
+
+    def test_identical(self):
+        result = compare(self.labels, self.labels)
+        self.assertEqual(result["mean_dice"], 1.0)
+        self.assertEqual(result["max_volume_error"], 0.0)
+        self.assertTrue(result["accepted"])
+
+    def test_rejects_large_disagreement(self):
+        test = self.labels.copy()
+        test[:16] = 0
+        result = compare(self.labels, test)
+        self.assertLess(result["mean_dice"], THRESHOLDS["min_mean_dice"])
+        self.assertFalse(result["accepted"])
+
+
+class GuardTest(unittest.TestCase):
+    def test_refuses_unvalidated_and_rejected(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(RuntimeError):
+                ModelRegistry(tmp, "cpu", int8_folder=tmp)
+            save_report(tmp, {"accepted": False, "thresholds": THRESHOLDS})
+            with self.assertRaises(RuntimeError):
+                ModelRegistry(tmp, "cpu", int8_folder=tmp)
+            save_report(tmp, {"accepted": True, "backend": "x86", "thresholds": THRESHOLDS})
+            self.assertEqual(ModelRegistry(tmp, "cpu", int8_folder=tmp).int8_report["backend"], "x86")
+
+    def test_cpu_only(self):
+        with self.assertRaises(ValueError):
+            ModelRegistry("models", "cuda", int8_folder="int8")
+
+
+if __name__ == "__main__":
+    unittest.main()
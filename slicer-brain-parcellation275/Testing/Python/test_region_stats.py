@@ -0,0 +1,97 @@
+"""Per-region statistics of utils/region_stats.py against a per-label loop.
+
+    python -m unittest Testing/Python/test_region_stats.py
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils import region_stats as module  # noqa: E402
+from utils.make_csv import load_regions  # noqa: E402
+from utils.region_stats import STATISTICS, read_stats, region_stats, stats_table, write_stats  # noqa: E402
+
+
+def reference(labels, intensity, affine, n):
+    stats = {name: np.full(n, np.nan) for name in STATISTICS}
+    stats["voxels"][:] = 0
+    for label in range(n):
+        mask = labels == label
+        if not mask.any():
+            continue
+        index = np.argwhere(mask)
+        values = intensity[mask].astype(np.float64)
+        stats["voxels"][label] = mask.sum()
+        stats["mean"][label] = values.mean()
+        stats["sd"][label] = values.std()
+        centroid = affine[:3, :3] @ index.mean(axis=0) + affine[:3, 3]
+        for axis, name in enumerate("ijk"):
+            stats[f"centroid_{'xyz'[axis]}"][label] = centroid[axis]
+            stats[f"min_{name}"][label] = index[:, axis].min()
+            stats[f"max_{name}"][label] = index[:, axis].max()
+    return stats
+
+
+class RegionStatsTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.labels = np.zeros((23, 19, 17), dtype=np.uint16)
+        self.labels[3:15, 2:12, 5:16] = rng.integers(0, 9, (12, 10, 11))
+        self.labels[20, 18, 0] = 12
+        self.intensity = rng.normal(300, 40, self.labels.shape).astype(np.float32)
+        self.affine = np.array([[0, -1.1, 0.1, 90], [0.9, 0, 0, -120], [0, 0.05, 1.3, -70], [0, 0, 0, 1]])
+
+    def check(self, stats, n=13):
+        expected = reference(self.labels, self.intensity, self.affine, n)
+        for name in STATISTICS:
+            np.testing.assert_allclose(stats[name], expected[name], rtol=1e-9, atol=1e-9, err_msg=name)
+
+    def test_matches_per_label_loop(self):
+        # Label 9..11 are absent, 12 is a single voxel in the last plane.
+        for planes in (1, 4, 16, 64):
+            self.check(region_stats(self.labels, self.intensity, self.affine, planes))
+
+    def test_memory_layouts(self):
+        # SimpleITK volumes come as transposed (Fortran-ordered) arrays.
+        intensity = np.asfortranarray(self.intensity)
+        self.check(region_stats(self.labels, intensity, self.affine, 3))
+        self.check(region_stats(np.asfortranarray(self.labels), self.intensity, self.affine, 5))
+
+    def test_table(self):
+        stats = region_stats(self.labels, self.intensity, self.affine)
+        df = stats_table(stats, "sub0")
+        numbers, regions = load_regions()
+        self.assertEqual(len(df), 1)
+        self.assertEqual(len(df.columns), 1 + len(STATISTICS) * len(regions))
+        self.assertEqual(df.loc[0, "uid"], "sub0")
+        label = numbers.index(1)
+        self.assertEqual(df.loc[0, f"voxels_{regions[label]}"], stats["voxels"][1])
+        self.assertEqual(df.loc[0, f"max_k_{regions[label]}"], stats["max_k"][1])
+        # Labels above the map's maximum: no voxels, no statistics.
+        self.assertEqual(df.loc[0, f"voxels_{regions[-1]}"], 0)
+        self.assertTrue(np.isnan(df.loc[0, f"mean_{regions[-1]}"]))
+
+    def test_csv_round_trip(self):
+        df = stats_table(region_stats(self.labels, self.intensity, self.affine), "sub0")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sub0_stats.csv")
+            write_stats(df, path)
+            pd.testing.assert_frame_equal(read_stats(path), df)
+
+    @unittest.skipIf(module.pyarrow is None, "needs pyarrow")
+    def test_parquet_round_trip(self):
+        df = stats_table(region_stats(self.labels, self.intensity, self.affine), "sub0")
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sub0_stats.parquet")
+            write_stats(df, path)
+            pd.testing.assert_frame_equal(read_stats(path), df)
+
+
+if __name__ == "__main__":
+    unittest.main()
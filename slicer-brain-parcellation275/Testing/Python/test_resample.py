@@ -0,0 +1,79 @@
+"""to_native() against uncrop() followed by nibabel's conform(order=0).
+
+    python -m unittest Testing/Python/test_resample.py
+"""
+import os
+import sys
+import unittest
+
+import nibabel as nib
+import numpy as np
+from nibabel import processing
+from nibabel.affines import from_matvec, rescale_affine
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.postprocessing import uncrop  # noqa: E402
+from utils.resample import to_native  # noqa: E402
+
+
+def rotation(angles):
+    a, b, c = angles
+    x = np.array([[1, 0, 0], [0, np.cos(a), -np.sin(a)], [0, np.sin(a), np.cos(a)]])
+    y = np.array([[np.cos(b), 0, np.sin(b)], [0, 1, 0], [-np.sin(b), 0, np.cos(b)]])
+    z = np.array([[np.cos(c), -np.sin(c), 0], [np.sin(c), np.cos(c), 0], [0, 0, 1]])
+    return x @ y @ z
+
+
+def images(shape, zooms, angles=(0, 0, 0)):
+    """A native image like prepare()'s odata and the conformed grid made from it."""
+    affine = from_matvec(rotation(angles) * np.array(zooms), [-90.0, -110.5, -70.25])
+    odata = nib.Nifti1Image(np.zeros(shape, dtype=np.float32), affine)
+    conformed = rescale_affine(odata.affine, odata.shape, (1.0, 1.0, 1.0), (256, 256, 256))
+    data = nib.Nifti1Image(np.zeros((256, 256, 256), dtype=np.uint8), conformed)
+    return odata, data
+
+
+def reference(labels, shift, odata, data):
+    output = uncrop(labels, shift)
+    nii = nib.Nifti1Image(output.astype(np.uint16), affine=data.affine)
+    header = odata.header
+    return processing.conform(
+        nii,
+        out_shape=(header["dim"][1], header["dim"][2], header["dim"][3]),
+        voxel_size=(header["pixdim"][1], header["pixdim"][2], header["pixdim"][3]),
+        order=0,
+    )
+
+
+class ToNativeTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.labels = rng.integers(0, 281, size=(192, 224, 192)).astype(np.int64)
+
+    def check(self, shape, zooms, shift, angles=(0, 0, 0)):
+        odata, data = images(shape, zooms, angles)
+        expected = reference(self.labels, shift, odata, data)
+        native = to_native(self.labels, shift, odata, data)
+        np.testing.assert_array_equal(native.affine, expected.affine)
+        self.assertEqual(native.get_data_dtype(), expected.get_data_dtype())
+        np.testing.assert_array_equal(np.asanyarray(native.dataobj), np.asanyarray(expected.dataobj))
+        self.assertEqual(native.header.binaryblock, expected.header.binaryblock)
+
+    def test_isotropic_grid_with_half_voxel_ties(self):
+        self.check((176, 240, 255), (1.0, 1.0, 1.0), (3, -7, 12))
+
+    def test_anisotropic_grid(self):
+        self.check((160, 192, 96), (1.2, 0.9375, 1.8), (-11, 4, 0))
+
+    def test_oblique_grid(self):
+        self.check((130, 150, 110), (1.5, 1.5, 1.6), (5, 2, -9), angles=(0.1, -0.05, 0.2))
+
+    def test_shift_wraps_around_the_volume(self):
+        # np.roll wraps: with shifts beyond the crop margins the brain crosses the edge.
+        self.check((128, 128, 100), (2.0, 2.0, 2.5), (45, -30, -60))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+"""Dependency order, concurrency and thread split of the stage scheduler.
+
+    python -m unittest Testing/Python/test_scheduler.py
+"""
+import os
+import sys
+import threading
+import unittest
+
+import torch
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.inference import SkipCounter, counting, skip_counter  # noqa: E402
+from utils.pipeline import REQUIRES, STAGES  # noqa: E402
+from utils.scheduler import Stage, order, run_stages  # noqa: E402
+
+
+def diamond(log, barrier=None):
+    def branch(name):
+        def run(x):
+            log.append((name, threading.get_ident(), torch.get_num_threads()))
+            if barrier is not None:
+                barrier.wait(timeout=10)
+            return x + [name]
+
+        return run
+
+    return [
+        Stage("left", ("root",), branch("left")),
+        Stage("right", ("root",), branch("right")),
+        Stage("join", ("left", "right"), lambda a, b: (a, b)),
+    ]
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_order_follows_dependencies(self):
+        stages = [Stage("b", ("a",), None), Stage("a", (), None), Stage("c", ("a",), None)]
+        self.assertEqual([s.name for s in order(stages)], ["a", "b", "c"])
+        with self.assertRaises(ValueError):
+            order([Stage("x", ("y",), None), Stage("y", ("x",), None)])
+        with self.assertRaises(ValueError):
+            order([Stage("x", ("missing",), None)])
+
+    def test_pipeline_stages_are_declared_in_order(self):
+        stages = [Stage(name, requires, None) for name, requires in REQUIRES.items()]
+        self.assertEqual(tuple(s.name for s in order(stages)), STAGES)
+
+    def test_independent_stages_run_together_with_split_threads(self):
+        log, started = [], []
+        # Both branches have to be inside run() at once to pass the barrier.
+        results = run_stages(
+            diamond(log, threading.Barrier(2)), {"root": []}, threads=4, on_stage=started.append
+        )
+        self.assertEqual(results["join"], (["left"], ["right"]))
+        self.assertEqual(started, ["left", "right", "join"])
+        self.assertEqual(sorted(threads for _, _, threads in log), [2, 2])
+        self.assertNotEqual(log[0][1], log[1][1])
+
+    def test_thread_count_is_restored(self):
+        # Threads started after a concurrent run, like the writers, get the caller's count.
+        previous = torch.get_num_threads()
+        self.addCleanup(torch.set_num_threads, previous)
+        torch.set_num_threads(4)
+        log = []
+        run_stages(diamond(log, threading.Barrier(2)), {"root": []})
+        self.assertEqual(sorted(threads for _, _, threads in log), [2, 2])
+        self.assertEqual(torch.get_num_threads(), 4)
+        later = []
+        thread = threading.Thread(target=lambda: later.append(torch.get_num_threads()))
+        thread.start()
+        thread.join()
+        self.assertEqual(later, [4])
+
+    def test_worker_threads_count_skipped_slices(self):
+        counter = SkipCounter()
+        stages = [Stage(name, ("root",), lambda x: skip_counter()) for name in ("left", "right")]
+        with counting(counter):
+            results = run_stages(stages, {"root": None}, threads=2)
+        self.assertIs(results["left"], counter)
+        self.assertIs(results["right"], counter)
+
+    def test_sequential_runs_on_the_calling_thread(self):
+        log = []
+        results = run_stages(diamond(log), {"root": []}, concurrent=False)
+        self.assertEqual([name for name, _, _ in log], ["left", "right"])
+        self.assertEqual({ident for _, ident, _ in log}, {threading.get_ident()})
+        self.assertEqual(results["join"], (["left"], ["right"]))
+
+    def test_errors_propagate(self):
+        def fail(x):
+            raise RuntimeError("stage failed")
+
+        stages = [Stage("left", ("root",), fail), Stage("right", ("root",), lambda x: x)]
+        with self.assertRaisesRegex(RuntimeError, "stage failed"):
+            run_stages(stages, {"root": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Span memory sampling of utils/trace.py.
+
+    python -m unittest Testing/Python/test_trace.py
+"""
+import os
+import sys
+import threading
+import unittest
+
+import numpy as np
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.functions import current_rss, reset_peak_rss  # noqa: E402
+from utils.trace import Tracer  # noqa: E402
+
+
+def touch(mib):
+    # Allocated and written, so the pages are resident.
+    data = np.ones(mib * 1024**2 // 8)
+    return float(data[-1])
+
+
+@unittest.skipUnless(current_rss() is not None and reset_peak_rss(), "needs Linux /proc/self/clear_refs")
+class TraceMemoryTest(unittest.TestCase):
+    def test_peak_per_span(self):
+        tracer = Tracer("s")
+        with tracer.span("large", memory=True):
+            touch(400)
+        with tracer.span("small", memory=True):
+            touch(20)
+        large, small = (event["args"] for event in tracer.events)
+        self.assertGreater(large["peak_rss_mib"] - large["rss_start_mib"], 350)
+        # A process-lifetime peak would still include the large span's 400 MiB.
+        self.assertLess(small["peak_rss_mib"] - small["rss_start_mib"], 200)
+        self.assertNotIn("peak_shared", large)
+        self.assertNotIn("peak_shared", small)
+
+    def test_overlapping_spans_share_the_peak(self):
+        tracer = Tracer("s")
+        entered, release = threading.Event(), threading.Event()
+
+        def other():
+            with tracer.span("other", memory=True):
+                entered.set()
+                release.wait()
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        entered.wait()
+        with tracer.span("main", memory=True):
+            pass
+        release.set()
+        thread.join()
+        with tracer.span("after", memory=True):
+            pass
+        shared = {event["name"]: event["args"].get("peak_shared", False) for event in tracer.events}
+        self.assertEqual(shared, {"main": True, "other": True, "after": False})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""The per-subject Volume against per-stage normalize() and transposes.
+
+    python -m unittest Testing/Python/test_volume.py
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.functions import normalize  # noqa: E402
+from utils.inference import SliceWindows, occupied  # noqa: E402
+from utils.volume import VIEWS, Volume  # noqa: E402
+
+
+def reference_normalize(voxel):
+    nonzero = voxel[voxel > 0]
+    voxel = np.clip(voxel, 0, np.mean(nonzero) + np.std(nonzero) * 2)
+    voxel = (voxel - np.min(voxel)) / (np.max(voxel) - np.min(voxel))
+    return ((voxel * 2) - 1).astype("float32")
+
+
+def brain(shape=(40, 44, 36), seed=0):
+    rng = np.random.default_rng(seed)
+    voxel = np.zeros(shape)
+    voxel[5:-7, 3:-9, 6:-4] = rng.normal(300, 120, (shape[0] - 12, shape[1] - 12, shape[2] - 10))
+    return voxel
+
+
+class VolumeTest(unittest.TestCase):
+    def test_normalize_matches_two_pass_statistics(self):
+        voxel = brain()
+        # The one-pass SD may differ in the last bits, moving a voxel by an ulp at most.
+        np.testing.assert_allclose(normalize(voxel), reference_normalize(voxel), rtol=0, atol=1e-6)
+        self.assertEqual(normalize(voxel).dtype, np.float32)
+
+    def test_stacks_are_contiguous_views(self):
+        volume = Volume(brain())
+        for view, axes in VIEWS.items():
+            stack = volume.stack(view)
+            self.assertTrue(stack.flags.c_contiguous)
+            self.assertTrue(np.shares_memory(stack, volume.padded(view)))
+            np.testing.assert_array_equal(stack, volume.normalized.transpose(axes))
+
+    def test_windows_match_padded_copies(self):
+        volume = Volume(brain())
+        for view in VIEWS:
+            expected = SliceWindows(volume.normalized.transpose(VIEWS[view]), context=1)
+            windows = volume.windows(view)
+            self.assertEqual(windows.shape, expected.shape)
+            np.testing.assert_array_equal(windows[3:11], expected[3:11])
+            np.testing.assert_array_equal(occupied(windows), occupied(expected))
+            self.assertTrue(np.shares_memory(windows[0:4], volume.padded(view)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+"""Leases, takeover and cohort summary of utils/work_queue.py.
+
+    python -m unittest Testing/Python/test_work_queue.py
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+module_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+sys.path.insert(0, module_dir)
+
+from utils.cli import create_parser  # noqa: E402
+from utils.pipeline import mark_complete  # noqa: E402
+from utils.work_queue import LEASE, WorkQueue, summary  # noqa: E402
+
+
+class WorkQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.out = self.tmp.name
+        self.paths = [f"/data/sub{i}.nii" for i in range(4)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def queue(self, node, **kwargs):
+        kwargs.setdefault("wait", False)
+        return WorkQueue(self.paths, self.out, node, heartbeat=0.05, timeout=1, **kwargs)
+
+    def lease(self, i):
+        return os.path.join(self.out, f"sub{i}", LEASE)
+
+    def finish(self, queue, path):
+        save = os.path.splitext(os.path.basename(path))[0]
+        mark_complete(os.path.join(self.out, save), save, path)
+        queue.release(save)
+
+    def test_cohort_csv_is_refused(self):
+        # The cohort table is only serialised within one process.
+        args = ["-i", self.out, "-o", self.out, "-m", self.out, "--queue"]
+        self.assertTrue(create_parser(args).queue)
+        with mock.patch("sys.stderr"), self.assertRaises(SystemExit):
+            create_parser([*args, "--cohort-csv", os.path.join(self.out, "cohort.csv")])
+
+    def test_nodes_claim_disjoint_subjects(self):
+        a, b = self.queue("a"), self.queue("b")
+        claims_a, claims_b = a.claims(), b.claims()
+        first = [next(claims_a), next(claims_b), next(claims_a), next(claims_b)]
+        self.assertEqual(first, self.paths)
+        self.assertEqual(list(claims_a), [])
+        a.close()
+        b.close()
+
+    def test_complete_subjects_are_skipped(self):
+        a = self.queue("a")
+        os.makedirs(os.path.join(self.out, "sub0"))
+        mark_complete(os.path.join(self.out, "sub0"), "sub0", self.paths[0])
+        claimed = []
+        for path in a.claims():
+            claimed.append(path)
+            self.finish(a, path)
+        a.close()
+        self.assertEqual(claimed, self.paths[1:])
+        self.assertFalse(any(os.path.exists(self.lease(i)) for i in range(4)))
+        self.assertFalse(self.queue("b").claim(self.paths[0]))
+
+    def test_table_refreshes_are_leased(self):
+        # Subjects whose tables alone are stale: one node refreshes each.
+        stale = set(self.paths[1:3])
+        a, b = self.queue("a"), self.queue("b")
+        claims_a = a.claims(stale.__contains__)
+        self.assertEqual(next(claims_a), self.paths[1])
+        self.assertEqual(list(b.claims(stale.__contains__)), [self.paths[2]])
+        self.assertEqual(list(claims_a), [])
+        self.assertTrue(os.path.exists(self.lease(1)))
+        # Refreshed meanwhile by the node holding the lease.
+        stale.discard(self.paths[2])
+        b.release("sub2")
+        self.assertFalse(a.claim(self.paths[2], stale.__contains__))
+        a.release("sub1")
+        self.assertFalse(any(os.path.exists(self.lease(i)) for i in range(4)))
+        # Refreshes are not segmented subjects.
+        self.assertEqual((a.seconds, b.seconds), ([], []))
+        a.close()
+        b.close()
+
+    def test_stale_lease_is_taken_over(self):
+        a, b = self.queue("a"), self.queue("b")
+        self.assertTrue(a.claim(self.paths[0]))
+        self.assertFalse(b.claim(self.paths[0]))
+        old = time.time() - 60
+        os.utime(self.lease(0), (old, old))
+        self.assertTrue(b.claim(self.paths[0]))
+        self.assertEqual(b.taken_over, 1)
+        # The old owner must not remove the new owner's lease.
+        a.release("sub0")
+        self.assertTrue(os.path.exists(self.lease(0)))
+
+    def test_heartbeat_keeps_lease_fresh(self):
+        a = self.queue("a")
+        claims = a.claims()
+        next(claims)
+        old = time.time() - 60
+        os.utime(self.lease(0), (old, old))
+        time.sleep(0.3)
+        self.assertGreater(os.stat(self.lease(0)).st_mtime, old + 30)
+        self.assertFalse(self.queue("b").claim(self.paths[0]))
+        a.close()
+
+    def test_heartbeat_notices_foreign_lease(self):
+        a = self.queue("a")
+        claims = a.claims()
+        next(claims)
+        # Replaced by another node after a takeover, as if it were put back too late.
+        os.remove(self.lease(0))
+        self.assertTrue(self.queue("c").claim(self.paths[0]))
+        old = time.time() - 60
+        os.utime(self.lease(0), (old, old))
+        time.sleep(0.3)
+        self.assertEqual(a.lost, 1)
+        self.assertEqual(a.leases, {})
+        self.assertLess(os.stat(self.lease(0)).st_mtime, old + 1)
+        a.close()
+        self.assertTrue(os.path.exists(self.lease(0)))
+
+    def test_wait_for_others(self):
+        a, b = self.queue("a"), self.queue("b", wait=True)
+        self.assertTrue(a.claim(self.paths[0]))
+        for path in b.claims():
+            self.finish(b, path)
+        self.assertFalse(self.queue("c").wait_for_others())
+        old = time.time() - 60
+        os.utime(self.lease(0), (old, old))
+        self.assertTrue(b.wait_for_others())
+        self.assertEqual(list(b.claims()), self.paths[:1])
+        self.finish(b, self.paths[0])
+        self.assertFalse(b.wait_for_others())
+        b.close()
+
+    def test_close_returns_unfinished_leases(self):
+        a = self.queue("a")
+        claims = a.claims()
+        self.finish(a, next(claims))
+        next(claims)
+        a.close()
+        self.assertFalse(os.path.exists(self.lease(1)))
+        self.assertTrue(self.queue("b").claim(self.paths[1]))
+
+    def test_summary(self):
+        a, b = self.queue("a"), self.queue("b")
+        self.finish(a, next(a.claims()))
+        self.assertTrue(b.claim(self.paths[1]))
+        self.assertTrue(b.claim(self.paths[2]))
+        old = time.time() - 60
+        os.utime(self.lease(2), (old, old))
+        b.write_status()
+        a.close()
+        result = summary(self.paths, self.out, timeout=1)
+        self.assertEqual(result["complete"], 1)
+        self.assertEqual(result["in_progress"], {"sub1": "b"})
+        self.assertEqual(result["stale"], ["sub2"])
+        self.assertEqual(result["pending"], ["sub3"])
+        self.assertEqual(result["nodes"]["a"]["subjects"], 1)
+        self.assertIsNotNone(result["nodes"]["a"]["finished"])
+        self.assertEqual(result["nodes"]["b"]["in_progress"], ["sub1", "sub2"])
+        # Leases are aged on the filesystem's clock, not on a skewed local one.
+        with mock.patch.object(time, "time", return_value=time.time() + 3600):
+            result = summary(self.paths, self.out, timeout=1)
+        self.assertEqual(result["in_progress"], {"sub1": "b"})
+
+
+if __name__ == "__main__":
+    unittest.main()
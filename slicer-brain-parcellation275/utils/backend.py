@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import torch
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+BACKENDS = ("torch", "onnxruntime")
+
+
+def onnx_path(folder, checkpoint):
+    """ONNX file of a MODELS checkpoint path, e.g. PNet/coronal.pth -> PNet/coronal.onnx."""
+    return os.path.join(folder, os.path.splitext(checkpoint)[0] + ".onnx")
+
+
+class OnnxModel:
+    """ONNX Runtime session with the interface `infer()` expects of a network.
+
+    Called with a (B, C, H, W) float32 tensor, returns the logits as a CPU
+    tensor. The session runs the graph with all ONNX Runtime optimizations
+    on `threads` intra-op threads (0 lets ONNX Runtime choose).
+    """
+
+    def __init__(self, path, threads=0):
+        if ort is None:
+            raise ImportError("the onnxruntime backend needs the onnxruntime package")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.nbytes = os.path.getsize(path)
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        # Slice windows arrive as strided views; ONNX Runtime wants them packed.
+        x = np.ascontiguousarray(x.detach().cpu().numpy())
+        return torch.from_numpy(self.session.run(None, {self.input_name: x})[0])
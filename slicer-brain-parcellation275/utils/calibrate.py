@@ -0,0 +1,114 @@
+"""Make INT8 versions of the seven networks and validate them against float32.
+
+    python utils/calibrate.py -m MODEL_FOLDER -o INT8_FOLDER \
+        --calibrate ref1.nii ref2.nii --validate val1.nii val2.nii
+
+The float32 networks are run on the calibration volumes to record the
+slices each one sees; static post-training quantization is calibrated on
+those. Both precisions then segment the validation volumes (the calibration
+volumes when none are given) and the label maps are compared per region:
+Dice and the volumes make_csv would report. INT8_FOLDER/quantization.json
+records the result, and `--int8-models INT8_FOLDER` is only accepted when
+every validation subject stayed within the thresholds.
+"""
+import argparse
+import os
+import sys
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import torch
+
+from utils.load_model import MODELS, build_model, load_weights
+from utils.network import UNet
+from utils.pipeline import segment
+from utils.postprocessing import uncrop
+from utils.preprocessing import preprocessing
+from utils.quantize import (
+    THRESHOLDS,
+    Recorder,
+    build_quantized,
+    compare,
+    default_backend,
+    quantize_model,
+    save_report,
+)
+
+
+def create_parser(args_list):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-m", required=True, help="Folder of the float32 pretrained models.")
+    parser.add_argument("-o", required=True, help="Folder to write the INT8 networks and quantization.json to.")
+    parser.add_argument("--calibrate", nargs="+", required=True, help="Reference volumes to calibrate on.")
+    parser.add_argument("--validate", nargs="*", default=None, help="Volumes to validate on; defaults to the calibration volumes.")
+    parser.add_argument("--every", type=int, default=16, help="Keep every n-th slice a network sees for calibration.")
+    parser.add_argument("--backend", default=default_backend(), choices=torch.backends.quantized.supported_engines)
+    parser.add_argument("-b", "--batch-size", type=int, default=0)
+    parser.add_argument("--parcellation-dtype", choices=["float32", "float16", "bfloat16"], default="float32")
+    parser.add_argument("--crop-resolution", type=int, default=256)
+    parser.add_argument("--no-skip-empty", dest="skip_empty", action="store_false")
+    parser.add_argument("--sequential-stages", dest="concurrent_stages", action="store_false")
+    for name, value in THRESHOLDS.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    return parser.parse_args(args_list)
+
+
+def float_unet(model_folder, name):
+    path, ch_in, ch_out = MODELS[name]
+    return load_weights(UNet(ch_in, ch_out), os.path.join(model_folder, path)).eval()
+
+
+def main(argv=None):
+    opt = create_parser(argv)
+    thresholds = {name: getattr(opt, name) for name in THRESHOLDS}
+    device = torch.device("cpu")
+
+    recorders = {name: Recorder(float_unet(opt.m, name), opt.every) for name in MODELS}
+    for path in opt.calibrate:
+        print(f"calibrating on {path}")
+        _, data = preprocessing(path, os.path.basename(path))
+        segment(data, recorders, device, opt)
+
+    for name, (path, _, _) in MODELS.items():
+        batches = recorders[name].batches()
+        print(f"quantizing {name} on {sum(len(b) for b in batches)} slices")
+        quantized = quantize_model(recorders[name].model, batches, opt.backend)
+        os.makedirs(os.path.dirname(os.path.join(opt.o, path)), exist_ok=True)
+        torch.save(quantized.state_dict(), os.path.join(opt.o, path))
+    del recorders
+
+    float_models = {name: build_model(os.path.join(opt.m, path), ch_in, ch_out, device) for name, (path, ch_in, ch_out) in MODELS.items()}
+    int8_models = {name: build_quantized(os.path.join(opt.o, path), ch_in, ch_out, opt.backend) for name, (path, ch_in, ch_out) in MODELS.items()}
+    subjects = {}
+    for path in opt.validate or opt.calibrate:
+        print(f"validating on {path}")
+        _, data = preprocessing(path, os.path.basename(path))
+        # Compared on the conformed grid: the two brains may be centered differently.
+        reference = uncrop(*segment(data, float_models, device, opt))
+        test = uncrop(*segment(data, int8_models, device, opt))
+        subjects[path] = compare(reference, test, thresholds)
+        print(
+            "  mean Dice {mean_dice:.4f}, worst label {worst_label} {min_label_dice:.4f}, "
+            "max volume error {max_volume_error:.2%}: {verdict}".format(
+                verdict="ok" if subjects[path]["accepted"] else "FAILED", **subjects[path]
+            )
+        )
+
+    accepted = all(result["accepted"] for result in subjects.values())
+    save_report(opt.o, {
+        "accepted": accepted,
+        "backend": opt.backend,
+        "thresholds": thresholds,
+        "model_folder": os.path.abspath(opt.m),
+        "calibration": [os.path.abspath(path) for path in opt.calibrate],
+        "every": opt.every,
+        "parcellation_dtype": opt.parcellation_dtype,
+        "subjects": subjects,
+    })
+    print(f"INT8 networks {'accepted' if accepted else 'REJECTED'}; report in {os.path.join(opt.o, 'quantization.json')}")
+    return 0 if accepted else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
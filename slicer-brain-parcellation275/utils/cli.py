@@ -0,0 +1,373 @@
+"""Headless entry point: runs the segmentation pipeline without Slicer.
+
+    python utils/cli.py -i INPUT -o OUTPUT -m MODEL_FOLDER [options]
+
+Only needs torch, nibabel, SimpleITK and the other packages the pipeline
+imports. Subjects that already have their outputs are skipped, so rerunning
+the same command after an interruption resumes the batch. With --queue,
+several machines share the batch through the output folder; see
+utils/work_queue.py.
+
+    python utils/cli.py --serve
+
+keeps one process, and the networks it has loaded, for many runs: it reads
+one JSON list of the arguments above per line of stdin, as the Slicer
+widget sends them, and reports the end of each run as an "exit" progress
+event with its exit code.
+"""
+import argparse
+import json
+import os
+import sys
+import traceback
+
+if __package__ in (None, ""):
+    # Run as a script: make `utils` importable like it is inside Slicer.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import torch
+from tqdm import tqdm
+
+from utils.backend import BACKENDS
+from utils.functions import peak_rss
+from utils.load_model import COMPILE_MODES, load_model
+from utils.manifest import Fingerprints
+from utils.n4_cache import N4Cache
+from utils.outputs import INPUT_COPIES, LABEL_FORMATS
+from utils.pipeline import Cancelled, find_inputs, pending, refresh_tables, run_pipeline, stale_tables, subject
+from utils.region_stats import STATS_FORMATS
+from utils.work_queue import WorkQueue, describe, save_summary, summary
+
+# Prefix of the machine-readable lines written with --progress.
+PROGRESS = "@progress "
+
+
+def create_parser(args_list):
+    parser = argparse.ArgumentParser(
+        description="Use this to run inference with OpenMAP-T1."
+    )
+    parser.add_argument(
+        "-i",
+        required=True,
+        help="Input folder. Specifies the folder containing the input brain MRI images.",
+    )
+    parser.add_argument(
+        "-o",
+        required=True,
+        help="Output folder. Difines the output folder where the results will be saved. If the specified folder does not exist, it will be automatically created.",
+    )
+    parser.add_argument(
+        "-m",
+        required=True,
+        help="Folder of pretrained models. Indicates the location of the pretrained models to be used for processing.",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=0,
+        help="Number of slices per forward pass. 0 picks the largest batch that fits the inference memory budget.",
+    )
+    parser.add_argument(
+        "--parcellation-dtype",
+        choices=["float32", "float16", "bfloat16"],
+        default="float32",
+        help="Precision of the shared parcellation probability volume. float16/bfloat16 halve its memory at the cost of exact agreement with float32.",
+    )
+    parser.add_argument(
+        "--volume-unit",
+        choices=["voxel", "mm3"],
+        default="voxel",
+        help="Unit of the region volumes written by make_csv.",
+    )
+    parser.add_argument(
+        "--cohort-csv",
+        default=None,
+        help="Append every subject's region volumes to this cohort-wide CSV instead of writing one _volume.csv per subject. Not with --queue.",
+    )
+    parser.add_argument(
+        "--region-stats",
+        choices=STATS_FORMATS,
+        default="none",
+        help="Also write {save}_stats.csv or {save}_stats.parquet: per-region voxel count, mean and SD of the N4-corrected intensity, centroid and bounding box, on the native grid. parquet needs the pyarrow package. Turned on for subjects segmented before, it reads their label maps back and only reruns N4 (or takes it from --n4-cache), not the networks.",
+    )
+    parser.add_argument(
+        "--input-copy",
+        choices=INPUT_COPIES,
+        default="float32",
+        help="What {save}.nii next to the outputs is: the input reoriented to RAS as float32 (default), a byte copy of the input in its own dtype (native), a symlink or hardlink to it, or nothing but a {save}.input.json reference to it.",
+    )
+    parser.add_argument(
+        "--label-format",
+        choices=LABEL_FORMATS,
+        default=".nii",
+        help="File format of the {save}_280 label map. .nii.gz is compressed on --compress-threads threads; .nii.zst needs the pyzstd package and cannot be loaded by 3D Slicer.",
+    )
+    parser.add_argument(
+        "--compress-threads",
+        type=int,
+        default=0,
+        help="Threads that compress a .nii.gz or .nii.zst label map. 0 uses the torch intra-op thread count.",
+    )
+    parser.add_argument(
+        "--model-memory",
+        type=int,
+        default=0,
+        help="Memory cap in MiB for networks kept resident between runs. Least recently used networks are released above it; 0 keeps all of them.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Processes that run N4 and conform on upcoming subjects while the current one is segmented. 0 runs them inline.",
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=0,
+        help="Threads that resample and write finished subjects in the background. 0 writes inline.",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=2,
+        help="Maximum number of subjects prepared ahead of, or waiting to be written behind, the one being segmented.",
+    )
+    parser.add_argument(
+        "--crop-resolution",
+        type=int,
+        default=256,
+        help="Run the coarse head-mask network (CNet) on a downsampled cube of this size, e.g. 128, and upsample its mask. Must be a multiple of 16; 256 runs it at full resolution.",
+    )
+    parser.add_argument(
+        "--no-skip-empty",
+        dest="skip_empty",
+        action="store_false",
+        help="Run parcellation and hemisphere networks on every slice. By default all-background slices outside the brain are filled with the network's background prediction instead, and the share of slices skipped is printed per subject.",
+    )
+    parser.add_argument(
+        "--sequential-stages",
+        dest="concurrent_stages",
+        action="store_false",
+        help="Run parcellation and hemisphere one after the other. By default they run at the same time, each with half of the torch threads and of the inference memory budget.",
+    )
+    parser.add_argument(
+        "--compile",
+        choices=COMPILE_MODES,
+        default="none",
+        help="Compile the networks after BatchNorm folding: TorchScript or torch.compile (inductor, needs a C++ compiler). The first forward passes are slower while compiling.",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="torch",
+        help="Inference backend. onnxruntime runs the networks exported by utils/export_onnx.py on the CPU.",
+    )
+    parser.add_argument(
+        "--onnx-models",
+        default=None,
+        help="Folder of the exported ONNX networks for --backend onnxruntime. Defaults to ONNX inside the model folder.",
+    )
+    parser.add_argument(
+        "--int8-models",
+        default=None,
+        help="Folder of INT8 networks made and validated by utils/calibrate.py. CPU only; refused unless they passed validation against float32.",
+    )
+    parser.add_argument(
+        "--n4-dir",
+        default=None,
+        help="Also write each bias-corrected volume to this folder. By default N4 output stays in memory.",
+    )
+    parser.add_argument(
+        "--n4-cache",
+        default=None,
+        help="Folder of cached N4-corrected volumes, keyed by input file hash and N4 parameters. Unchanged inputs skip N4 on reruns.",
+    )
+    parser.add_argument(
+        "--n4-cache-size",
+        type=int,
+        default=20480,
+        help="Size cap of the N4 cache in MiB; least recently used volumes are deleted above it. 0 disables the cap.",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Record per-stage and per-forward-pass timings, tensor sizes and memory. Writes {save}_trace.json (Chrome trace format) per subject and trace_summary.json for the cohort.",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Segment every input again. By default subjects with a completion marker, or with both a {save}_280 label map and {save}_volume.csv, are skipped so an interrupted batch resumes where it stopped. Marked subjects whose input, networks or options changed since are segmented again, or only get make_csv rerun when just Level5.txt, --volume-unit or --cohort-csv changed.",
+    )
+    parser.add_argument(
+        "--device",
+        default=None,
+        help="Torch device for inference, e.g. cpu or cuda:1. Defaults to cuda when available.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="Number of torch intra-op threads. 0 keeps the torch default.",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help=f"Print one '{PROGRESS}{{json}}' line to stdout per subject and stage, for front ends such as the Slicer module.",
+    )
+    parser.add_argument(
+        "--cancel-file",
+        default=None,
+        help="Stop before the next stage once this file exists. Subjects already written stay complete.",
+    )
+    parser.add_argument(
+        "--queue",
+        action="store_true",
+        help="Share the inputs with other machines running the same command on the same output folder. Each subject is leased by one node at a time; see utils/work_queue.py.",
+    )
+    parser.add_argument(
+        "--node-name",
+        default=None,
+        help="Name of this node in the --queue leases and throughput files. Defaults to {hostname}-{pid}.",
+    )
+    parser.add_argument(
+        "--heartbeat",
+        type=float,
+        default=30,
+        help="Seconds between refreshes of this node's --queue leases.",
+    )
+    parser.add_argument(
+        "--lease-timeout",
+        type=float,
+        default=300,
+        help="Seconds without a heartbeat after which another node takes over a --queue lease.",
+    )
+    parser.add_argument(
+        "--no-queue-wait",
+        dest="queue_wait",
+        action="store_false",
+        help="Exit once no --queue subject is left to claim. By default a node waits for the subjects other nodes are segmenting, to take them over should their node die.",
+    )
+    opt = parser.parse_args(args_list)
+    if opt.queue and opt.overwrite:
+        parser.error("--overwrite cannot be combined with --queue: nodes would redo each other's subjects")
+    if opt.queue and opt.cohort_csv:
+        parser.error("--cohort-csv cannot be combined with --queue: nodes on other hosts would overwrite each other's rows; gather the _volume.csv files instead")
+    if opt.queue and opt.lease_timeout <= 2 * opt.heartbeat:
+        parser.error("--lease-timeout must be more than twice --heartbeat")
+    if opt.crop_resolution <= 0 or opt.crop_resolution % 16:
+        parser.error("--crop-resolution must be a positive multiple of 16")
+    return opt
+
+
+def report(event, **fields):
+    print(PROGRESS + json.dumps(dict(fields, event=event)), flush=True)
+
+
+def main(argv=None):
+    opt = create_parser(argv)
+    if opt.device:
+        device = torch.device(opt.device)
+    elif opt.backend == "onnxruntime" or opt.int8_models:
+        # Both only run on the CPU.
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    pathes = find_inputs(opt.i)
+    fingerprints = Fingerprints(opt)
+    cache = N4Cache(opt.n4_cache, opt.n4_cache_size * 1024**2) if opt.n4_cache else None
+    queue = None
+    if opt.queue:
+        queue = WorkQueue(pathes, opt.o, opt.node_name, opt.heartbeat, opt.lease_timeout, opt.queue_wait, fingerprints)
+        # Each node refreshes the tables of the subjects it holds a lease on.
+        try:
+            refreshed = refresh_tables(
+                queue.claims(lambda path: stale_tables(path, opt, fingerprints)), opt, fingerprints, cache
+            )
+        except BaseException:
+            queue.close()
+            raise
+        for save in refreshed:
+            queue.release(save)
+    else:
+        refreshed = refresh_tables(pathes, opt, fingerprints, cache)
+    if refreshed:
+        print(f"Tables brought up to date for {len(refreshed)} subjects whose label maps are up to date")
+    if queue is not None:
+        left = len(pending(pathes, opt, fingerprints))
+        print(f"{len(pathes)} inputs, {left} not complete, shared with the other nodes as {queue.node} on {device}")
+        todo, total = queue.claims(), None if left else 0
+    else:
+        todo = pending(pathes, opt, fingerprints)
+        print(f"{len(pathes)} inputs, {len(pathes) - len(todo)} up to date, {len(todo)} to segment on {device}")
+        total = len(todo)
+    if opt.progress:
+        # Under --queue the subjects are only known as they are claimed.
+        report("start", subjects=[] if queue else [subject(path, opt.o)[0] for path in todo])
+    if total == 0:
+        if queue is not None:
+            queue.close()
+        return 0
+
+    def on_stage(save, stage):
+        if opt.cancel_file and os.path.exists(opt.cancel_file):
+            raise Cancelled(f"cancelled before {stage} of {save}")
+        if opt.progress:
+            report("stage", subject=save, stage=stage)
+
+    models = load_model(opt, device)
+    try:
+        while True:
+            for save in tqdm(run_pipeline(todo, models, device, opt, on_stage), total=total):
+                if queue is not None:
+                    queue.release(save)
+                if opt.progress:
+                    report("done", subject=save)
+                rss = peak_rss()
+                if rss is not None:
+                    tqdm.write(f"{save}: peak RSS {rss:.0f} MiB")
+            # Another round for subjects whose node died before finishing them.
+            if queue is None or not queue.wait_for_others():
+                break
+            todo = queue.claims()
+    except Cancelled as e:
+        print(e)
+        if opt.progress:
+            report("cancelled")
+        return 1
+    finally:
+        if queue is not None:
+            queue.close()
+            result = summary(pathes, opt.o, opt.lease_timeout)
+            save_summary(opt.o, result)
+            print(describe(result))
+    return 0
+
+
+def serve(lines=None):
+    """Run `main()` once per line of `lines` (default stdin), each a JSON list of arguments.
+
+    The process-wide model registry keeps the networks of one run for the
+    next. A run that fails is reported and the worker waits for the next one.
+    """
+    for line in lines if lines is not None else sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            code = main(json.loads(line))
+        except SystemExit as e:
+            # Argument errors, already printed by argparse.
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        sys.stderr.flush()
+        report("exit", code=code)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(serve() if sys.argv[1:] == ["--serve"] else main())
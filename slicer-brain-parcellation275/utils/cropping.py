@@ -1,40 +1,43 @@
-import numpy as np
 import torch
-from scipy.ndimage import binary_closing
+import torch.nn.functional as F
+from utils.inference import infer
+from utils.morphology import close_cube
+from utils.volume import Volume
 
-from utils.functions import normalize
 
+def crop(voxel, model, device, batch=None):
+    output = torch.zeros(voxel.shape).to(device)
+    return infer(voxel, model, device, torch.sigmoid, output, batch)
 
-def crop(voxel, model, device):
-    model.eval()
-    with torch.inference_mode():
-        output = torch.zeros(256, 256, 256).to(device)
-        for i, v in enumerate(voxel):
-            image = v.reshape(1, 1, 256, 256)
-            image = torch.tensor(image).to(device)
-            x_out = torch.sigmoid(model(image)).detach()
-            if i == 0:
-                output[0] = x_out
-            else:
-                output[i] = x_out
-        return output.reshape(256, 256, 256)
 
-
-def closing(voxel):
-    selem = np.ones((3, 3, 3), dtype="bool")
-    voxel = binary_closing(voxel, structure=selem, iterations=3)
-    return voxel
+def resample(voxel, size, mode):
+    """Resize a cubic volume (numpy or torch) to `size`^3 as a float32 tensor."""
+    voxel = torch.as_tensor(voxel, dtype=torch.float32)[None, None]
+    return F.interpolate(voxel, size=(size,) * 3, mode=mode)[0, 0]
 
 
-def cropping(data, cnet, device):
-    voxel = data.get_fdata()
-    voxel = normalize(voxel)
-
-    coronal = voxel.transpose(1, 2, 0)
-    sagittal = voxel
-    out_c = crop(coronal, cnet, device).permute(2, 0, 1)
-    out_s = crop(sagittal, cnet, device)
-    out_e = ((out_c + out_s) / 2) > 0.5
+def closing(voxel):
+    # Same as binary_closing with a 3x3x3 cube and iterations=3.
+    return close_cube(voxel, 3)
+
+
+def cropping(data, cnet, device, batch=None, resolution=256):
+    """Head mask by CNet, applied to the conformed volume.
+
+    With `resolution` below 256, CNet runs on an area-downsampled
+    `resolution`^3 volume and its probabilities are trilinearly upsampled
+    before thresholding; the mask is coarse anyway and closed afterwards.
+    """
+    volume = Volume(data.get_fdata())
+    if resolution != volume.shape[0]:
+        volume = Volume(resample(volume.normalized, resolution, "area").numpy(), normalized=True)
+
+    out_c = crop(volume.stack("coronal"), cnet, device, batch).permute(2, 0, 1)
+    out_s = crop(volume.stack("sagittal"), cnet, device, batch)
+    out_e = (out_c + out_s) / 2
+    if resolution != data.shape[0]:
+        out_e = resample(out_e.cpu(), data.shape[0], "trilinear")
+    out_e = out_e > 0.5
     out_e = out_e.cpu().numpy()
     out_e = closing(out_e)
     cropped = data.get_fdata() * out_e
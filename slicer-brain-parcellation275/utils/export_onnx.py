@@ -0,0 +1,75 @@
+"""Export the seven networks to ONNX for `--backend onnxruntime`.
+
+    python utils/export_onnx.py -m MODEL_FOLDER [-o MODEL_FOLDER/ONNX]
+
+Each checkpoint is exported with BatchNorm folded and dynamic batch and
+slice dimensions, next to the others under the same sub-folder layout
+(e.g. PNet/coronal.pth -> ONNX/PNet/coronal.onnx). Every export is checked
+against the PyTorch network before moving on.
+"""
+import argparse
+import os
+import sys
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import numpy as np
+import torch
+
+from utils.backend import OnnxModel, onnx_path
+from utils.load_model import MODELS, load_weights
+from utils.network import UNet
+
+
+def export(model, ch_in, path, opset=17):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    example = torch.zeros(2, ch_in, 64, 64)
+    axes = {0: "batch", 2: "height", 3: "width"}
+    torch.onnx.export(
+        model,
+        (example,),
+        path,
+        input_names=["input"],
+        output_names=["output"],
+        dynamic_axes={"input": axes, "output": axes},
+        opset_version=opset,
+        dynamo=False,
+    )
+
+
+def check(model, path, ch_in, shape=(3, 96, 80)):
+    """Largest absolute difference between ONNX Runtime and PyTorch logits."""
+    x = torch.from_numpy(np.random.default_rng(0).standard_normal((shape[0], ch_in) + shape[1:]).astype(np.float32))
+    with torch.inference_mode():
+        expected = model(x)
+    return (OnnxModel(path)(x) - expected).abs().max().item()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-m", required=True, help="Folder of pretrained models.")
+    parser.add_argument("-o", default=None, help="Output folder; defaults to ONNX inside the model folder.")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="Largest accepted logit difference to PyTorch.")
+    opt = parser.parse_args(argv)
+    output = opt.o or os.path.join(opt.m, "ONNX")
+
+    failed = []
+    for name, (checkpoint, ch_in, ch_out) in MODELS.items():
+        model = load_weights(UNet(ch_in, ch_out), os.path.join(opt.m, checkpoint))
+        model.fuse()
+        path = onnx_path(output, checkpoint)
+        export(model, ch_in, path, opset=opt.opset)
+        error = check(model, path, ch_in)
+        print(f"{name}: {path} (max logit difference {error:.2e})")
+        if not error <= opt.tolerance:
+            failed.append(name)
+    if failed:
+        print(f"ONNX Runtime disagrees with PyTorch for {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,85 @@
+import sys
+
 import numpy as np
 
 
-def normalize(voxel):
-    nonzero = voxel[voxel > 0]
-    voxel = np.clip(voxel, 0, np.mean(nonzero) + np.std(nonzero) * 2)
-    voxel = (voxel - np.min(voxel)) / (np.max(voxel) - np.min(voxel))
-    voxel = (voxel * 2) - 1
-    return voxel.astype("float32")
+def statistics(voxel, planes=8):
+    """Min, max, and mean and SD of the positive voxels, in one pass over `voxel`.
+
+    The volume is read `planes` planes at a time, so every slab is reduced
+    while it is still in cache; the SD comes from the sum of squares.
+    """
+    lo, hi = np.inf, -np.inf
+    count = total = squares = np.float64(0)
+    for start in range(0, len(voxel), planes):
+        slab = np.asarray(voxel[start : start + planes], dtype=np.float64)
+        positive = slab[slab > 0]
+        lo, hi = min(lo, slab.min()), max(hi, slab.max())
+        count += positive.size
+        total += positive.sum()
+        squares += np.dot(positive, positive)
+    mean = total / count if count else np.nan
+    sd = np.sqrt(max(squares / count - mean * mean, 0)) if count else np.nan
+    return lo, hi, mean, sd
+
+
+def normalize(voxel, planes=8):
+    """Clip at mean + 2 SD of the positive voxels and rescale to [-1, 1], as float32.
+
+    Works slab by slab in float64 (see `statistics`), so the only full-size
+    array it allocates is the float32 result.
+    """
+    lo, hi, mean, sd = statistics(voxel, planes)
+    top = mean + sd * 2
+    # Clipping is monotonic: the clipped volume's range is the clipped range.
+    lo, hi = np.clip(lo, 0, top), np.clip(hi, 0, top)
+    out = np.empty(np.shape(voxel), dtype="float32")
+    for start in range(0, len(voxel), planes):
+        slab = np.clip(np.asarray(voxel[start : start + planes], dtype=np.float64), 0, top)
+        out[start : start + planes] = ((slab - lo) / (hi - lo)) * 2 - 1
+    return out
+
+
+def peak_rss():
+    """Peak resident set size of this process in MiB, or None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+
+def _status_mib(field):
+    """A memory field of /proc/self/status (Linux) in MiB, or None."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss():
+    """Resident set size of this process in MiB, or None where /proc is missing."""
+    return _status_mib("VmRSS")
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS counter (Linux); returns False elsewhere."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_since_reset():
+    """Peak RSS in MiB since `reset_peak_rss()`, or `peak_rss()` where it cannot be reset."""
+    peak = _status_mib("VmHWM")
+    return peak if peak is not None else peak_rss()
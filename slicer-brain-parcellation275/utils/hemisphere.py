@@ -1,43 +1,32 @@
-import torch
-from scipy.ndimage import binary_dilation
+from functools import partial
 
-from utils.functions import normalize
+import torch
+from utils.inference import infer
+from utils.morphology import dilate_cross
+from utils.volume import as_volume
 
-def separate(voxel, model, device, mode):
+def separate(voxel, model, device, mode, batch=None, skip_empty=False):
     if mode == "c":
         stack = (224, 192, 192)
     elif mode == "a":
         stack = (192, 224, 192)
 
-    model.eval()
-    with torch.inference_mode():
-        output = torch.zeros(stack[0], 3, stack[1], stack[2]).to(device)
-        for i, v in enumerate(voxel):
-            image = torch.tensor(v.reshape(1, 1, stack[1], stack[2]))
-            image = image.to(device)
-            x_out = torch.softmax(model(image), 1).detach()
-            if i == 0:
-                output[0] = x_out
-            else:
-                output[i] = x_out
-        return output
-
-def hemisphere(voxel, hnet_c, hnet_a, device):
-    voxel = normalize(voxel)
+    output = torch.zeros(stack[0], 3, stack[1], stack[2]).to(device)
+    return infer(voxel, model, device, partial(torch.softmax, dim=1), output, batch, skip_empty=skip_empty)
 
-    coronal = voxel.transpose(1, 2, 0)
-    transverse = voxel.transpose(2, 1, 0)
-    out_c = separate(coronal, hnet_c, device, "c").permute(1, 3, 0, 2)
-    out_a = separate(transverse, hnet_a, device, "a").permute(1, 3, 2, 0)
+def hemisphere(voxel, hnet_c, hnet_a, device, batch=None, skip_empty=False):
+    volume = as_volume(voxel)
+    out_c = separate(volume.stack("coronal"), hnet_c, device, "c", batch, skip_empty).permute(1, 3, 0, 2)
+    out_a = separate(volume.stack("axial"), hnet_a, device, "a", batch, skip_empty).permute(1, 3, 2, 0)
     out_e = out_c + out_a
     out_e = torch.argmax(out_e, 0).cpu().numpy()
     torch.cuda.empty_cache()
 
     # Maskeleri oluştur
-    dilated_mask_1 = binary_dilation(out_e == 1, iterations=5).astype("int16")
+    dilated_mask_1 = dilate_cross(out_e == 1, 5).astype("int16")
     dilated_mask_1[out_e == 2] = 2
     dilated_mask_2 = (
-        binary_dilation(dilated_mask_1 == 2, iterations=5).astype("int16") * 2
+        dilate_cross(dilated_mask_1 == 2, 5).astype("int16") * 2
     )
     dilated_mask_2[dilated_mask_1 == 1] = 1
     return dilated_mask_2
@@ -0,0 +1,172 @@
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from utils.trace import span
+
+# Approximate peak activation memory of one UNet slice per input pixel, in bytes.
+# The full-resolution decoder level keeps ~400 float32 feature maps alive.
+BYTES_PER_PIXEL = 2048
+MEMORY_BUDGET = 2 * 1024**3
+MAX_BATCH = 64
+
+_local = threading.local()
+
+
+@contextmanager
+def memory_share(parts):
+    """Give `batch_size()` calls on this thread 1/`parts` of the default budget."""
+    previous = getattr(_local, "parts", 1)
+    _local.parts = parts
+    try:
+        yield
+    finally:
+        _local.parts = previous
+
+
+class SkipCounter:
+    """Slices `infer()` was given and skipped as background with `skip_empty`,
+    on the threads counting into it (see `counting()`)."""
+
+    def __init__(self):
+        self.slices = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def add(self, slices, skipped):
+        with self._lock:
+            self.slices += slices
+            self.skipped += skipped
+
+
+@contextmanager
+def counting(counter):
+    """Make the `infer()` calls of this thread count into `counter` (a `SkipCounter` or None)."""
+    previous = skip_counter()
+    _local.counter = counter
+    try:
+        yield counter
+    finally:
+        _local.counter = previous
+
+
+def skip_counter():
+    return getattr(_local, "counter", None)
+
+
+def batch_size(shape, device, budget=None):
+    """Largest slice batch whose activations fit in the memory budget."""
+    if budget is None:
+        budget = MEMORY_BUDGET
+        if torch.device(device).type == "cuda":
+            free, _ = torch.cuda.mem_get_info(torch.device(device))
+            budget = free // 2
+        budget //= getattr(_local, "parts", 1)
+    per_slice = shape[-2] * shape[-1] * BYTES_PER_PIXEL
+    return int(max(1, min(MAX_BATCH, budget // per_slice)))
+
+
+class SliceWindows:
+    """Stack of (2 * context + 1)-channel windows around each slice of `voxel`.
+
+    `voxel` is padded with `context` background planes on both ends, unless
+    it already is (`padded`). Indexing returns a strided view of the padded
+    stack, with no copy.
+    """
+
+    def __init__(self, voxel, context=1, padded=False):
+        self.context = context
+        if not padded:
+            voxel = np.pad(
+                voxel,
+                [(context, context), (0, 0), (0, 0)],
+                "constant",
+                constant_values=voxel.min(),
+            )
+        self.voxel = voxel
+        width = 2 * context + 1
+        self.shape = (len(voxel) - 2 * context, width) + voxel.shape[1:]
+        self.windows = np.lib.stride_tricks.as_strided(
+            voxel, self.shape, (voxel.strides[0],) + voxel.strides
+        )
+
+    def __len__(self):
+        return self.shape[0]
+
+    def occupied(self):
+        """Per-window flags: False where every slice of the window is background."""
+        flags = (self.voxel != self.voxel.min()).reshape(len(self.voxel), -1).any(axis=1)
+        width = 2 * self.context + 1
+        return np.lib.stride_tricks.sliding_window_view(flags, width).any(axis=1)
+
+    def __getitem__(self, index):
+        return self.windows[index]
+
+
+def occupied(voxel):
+    """Per-slice flags of a (N, ...) stack: False where a slice is all background.
+
+    The background is the stack's minimum, which is what `normalize()` maps
+    the zeros around the stripped brain to.
+    """
+    if isinstance(voxel, SliceWindows):
+        return voxel.occupied()
+    voxel = np.asarray(voxel)
+    return (voxel != voxel.min()).reshape(len(voxel), -1).any(axis=1)
+
+
+def infer(voxel, model, device, activation, output, batch=None, accumulate=False, skip_empty=False):
+    """Run `model` over a stack of slices, `batch` slices per forward pass.
+
+    `voxel` is a (N, H, W) or (N, C, H, W) array (or `SliceWindows`) and the
+    activated predictions are written into the preallocated `output[:N]`,
+    or added to it when `accumulate` is set.
+
+    With `skip_empty`, only the range of slices that contain foreground goes
+    through the network; the all-background slices outside it all get the
+    prediction of a single background slice. They are counted in this
+    thread's `SkipCounter`, if any.
+    """
+    if batch is None or batch <= 0:
+        batch = batch_size(voxel.shape, device)
+    first, last = 0, len(voxel)
+    if skip_empty:
+        index = np.flatnonzero(occupied(voxel))
+        first, last = (int(index[0]), int(index[-1]) + 1) if len(index) else (0, 0)
+
+    def predict(start, stop):
+        # Contiguous float32 stacks and SliceWindows are passed on as views.
+        image = np.asarray(voxel[start:stop], dtype=np.float32)
+        if image.ndim == 3:
+            image = image[:, None]
+        image = torch.from_numpy(image).to(device)
+        with span("forward", batch=stop - start, shape=list(image.shape)):
+            return activation(model(image)).detach()
+
+    def store(start, stop, x_out):
+        x_out = x_out.reshape((-1,) + tuple(output.shape[1:])).expand(output[start:stop].shape)
+        if accumulate:
+            output[start:stop] += x_out.to(output.device, output.dtype)
+        else:
+            output[start:stop] = x_out
+
+    model.eval()
+    with torch.inference_mode():
+        for start in range(first, last, batch):
+            stop = min(start + batch, last)
+            store(start, stop, predict(start, stop))
+        skipped = len(voxel) - (last - first)
+        counter = skip_counter()
+        if skip_empty and counter is not None:
+            counter.add(len(voxel), skipped)
+        if skip_empty:
+            # Recorded when nothing is skipped too, so the slices count every one.
+            with span("skip_empty", slices=len(voxel), skipped_slices=skipped):
+                if skipped:
+                    empty = 0 if first > 0 else last
+                    background = predict(empty, empty + 1)
+                    store(0, first, background)
+                    store(last, len(voxel), background)
+    return output
@@ -1,43 +1,192 @@
 import os
+import threading
+from collections import OrderedDict
 
 import torch
+import torch.nn as nn
 
+from utils.backend import BACKENDS, OnnxModel, onnx_path
 from utils.network import UNet
+from utils.quantize import build_quantized, load_report
+
+# name -> (checkpoint path inside the model folder, input channels, output channels)
+MODELS = {
+    "cnet": ("CNet/CNet.pth", 1, 1),
+    "ssnet": ("SSNet/SSNet.pth", 1, 1),
+    "pnet_c": ("PNet/coronal.pth", 3, 142),
+    "pnet_s": ("PNet/sagittal.pth", 3, 142),
+    "pnet_a": ("PNet/axial.pth", 3, 142),
+    "hnet_c": ("HNet/coronal.pth", 1, 3),
+    "hnet_a": ("HNet/axial.pth", 1, 3),
+}
+
+COMPILE_MODES = ("none", "torchscript", "inductor")
+
+
+def load_state(path):
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+
+def load_weights(model, path):
+    """Load the checkpoint at `path` into `model`.
+
+    The checkpoint's tensors become the parameters instead of being copied
+    into the freshly initialised ones. They are not what stays resident:
+    `optimize_model()` makes new inference weights from them when it folds
+    BatchNorm and converts to channels-last.
+    """
+    state = load_state(path)
+    try:
+        model.load_state_dict(state, assign=True)
+    except TypeError:
+        # torch < 2.1 has no `assign`.
+        model.load_state_dict(state)
+    return model
+
+
+class ChannelsLast(nn.Module):
+    """Feeds a channels-last network inputs in the same memory format."""
+
+    def __init__(self, model):
+        super(ChannelsLast, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+def optimize_model(model, compile="none"):
+    """Inference-only form of a loaded UNet.
+
+    BatchNorm is folded into the convolutions and the weights are stored
+    channels-last; `compile` optionally scripts the network with TorchScript
+    or compiles it with torch.compile ("inductor").
+    """
+    model.fuse()
+    model.to(memory_format=torch.channels_last)
+    if compile == "torchscript":
+        model = torch.jit.script(model)
+    elif compile == "inductor":
+        model = torch.compile(model)
+    elif compile != "none":
+        raise ValueError(f"unknown compile mode {compile!r}, expected one of {COMPILE_MODES}")
+    return ChannelsLast(model).eval()
+
+
+def build_model(path, ch_in, ch_out, device, compile="none"):
+    model = load_weights(UNet(ch_in, ch_out), path)
+    model.to(device)
+    return optimize_model(model, compile)
+
+
+def model_bytes(model):
+    if isinstance(model, OnnxModel):
+        return model.nbytes
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelRegistry:
+    """Networks of one model folder, loaded on first use and kept resident.
+
+    When `max_bytes` is set, the least recently used networks are released
+    once the resident weights exceed it; the network just requested is
+    always kept. Networks are prepared for inference by `optimize_model`,
+    or loaded from `int8_folder` (see utils/calibrate.py) when it is given.
+    With the "onnxruntime" backend they are ONNX Runtime sessions of the
+    files utils/export_onnx.py wrote to `onnx_folder` (default
+    `{model_folder}/ONNX`).
+    """
+
+    def __init__(self, model_folder, device, max_bytes=None, compile="none", int8_folder=None,
+                 backend="torch", onnx_folder=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"unknown backend {backend!r}, expected one of {BACKENDS}")
+        self.model_folder = model_folder
+        self.device = device
+        self.max_bytes = max_bytes
+        self.compile = compile
+        self.int8_folder = int8_folder
+        self.int8_report = None
+        self.backend = backend
+        self.onnx_folder = onnx_folder or os.path.join(model_folder, "ONNX")
+        if int8_folder is not None and backend != "torch":
+            raise ValueError("INT8 networks run on the torch backend")
+        if (int8_folder is not None or backend == "onnxruntime") and torch.device(device).type != "cpu":
+            raise ValueError(f"{'INT8 networks' if int8_folder else 'ONNX Runtime networks'} only run on the CPU")
+        if int8_folder is not None:
+            self.int8_report = load_report(int8_folder)
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, name):
+        return name in self._models
+
+    def get(self, name):
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name]
+            path, ch_in, ch_out = MODELS[name]
+            if self.backend == "onnxruntime":
+                model = OnnxModel(onnx_path(self.onnx_folder, path), torch.get_num_threads())
+            elif self.int8_folder is not None:
+                model = build_quantized(
+                    os.path.join(self.int8_folder, path), ch_in, ch_out, self.int8_report["backend"]
+                )
+            else:
+                model = build_model(
+                    os.path.join(self.model_folder, path), ch_in, ch_out, self.device, self.compile
+                )
+            self._models[name] = model
+            self._evict()
+            return model
+
+    def nbytes(self):
+        return sum(model_bytes(model) for model in self._models.values())
+
+    def _evict(self):
+        if not self.max_bytes:
+            return
+        evicted = False
+        while len(self._models) > 1 and self.nbytes() > self.max_bytes:
+            self._models.popitem(last=False)
+            evicted = True
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(model_folder, device, max_bytes=None, compile="none", int8_folder=None,
+                 backend="torch", onnx_folder=None):
+    """Process-wide registry for `model_folder` on `device`, shared across runs."""
+    folders = [os.path.realpath(f) if f else None for f in (model_folder, int8_folder, onnx_folder)]
+    key = (*folders, str(device), compile, backend)
+    with _registries_lock:
+        registry = _registries.get(key)
+        if registry is None:
+            registry = _registries[key] = ModelRegistry(
+                model_folder, device, max_bytes, compile, int8_folder, backend, onnx_folder
+            )
+        elif registry.max_bytes != max_bytes:
+            with registry._lock:
+                registry.max_bytes = max_bytes
+                registry._evict()
+        return registry
 
 
 def load_model(opt, device):
-    cnet = UNet(1, 1)
-    cnet.load_state_dict(torch.load(os.path.join(opt.m, "CNet/CNet.pth"), weights_only=True))
-    cnet.to(device)
-    cnet.eval()
-
-    ssnet = UNet(1, 1)
-    ssnet.load_state_dict(torch.load(os.path.join(opt.m, "SSNet/SSNet.pth"), weights_only=True))
-    ssnet.to(device)
-    ssnet.eval()
-
-    pnet_c = UNet(3, 142)
-    pnet_c.load_state_dict(torch.load(os.path.join(opt.m, "PNet/coronal.pth"), weights_only=True))
-    pnet_c.to(device)
-    pnet_c.eval()
-
-    pnet_s = UNet(3, 142)
-    pnet_s.load_state_dict(torch.load(os.path.join(opt.m, "PNet/sagittal.pth"), weights_only=True))
-    pnet_s.to(device)
-    pnet_s.eval()
-
-    pnet_a = UNet(3, 142)
-    pnet_a.load_state_dict(torch.load(os.path.join(opt.m, "PNet/axial.pth"), weights_only=True))
-    pnet_a.to(device)
-    pnet_a.eval()
-
-    hnet_c = UNet(1, 3)
-    hnet_c.load_state_dict(torch.load(os.path.join(opt.m, "HNet/coronal.pth"), weights_only=True))
-    hnet_c.to(device)
-    hnet_c.eval()
-
-    hnet_a = UNet(1, 3)
-    hnet_a.load_state_dict(torch.load(os.path.join(opt.m, "HNet/axial.pth"), weights_only=True))
-    hnet_a.to(device)
-    hnet_a.eval()
-    return cnet, ssnet, pnet_c, pnet_s, pnet_a, hnet_c, hnet_a
+    """Registry of the networks `opt` asks for; each one is loaded on its first `get()`."""
+    return get_registry(
+        opt.m, device, opt.model_memory * 1024**2, opt.compile, opt.int8_models, opt.backend, opt.onnx_models
+    )
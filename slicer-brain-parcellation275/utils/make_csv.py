@@ -1,19 +1,77 @@
 import numpy as np
 import pandas as pd
 import os
+from functools import lru_cache
 
-def make_csv(parcellation, save):
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-
-    csv_path = os.path.join(script_dir, "..", "level" , "Level5.txt")
-    df = (
-        pd.read_table(csv_path, names=["number", "region"])
-        .astype("str")
-        .set_index("number")
-    )
-    for i in range(280):
-        i += 1
-        volume = np.count_nonzero(parcellation == i)
-        df.loc[str(i), save] = volume
-    df = df.set_index("region").T.reset_index().rename(columns={"index": "uid"})
+from utils.outputs import tmp_path
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+level_path = os.path.join(script_dir, "..", "level", "Level5.txt")
+
+
+@lru_cache(maxsize=None)
+def load_regions(path=level_path):
+    """Label numbers and region names of Level5.txt, parsed once per process."""
+    table = pd.read_table(path, names=["number", "region"])
+    return tuple(table["number"].astype(int)), tuple(table["region"].astype(str))
+
+
+def count_regions(parcellation, labels=280):
+    """Voxel count of every label 0..labels in a single pass over the volume."""
+    return np.bincount(np.ravel(parcellation), minlength=labels + 1)
+
+
+def region_table(counts, save, zooms=None):
+    """One-row table of region volumes for subject `save`, from `count_regions()`.
+
+    Volumes are voxel counts, or mm^3 when the voxel spacing `zooms` is given.
+    """
+    numbers, regions = load_regions()
+    counts = np.pad(counts, (0, max(0, max(numbers) + 1 - len(counts))))
+    volumes = counts[list(numbers)].astype("float64")
+    if zooms is not None:
+        volumes *= float(np.prod(zooms[:3]))
+    df = pd.DataFrame([volumes], columns=pd.Index(regions, name="region"))
+    df.insert(0, "uid", save)
     return df
+
+
+def make_csv(parcellation, save, zooms=None):
+    """One-row table of region volumes for subject `save`; see `region_table()`."""
+    return region_table(count_regions(parcellation, max(load_regions()[0])), save, zooms)
+
+
+def append_csv(df, path):
+    """Append subject rows to a cohort-wide table, writing the header once."""
+    header = not os.path.exists(path) or os.path.getsize(path) == 0
+    df.to_csv(path, mode="a", header=header, index=False)
+
+
+def write_rows(df, path):
+    """Add subject rows to a cohort-wide table, in place of rows the subjects already have.
+
+    Appends unless one of them is in the table already, e.g. after a run
+    stopped between writing a subject's row and marking it complete.
+    """
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        uids = pd.read_csv(path, usecols=["uid"], dtype={"uid": str})["uid"]
+        if uids.isin(df["uid"].astype(str)).any():
+            replace_rows(df, path)
+            return
+    append_csv(df, path)
+
+
+def replace_rows(df, path):
+    """Put the rows of `df` in the cohort-wide table in place of earlier rows of the same subjects.
+
+    The table is rewritten under a temporary name with the columns of `df`,
+    so rows written under an older Level5.txt do not keep a stale header.
+    """
+    table = df
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        old = pd.read_csv(path, dtype={"uid": str})
+        old = old[~old["uid"].isin(df["uid"].astype(str))]
+        table = pd.concat([old, df], ignore_index=True).reindex(columns=df.columns)
+    tmp = tmp_path(path)
+    table.to_csv(tmp, index=False)
+    os.replace(tmp, path)
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+from functools import lru_cache
+
+from utils.backend import onnx_path
+from utils.load_model import MODELS
+from utils.make_csv import level_path
+from utils.n4_cache import file_hash
+from utils.preprocessing import N4_PARAMS
+
+# Bump when a code change alters the label maps, to segment every subject again.
+VERSION = 1
+
+# Stage -> options its outputs depend on. The fingerprints of the later
+# stages also cover the label map's, so a stale label map makes them stale too.
+# Options that only change how outputs are written (--input-copy,
+# --label-format) or how fast the networks run (--compile, batch size,
+# --no-skip-empty, ...) are left out; a label map missing in the current
+# --label-format is caught by `Fingerprints.stale()` instead. Skipped
+# background slices get the prediction of one identical background slice,
+# which differs from running them at most as much as a change of batch size.
+OPTIONS = {
+    "labels": ("crop_resolution", "parcellation_dtype", "backend"),
+    "make_csv": ("volume_unit", "cohort_csv"),
+    "region_stats": ("region_stats",),
+}
+STAGES = tuple(OPTIONS)
+
+
+@lru_cache(maxsize=None)
+def _hash(path, size, mtime_ns):
+    return file_hash(path)
+
+
+def cached_hash(path):
+    """sha256 of a file, read again only when its size or mtime changed; None if missing."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return _hash(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def model_files(opt):
+    """Files the networks of a run are loaded from, as ModelRegistry picks them."""
+    files = []
+    for path, _, _ in MODELS.values():
+        if opt.backend == "onnxruntime":
+            files.append(onnx_path(opt.onnx_models or os.path.join(opt.m, "ONNX"), path))
+        elif opt.int8_models:
+            files.append(os.path.join(opt.int8_models, path))
+        else:
+            files.append(os.path.join(opt.m, path))
+    if opt.int8_models:
+        files.append(os.path.join(opt.int8_models, "quantization.json"))
+    return files
+
+
+class Fingerprints:
+    """Per-stage fingerprints of the inputs, networks and options of a run.
+
+    A subject's manifest (its completion marker) records them when it is
+    written; `stale()` compares a manifest with the current run. Inputs are
+    only hashed again when their size or mtime changed since the manifest
+    was written, and the networks once per process.
+    """
+
+    def __init__(self, opt):
+        self.opt = opt
+        self._models = None
+
+    def models(self):
+        if self._models is None:
+            self._models = digest([(os.path.basename(os.path.dirname(f)), os.path.basename(f), cached_hash(f)) for f in model_files(self.opt)])
+        return self._models
+
+    def input(self, path, manifest=None):
+        stat = os.stat(path)
+        if manifest and manifest.get("input_size") == stat.st_size and manifest.get("input_mtime_ns") == stat.st_mtime_ns:
+            return manifest["input_hash"]
+        return file_hash(path)
+
+    def stages(self, input_hash):
+        options = {stage: {name: getattr(self.opt, name) for name in names} for stage, names in OPTIONS.items()}
+        labels = digest({"version": VERSION, "input": input_hash, "models": self.models(), "n4": N4_PARAMS, **options["labels"]})
+        regions = cached_hash(level_path)
+        table = digest({"labels": labels, "regions": regions, **options["make_csv"]})
+        # No fingerprint while the statistics are off, so turning them off reruns nothing.
+        stats = None
+        if self.opt.region_stats != "none":
+            stats = digest({"labels": labels, "regions": regions, **options["region_stats"]})
+        return {"labels": labels, "make_csv": table, "region_stats": stats}
+
+    def manifest(self, path, counts, zooms, previous=None):
+        """Manifest of a subject just written from `path`, with make_csv's label `counts`."""
+        stat = os.stat(path)
+        input_hash = self.input(path, previous)
+        return {
+            "input_hash": input_hash,
+            "input_size": stat.st_size,
+            "input_mtime_ns": stat.st_mtime_ns,
+            "fingerprints": self.stages(input_hash),
+            "counts": [int(c) for c in counts],
+            "zooms": [float(z) for z in zooms[:3]],
+        }
+
+    def stale(self, path, manifest, output_dir, save):
+        """Stages whose outputs are out of date, in order; None for a manifest without fingerprints.
+
+        A stage is also stale when its output file is gone. Region statistics
+        only count while they are turned on.
+        """
+        if not manifest or "fingerprints" not in manifest:
+            return None
+        current = self.stages(self.input(path, manifest))
+        stale = {stage for stage in STAGES if current[stage] is not None and manifest["fingerprints"].get(stage) != current[stage]}
+        if not os.path.exists(os.path.join(output_dir, f"{save}_280{self.opt.label_format}")):
+            stale |= {stage for stage in STAGES if current[stage] is not None}
+        if not self.opt.cohort_csv and not os.path.exists(os.path.join(output_dir, f"{save}_volume.csv")):
+            stale.add("make_csv")
+        if current["region_stats"] is not None and not os.path.exists(
+            os.path.join(output_dir, f"{save}_stats.{self.opt.region_stats}")
+        ):
+            stale.add("region_stats")
+        return [stage for stage in STAGES if stage in stale]
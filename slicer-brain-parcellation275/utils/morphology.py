@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from scipy.ndimage import binary_closing, distance_transform_cdt
+
+
+def bounding_box(mask, margin=0):
+    """Slices of the smallest box around the True voxels, grown by `margin` and clipped."""
+    box = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        index = np.flatnonzero(mask.any(axis=other))
+        if not len(index):
+            return None
+        box.append(slice(max(index[0] - margin, 0), min(index[-1] + 1 + margin, mask.shape[axis])))
+    return tuple(box)
+
+
+def by_slabs(fn, mask, halo, workers=None):
+    """Apply `fn` to the bounding box of `mask`, in slabs along axis 0 on a thread pool.
+
+    `fn` must be local: each output voxel may only depend on input voxels
+    within `halo` of it, and voxels outside the volume must count as
+    background. Each slab is then processed with `halo` extra planes on both
+    sides and only its own planes are kept, which makes the result identical
+    to `fn(mask)`. scipy.ndimage releases the GIL, so slabs run in parallel.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    out = np.zeros(mask.shape, dtype=bool)
+    box = bounding_box(mask, halo)
+    if box is None:
+        return out
+    region = mask[box]
+    workers = workers or torch.get_num_threads()
+    bounds = np.linspace(0, len(region), min(workers, max(1, len(region) // (4 * halo + 1))) + 1).astype(int)
+
+    def run(start, stop):
+        lo, hi = max(start - halo, 0), min(stop + halo, len(region))
+        return fn(region[lo:hi])[start - lo : stop - lo]
+
+    if len(bounds) == 2:
+        out[box] = fn(region)
+        return out
+    with ThreadPoolExecutor(len(bounds) - 1) as pool:
+        slabs = list(pool.map(run, bounds[:-1], bounds[1:]))
+    out[box] = np.concatenate(slabs)
+    return out
+
+
+def dilate_cross(mask, iterations, workers=None):
+    """binary_dilation(mask, iterations=n) with the default 6-connected structure.
+
+    n dilations by the cross reach exactly the voxels within taxicab
+    distance n, so one chamfer distance transform replaces the n passes.
+    """
+    def dilate(region):
+        if not region.any():
+            # No feature voxel: the transform would be -1 everywhere.
+            return np.zeros_like(region)
+        return distance_transform_cdt(~region, metric="taxicab") <= iterations
+
+    return by_slabs(dilate, mask, iterations, workers)
+
+
+def close_cube(mask, iterations, workers=None):
+    """binary_closing(mask, structure=ones((3, 3, 3)), iterations=n), restricted to the mask."""
+    selem = np.ones((3, 3, 3), dtype="bool")
+
+    def close(region):
+        return binary_closing(region, structure=selem, iterations=iterations)
+
+    return by_slabs(close, mask, 2 * iterations, workers)
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+
+from utils.outputs import tmp_path
+
+
+def file_hash(path, chunk=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class N4Cache:
+    """On-disk cache of N4-corrected volumes keyed by input file and N4 parameters.
+
+    Entries are the .nii files N4 would have written, so a hit is read back
+    with nibabel alone. Reading an entry refreshes its mtime; once the folder
+    grows past `max_bytes`, the least recently used entries are deleted.
+    """
+
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+
+    def key(self, path, params):
+        params = dict(params, simpleitk=sitk.Version_VersionString())
+        digest = hashlib.sha256(file_hash(path).encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.nii")
+
+    def get(self, key):
+        """Cached volume as an in-memory nibabel image, or None on a miss."""
+        path = self.path(key)
+        try:
+            image = self._read(path)
+            os.utime(path)
+        except (OSError, EOFError, ValueError, nib.filebasedimages.ImageFileError, nib.spatialimages.HeaderDataError):
+            # Missing, or cut short (e.g. copied in part); put() replaces it.
+            self.misses += 1
+            return None
+        self.hits += 1
+        return image
+
+    def put(self, key, sitk_image):
+        """Store `sitk_image` under `key` and return it as `get()` will.
+
+        The entry is read back rather than converted in memory, so the run
+        that computes a volume sees the same affine and voxels as every
+        later run that finds it here.
+        """
+        path = self.path(key)
+        tmp = tmp_path(os.path.join(self.root, key), ".tmp.nii")
+        sitk.WriteImage(sitk_image, tmp)
+        image = self._read(tmp)
+        os.replace(tmp, path)
+        self.evict()
+        return image
+
+    def _read(self, path):
+        # Read in full here, so a truncated entry fails now and not in N4's caller.
+        image = nib.load(path, mmap=False)
+        return nib.Nifti1Image(np.asanyarray(image.dataobj), image.affine, image.header)
+
+    def evict(self):
+        if not self.max_bytes:
+            return
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".nii") or ".tmp." in name:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -2,6 +2,7 @@ from typing import List
 
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class ConvBlock(nn.Module):
@@ -24,6 +25,15 @@ class ConvBlock(nn.Module):
         h = self.relu(self.batchnorm2(self.conv2(h)))
         return h
 
+    def fuse(self):
+        """Fold the BatchNorm layers into the convolutions; eval mode only."""
+        if isinstance(self.batchnorm1, nn.BatchNorm2d):
+            self.conv1 = fuse_conv_bn_eval(self.conv1, self.batchnorm1)
+            self.conv2 = fuse_conv_bn_eval(self.conv2, self.batchnorm2)
+            self.batchnorm1 = nn.Identity()
+            self.batchnorm2 = nn.Identity()
+        return self
+
 
 class EncodeBlock(nn.Module):
     def __init__(self, ch_in, ch_out):
@@ -83,6 +93,18 @@ class UNet(nn.Module):
     def make_upblock(self, ch_in, ch_out):
         return DecodeBlock(ch_in=ch_in, ch_out=ch_out)
 
+    def fuse(self):
+        """Fold every ConvBlock's BatchNorm into its convolutions.
+
+        The fused network has no BatchNorm parameters, so load checkpoints
+        before fusing.
+        """
+        self.eval()
+        for module in self.modules():
+            if isinstance(module, ConvBlock):
+                module.fuse()
+        return self
+
     def forward(self, x):
         x = self.econv0(x)
         x, skip1 = self.econv1(x)
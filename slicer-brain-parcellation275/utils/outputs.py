@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import socket
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import torch
+
+try:
+    import pyzstd
+except ImportError:
+    pyzstd = None
+
+# What `{save}.nii` in the output folder is:
+#   float32   the input reoriented to RAS and decoded to float32 (the default),
+#   native    a byte-for-byte copy of the input file, in its own dtype,
+#   symlink   a symbolic link to the input,
+#   hardlink  a hard link to the input, or a native copy across filesystems,
+#   reference no image; `{save}.input.json` records where the input is.
+INPUT_COPIES = ("float32", "native", "symlink", "hardlink", "reference")
+
+# File formats of the label map, `{save}_280{format}`. ".nii.zst" needs the
+# pyzstd package to write and nibabel needs it to read; 3D Slicer cannot
+# load it.
+LABEL_FORMATS = (".nii", ".nii.gz", ".nii.zst")
+
+# Input size per compressed block; blocks are compressed in parallel.
+BLOCK_BYTES = 4 * 1024**2
+
+
+def tmp_path(path, suffix=".tmp"):
+    """Temporary name to write `path` under before renaming it into place.
+
+    Unique to this host and process: nodes sharing a cohort (--queue) can
+    end up writing the same subject, and must not write into one file.
+    """
+    return f"{path}.{socket.gethostname()}.{os.getpid()}{suffix}"
+
+
+def copy_input(path, image, output_dir, save, mode="float32"):
+    """Put the input next to the outputs as `{save}.nii`, as `mode` says.
+
+    `image` is the squeezed input with its voxels already decoded to
+    float32, which only the "float32" copy needs.
+    """
+    target = os.path.join(output_dir, f"{save}.nii")
+    if mode not in INPUT_COPIES:
+        raise ValueError(f"unknown input copy {mode!r}, expected one of {INPUT_COPIES}")
+    if mode == "reference":
+        info = os.stat(path)
+        reference = {"input": os.path.abspath(path), "size": info.st_size, "mtime": info.st_mtime}
+        atomic_write(os.path.join(output_dir, f"{save}.input.json"), json.dumps(reference).encode())
+        return
+    tmp = tmp_path(os.path.join(output_dir, save), ".tmp.nii")
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    if mode == "float32":
+        odata = nib.as_closest_canonical(image)
+        nib.save(nib.Nifti1Image(np.asanyarray(odata.dataobj), affine=odata.affine), tmp)
+    elif mode == "symlink":
+        os.symlink(os.path.abspath(path), tmp)
+    elif mode == "hardlink":
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp)
+    else:
+        shutil.copyfile(path, tmp)
+    os.replace(tmp, target)
+
+
+def gzip_compress(data, threads=None, level=6):
+    """gzip `data` in BLOCK_BYTES blocks on `threads` threads.
+
+    Each block is its own gzip member; zlib releases the GIL while it
+    compresses. Readers decompress concatenated members as one stream, as
+    the gzip format specifies (nibabel, zlib's gzread and so ITK and
+    3D Slicer all do).
+    """
+    view = memoryview(data)
+    blocks = [view[start : start + BLOCK_BYTES] for start in range(0, len(view), BLOCK_BYTES)]
+
+    def compress(block):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    with ThreadPoolExecutor(threads or torch.get_num_threads()) as pool:
+        return b"".join(pool.map(compress, blocks))
+
+
+def zstd_compress(data, threads=None, level=3):
+    """zstd-compress `data` with `threads` compression workers."""
+    if pyzstd is None:
+        raise ImportError(".nii.zst label maps need the pyzstd package")
+    option = {
+        pyzstd.CParameter.compressionLevel: level,
+        pyzstd.CParameter.nbWorkers: threads or torch.get_num_threads(),
+    }
+    return pyzstd.compress(data, option)
+
+
+def atomic_write(path, data):
+    # Written under a temporary name so an interrupted run never leaves a
+    # truncated file that looks complete.
+    tmp = tmp_path(path)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def save_nifti(image, path, threads=None):
+    """Save `image` to `path`, compressed in parallel for .nii.gz and .nii.zst."""
+    if path.endswith(".nii"):
+        data = image.to_bytes()
+    elif path.endswith(".nii.gz"):
+        data = gzip_compress(image.to_bytes(), threads)
+    elif path.endswith(".nii.zst"):
+        data = zstd_compress(image.to_bytes(), threads)
+    else:
+        raise ValueError(f"unknown label map format of {path}, expected one of {LABEL_FORMATS}")
+    atomic_write(path, data)
@@ -1,68 +1,44 @@
-import numpy as np
-import torch
-
-from utils.functions import normalize
-
-def parcellate(voxel, model, device, mode):
-    if mode == "c":
-        stack = (224, 192, 192)
-    elif mode == "s":
-        stack = (192, 224, 192)
-    elif mode == "a":
-        stack = (192, 224, 192)
-    model.eval()
-
-    voxel = np.pad(
-        voxel, [(1, 1), (0, 0), (0, 0)], "constant", constant_values=voxel.min()
-    )
-
-    with torch.inference_mode():
-        box = torch.zeros(stack[0], 142, stack[1], stack[2])
-
-        for i in range(stack[0]):
-            i += 1
+from functools import partial
 
-            image = np.stack([voxel[i - 1], voxel[i], voxel[i + 1]])
-
-            image = torch.tensor(image.reshape(1, 3, stack[1], stack[2]))
+import torch
 
-            image = image.to(device)
+from utils.inference import SliceWindows, infer
+from utils.volume import as_volume
 
-            x_out = torch.softmax(model(image), 1).detach().cpu()
+# Output channels of the PNets.
+CLASSES = 142
 
-            if i == 1:
-                box[0] = x_out
-            else:
-                box[i - 1] = x_out
+def parcellate(voxel, model, device, mode, batch=None, box=None, skip_empty=False):
+    # `mode` ("c", "s" or "a") only names the view; the stack's shape comes from `voxel`.
+    windows = voxel if isinstance(voxel, SliceWindows) else SliceWindows(voxel, context=1)
+    softmax = partial(torch.softmax, dim=1)
+    if box is None:
+        box = torch.zeros(len(windows), CLASSES, *windows.shape[2:])
+        return infer(windows, model, device, softmax, box, batch, skip_empty=skip_empty)
+    # Streaming mode: add this view's softmax into the shared accumulator.
+    return infer(windows, model, device, softmax, box, batch, accumulate=True, skip_empty=skip_empty)
 
-        return box.reshape(stack[0], 142, stack[1], stack[2])
+def parcellation(voxel, pnet_c, pnet_s, pnet_a, device, batch=None, dtype=torch.float32, skip_empty=False):
+    # `voxel` is the stripped brain, or the `Volume` hemisphere() shares.
+    volume = as_volume(voxel)
 
-def parcellation(voxel, pnet_c, pnet_s, pnet_a, device):
-    voxel = normalize(voxel)
-    coronal = voxel.transpose(1, 2, 0)
-    sagittal = voxel
-    axial = voxel.transpose(2, 1, 0)
+    # A single (142, 192, 224, 192) probability volume shared by the three views.
+    # Each view writes through a permuted view of it, so the summation order
+    # (coronal + sagittal) + axial matches the per-view boxes in float32.
+    out_e = torch.zeros(CLASSES, *volume.shape, dtype=dtype)
 
-    out_c = parcellate(coronal, pnet_c, device, "c").permute(1, 3, 0, 2)
+    parcellate(volume.windows("coronal"), pnet_c, device, "c", batch, out_e.permute(2, 0, 3, 1), skip_empty)
 
     torch.cuda.empty_cache()
 
-    out_s = parcellate(sagittal, pnet_s, device, "s").permute(1, 0, 2, 3)
+    parcellate(volume.windows("sagittal"), pnet_s, device, "s", batch, out_e.permute(1, 0, 2, 3), skip_empty)
 
     torch.cuda.empty_cache()
 
-    out_e = out_c + out_s
-
-    del out_c, out_s
-
-    out_a = parcellate(axial, pnet_a, device, "a").permute(1, 3, 2, 0)
+    parcellate(volume.windows("axial"), pnet_a, device, "a", batch, out_e.permute(3, 0, 2, 1), skip_empty)
 
     torch.cuda.empty_cache()
 
-    out_e = out_e + out_a
-
-    del out_a
-
     parcellated = torch.argmax(out_e, 0).numpy()
 
     return parcellated
@@ -0,0 +1,405 @@
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+import torch
+
+from utils.cropping import cropping
+from utils.hemisphere import hemisphere
+from utils.inference import SkipCounter, counting
+from utils.make_csv import count_regions, region_table, replace_rows, write_rows
+from utils.manifest import Fingerprints
+from utils.parcellation import parcellation
+from utils.postprocessing import postprocessing
+from utils.scheduler import Stage, run_stages
+from utils.n4_cache import N4Cache
+from utils.outputs import LABEL_FORMATS, copy_input, save_nifti, tmp_path
+from utils.preprocessing import N4_PARAMS, bias_corrected, preprocessing
+from utils.region_stats import region_stats, stats_path, stats_table, write_stats
+from utils.resample import to_native
+from utils.stripping import stripping
+from utils.trace import Tracer, activate, span, summarize
+from utils.volume import Volume
+
+_csv_lock = threading.Lock()
+
+COMPLETE_MARKER = ".complete"
+# Manifest stages `refresh_tables()` brings up to date without segmenting again.
+TABLES = ("make_csv", "region_stats")
+
+# The stages each subject goes through and the stages whose results each one
+# takes. Preprocessing runs ahead in `prepare()` and write behind in
+# `write()`; `segment()` schedules the stages in between, running those
+# whose inputs are ready at the same time concurrently. Listed in an order
+# that respects the dependencies, which is the order `on_stage` reports.
+REQUIRES = {
+    "preprocessing": (),
+    "cropping": ("preprocessing",),
+    "stripping": ("cropping", "preprocessing"),
+    "parcellation": ("stripping",),
+    "hemisphere": ("stripping",),
+    "postprocessing": ("parcellation", "hemisphere"),
+    "write": ("postprocessing", "stripping", "preprocessing"),
+}
+STAGES = tuple(REQUIRES)
+
+
+class Cancelled(Exception):
+    """Raised by an `on_stage` callback to stop a run between two stages."""
+
+
+def find_inputs(input_root):
+    return sorted(glob.glob(os.path.join(input_root, "**/*.nii"), recursive=True))
+
+
+def subject(path, output_root):
+    save = os.path.splitext(os.path.basename(path))[0]
+    return save, os.path.join(output_root, save)
+
+
+def is_complete(output_dir, save, path=None, fingerprints=None):
+    """A subject is done once marked, or when both of its outputs exist.
+
+    With `fingerprints`, a marked subject is not done when its label map is
+    out of date for the input `path`; see `Fingerprints.stale()`. Stale
+    tables alone are left to `refresh_tables()`.
+    """
+    if os.path.exists(os.path.join(output_dir, COMPLETE_MARKER)):
+        if fingerprints is None or path is None:
+            return True
+        return not set(fingerprints.stale(path, read_manifest(output_dir), output_dir, save) or ()) - set(TABLES)
+    return os.path.exists(os.path.join(output_dir, f"{save}_volume.csv")) and any(
+        os.path.exists(os.path.join(output_dir, f"{save}_280{suffix}")) for suffix in LABEL_FORMATS
+    )
+
+
+def mark_complete(output_dir, save, path, manifest=None):
+    """Write the completion marker, which is also the subject's `manifest`."""
+    marker = os.path.join(output_dir, COMPLETE_MARKER)
+    tmp = tmp_path(marker)
+    with open(tmp, "w") as f:
+        json.dump(dict(manifest or {}, subject=save, input=os.path.abspath(path), finished=time.time()), f)
+    os.replace(tmp, marker)
+
+
+def read_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, COMPLETE_MARKER)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def pending(paths, opt, fingerprints=None):
+    """Inputs still to segment; all of them with `opt.overwrite`.
+
+    With `fingerprints`, subjects whose label map is out of date are
+    segmented again; see `refresh_tables()` for the other outputs.
+    """
+    if opt.overwrite:
+        return list(paths)
+    todo = []
+    for path in paths:
+        save, output_dir = subject(path, opt.o)
+        if not is_complete(output_dir, save, path, fingerprints):
+            todo.append(path)
+    return todo
+
+
+def stale_tables(path, opt, fingerprints, manifest=None):
+    """`TABLES` stages `refresh_tables()` would recompute for `path`.
+
+    Empty when the subject is up to date, and when its label map is not:
+    then the whole subject is segmented again instead.
+    """
+    save, output_dir = subject(path, opt.o)
+    if manifest is None:
+        manifest = read_manifest(output_dir)
+    stale = fingerprints.stale(path, manifest, output_dir, save)
+    if not stale or set(stale) - set(TABLES):
+        return []
+    return stale
+
+
+def refresh_tables(paths, opt, fingerprints, cache=None):
+    """Recompute the tables of subjects whose label map is up to date but whose tables are not.
+
+    The region volumes are rebuilt from the label counts in the manifest,
+    with no image read, e.g. after Level5.txt or --volume-unit changed. With
+    `opt.cohort_csv`, their rows of the cohort table are replaced in a
+    single rewrite. Region statistics (`opt.region_stats`) are computed from
+    the saved label map and the N4-corrected input, which comes from `cache`
+    when it holds it; N4 is much cheaper than segmenting again. Returns the
+    subjects updated.
+
+    `paths` may be `WorkQueue.claims(refresh=...)`, so that nodes sharing a
+    cohort each refresh the subjects they hold a lease on.
+    """
+    if opt.overwrite:
+        return []
+    refreshed = []
+    for path in paths:
+        save, output_dir = subject(path, opt.o)
+        manifest = read_manifest(output_dir)
+        stale = stale_tables(path, opt, fingerprints, manifest)
+        if not stale:
+            continue
+        df = None
+        if "make_csv" in stale:
+            zooms = manifest["zooms"] if opt.volume_unit == "mm3" else None
+            df = region_table(np.asarray(manifest["counts"]), save, zooms)
+            if not opt.cohort_csv:
+                write_table(df, output_dir, save, opt)
+        if "region_stats" in stale:
+            write_region_stats(path, output_dir, save, opt, cache)
+        refreshed.append((path, save, output_dir, manifest, df))
+    rows = [df for *_, df in refreshed if df is not None]
+    if opt.cohort_csv and rows:
+        with _csv_lock:
+            replace_rows(pd.concat(rows, ignore_index=True), opt.cohort_csv)
+    for path, save, output_dir, manifest, _ in refreshed:
+        mark_complete(output_dir, save, path, fingerprints.manifest(path, manifest["counts"], manifest["zooms"], manifest))
+    return [save for _, save, *_ in refreshed]
+
+
+def write_region_stats(path, output_dir, save, opt, cache=None):
+    """Region statistics of a segmented subject, from its saved label map."""
+    image = nib.squeeze_image(nib.load(path))
+    # Decoded like prepare() does, so N4 sees the same volume.
+    image = nib.Nifti1Image(np.asanyarray(image.dataobj, dtype=np.float32), image.affine, image.header)
+    key = cache.key(path, N4_PARAMS) if cache is not None else None
+    odata = bias_corrected(image, save, opt.n4_dir, cache, key, path)
+    labels = nib.load(os.path.join(output_dir, f"{save}_280{opt.label_format}"))
+    stats = region_stats(np.asanyarray(labels.dataobj), np.asanyarray(odata.dataobj), labels.affine)
+    write_stats(stats_table(stats, save), stats_path(output_dir, save, opt.region_stats))
+
+
+def prepare(path, output_dir, save, tmp_dir=None, cache=None, trace_origin=None, input_copy="float32"):
+    """CPU stage before inference: input copy, N4 bias correction and conform.
+
+    The input is decoded once, straight to float32; the copy and N4 both
+    work on that array. `input_copy` is one of `INPUT_COPIES`.
+    Returns the N4-corrected and conformed images, whether N4 came from
+    `cache` and, when `trace_origin` is given, the trace events recorded here.
+    """
+    tracer = Tracer(save, trace_origin) if trace_origin is not None else None
+    with activate(tracer):
+        with span("input_copy"):
+            os.makedirs(output_dir, exist_ok=True)
+            image = nib.squeeze_image(nib.load(path))
+            # Scaled by the array proxy in float32, without a float64 copy.
+            image = nib.Nifti1Image(np.asanyarray(image.dataobj, dtype=np.float32), image.affine, image.header)
+            copy_input(path, image, output_dir, save, input_copy)
+        with span("preprocessing", memory=True, shape=list(image.shape)) as args:
+            if cache is None:
+                hit = None
+                odata, data = preprocessing(image, save, tmp_dir, geometry=path)
+            else:
+                hits = cache.hits
+                key = cache.key(path, N4_PARAMS)
+                odata, data = preprocessing(image, save, tmp_dir, cache, key, path)
+                hit = args["n4_cached"] = cache.hits > hits
+    return odata, data, hit, tracer.events if tracer is not None else None
+
+
+def network_stages(models, device, opt):
+    """The `Stage`s of `segment()`: conformed volume -> cropped label map."""
+
+    def strip(cropped, data):
+        stripped, shift = stripping(cropped, data, models.get("ssnet"), device, opt.batch_size)
+        # Parcellation and hemisphere share the normalized brain and its stacks.
+        with span("normalize"):
+            return Volume(stripped), shift
+
+    def parcellate(stripped):
+        return parcellation(
+            stripped[0], models.get("pnet_c"), models.get("pnet_s"), models.get("pnet_a"),
+            device, opt.batch_size, getattr(torch, opt.parcellation_dtype), opt.skip_empty,
+        )
+
+    def separate(stripped):
+        return hemisphere(
+            stripped[0], models.get("hnet_c"), models.get("hnet_a"), device, opt.batch_size, opt.skip_empty
+        )
+
+    def postprocess(parcellated, separated):
+        return postprocessing(parcellated, separated, device)
+
+    run = {
+        "cropping": lambda data: cropping(data, models.get("cnet"), device, opt.batch_size, opt.crop_resolution),
+        "stripping": strip,
+        "parcellation": parcellate,
+        "hemisphere": separate,
+        "postprocessing": postprocess,
+    }
+    args = {"parcellation": {"dtype": opt.parcellation_dtype}}
+    return [Stage(name, REQUIRES[name], run[name], args.get(name)) for name in run]
+
+
+def segment(data, models, device, opt, on_stage=None):
+    """Network stages: conformed 256^3 volume -> cropped label map and shift.
+
+    The label map is on the 192x224x192 grid stripping() centered the
+    brain on, `shift` voxels away from the conformed grid; see `uncrop()`.
+
+    With `opt.concurrent_stages`, parcellation and hemisphere run at the
+    same time, splitting the torch threads. `on_stage(name)` is called
+    before each stage starts.
+    """
+    results = run_stages(
+        network_stages(models, device, opt),
+        {"preprocessing": data},
+        concurrent=opt.concurrent_stages,
+        on_stage=on_stage,
+    )
+    return results["postprocessing"], results["stripping"][1]
+
+
+def write_table(df, output_dir, save, opt):
+    if opt.cohort_csv:
+        with _csv_lock:
+            write_rows(df, opt.cohort_csv)
+    else:
+        csv_path = os.path.join(output_dir, f"{save}_volume.csv")
+        tmp = tmp_path(csv_path)
+        df.to_csv(tmp, index=False)
+        os.replace(tmp, csv_path)
+
+
+def write(output, shift, odata, data, output_dir, save, opt, tracer=None):
+    """CPU stage after inference: region volumes, native-space label map and,
+    with `opt.region_stats`, region statistics of the N4-corrected volume.
+
+    `output` is the cropped label map `segment()` returns, with its `shift`.
+    Returns the label counts and voxel spacing the region volumes came from,
+    for the manifest.
+    """
+    with activate(tracer):
+        with span("make_csv"):
+            zooms = data.header.get_zooms()
+            counts = count_regions(output)
+            write_table(region_table(counts, save, zooms if opt.volume_unit == "mm3" else None), output_dir, save, opt)
+
+        with span("conform", memory=True):
+            nii = to_native(output, shift, odata, data)
+
+        with span("save", format=opt.label_format):
+            save_nifti(nii, os.path.join(output_dir, f"{save}_280{opt.label_format}"), opt.compress_threads)
+
+        if opt.region_stats != "none":
+            with span("region_stats"):
+                stats = region_stats(np.asanyarray(nii.dataobj), np.asanyarray(odata.dataobj), nii.affine)
+                write_stats(stats_table(stats, save), stats_path(output_dir, save, opt.region_stats))
+
+    del odata, data
+    return counts, zooms
+
+
+def _inline(fn, *args):
+    future = Future()
+    future.set_result(fn(*args))
+    return future
+
+
+def run_pipeline(paths, models, device, opt, on_stage=None):
+    """Segment every path, overlapping CPU pre/post-processing with inference.
+
+    With `opt.workers` > 0, subjects ahead of the one being segmented are
+    prepared in a process pool, at most `opt.queue_depth` at a time. With
+    `opt.writers` > 0, finished subjects are resampled and written by a
+    thread pool while the next one is segmented. Both default to 0, which
+    runs every step inline. Yields each subject's name once it is written
+    and marked complete, with a manifest of what its outputs depend on.
+
+    `on_stage(save, stage)` is called on the caller's thread as each subject
+    enters one of `STAGES`; raising `Cancelled` from it stops the run.
+    """
+    on_stage = on_stage or (lambda save, stage: None)
+    depth = max(1, opt.queue_depth)
+    preparers = ProcessPoolExecutor(opt.workers) if opt.workers > 0 else None
+    writers = ThreadPoolExecutor(opt.writers) if opt.writers > 0 else None
+    cache = N4Cache(opt.n4_cache, opt.n4_cache_size * 1024**2) if opt.n4_cache else None
+    cache_hits = cache_misses = 0
+    fingerprints = Fingerprints(opt)
+    summaries = {}
+    jobs = iter(paths)
+    prepared = deque()
+    written = deque()
+
+    def submit_prepare():
+        path = next(jobs, None)
+        if path is None:
+            return
+        save, output_dir = subject(path, opt.o)
+        tracer = Tracer(save) if opt.trace else None
+        on_stage(save, "preprocessing")
+        args = (path, output_dir, save, opt.n4_dir, cache, tracer.origin if tracer else None, opt.input_copy)
+        if preparers is None:
+            future = _inline(prepare, *args)
+        else:
+            future = preparers.submit(prepare, *args)
+        prepared.append((path, save, output_dir, tracer, future))
+
+    def finished(limit):
+        # Written subjects, in order; blocks while more than `limit` are pending.
+        while written and (len(written) > limit or written[0][4].done()):
+            path, save, output_dir, tracer, future = written.popleft()
+            counts, zooms = future.result()
+            mark_complete(output_dir, save, path, fingerprints.manifest(path, counts, zooms, read_manifest(output_dir)))
+            if tracer is not None:
+                tracer.save(os.path.join(output_dir, f"{save}_trace.json"))
+                summaries[save] = tracer.summary()
+            yield save
+
+    try:
+        for _ in range(depth if preparers is not None else 1):
+            submit_prepare()
+        while prepared:
+            path, save, output_dir, tracer, future = prepared.popleft()
+            odata, data, hit, events = future.result()
+            if tracer is not None:
+                tracer.extend(events)
+            if hit is not None:
+                cache_hits += hit
+                cache_misses += not hit
+            if preparers is not None:
+                submit_prepare()
+
+            yield from finished(depth)
+            counter = SkipCounter()
+            with activate(tracer), counting(counter):
+                output, shift = segment(data, models, device, opt, partial(on_stage, save))
+            if counter.slices:
+                print(f"{save}: {counter.skipped}/{counter.slices} slices ({counter.skipped / counter.slices:.0%}) skipped as background")
+
+            on_stage(save, "write")
+            args = (output, shift, odata, data, output_dir, save, opt, tracer)
+            if writers is None:
+                future = _inline(write, *args)
+            else:
+                future = writers.submit(write, *args)
+            written.append((path, save, output_dir, tracer, future))
+            del output, odata, data, args
+            yield from finished(depth if writers is not None else 0)
+
+            if preparers is None:
+                submit_prepare()
+        yield from finished(0)
+        if cache is not None:
+            print(f"N4 cache: {cache_hits} hits, {cache_misses} misses ({cache.root})")
+        if summaries:
+            with open(os.path.join(opt.o, "trace_summary.json"), "w") as f:
+                json.dump(summarize(summaries), f, indent=2)
+    finally:
+        if preparers is not None:
+            preparers.shutdown(cancel_futures=True)
+        if writers is not None:
+            writers.shutdown()
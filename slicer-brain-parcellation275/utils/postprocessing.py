@@ -1,24 +1,53 @@
 import pickle
+from functools import lru_cache
+
 import numpy as np
 import torch
 import os
 
-def postprocessing(parcellated, separated, shift, device):
-    script_dir = os.path.dirname(os.path.realpath(__file__))
+script_dir = os.path.dirname(os.path.realpath(__file__))
+split_map_path = os.path.join(script_dir, "split_map.pkl")
+
+# Planes stripping() crops from each side of the centered 256^3 volume.
+CROP = ((32, 32), (16, 16), (32, 32))
+
+
+@lru_cache(maxsize=None)
+def load_lut(path=split_map_path):
+    """Compile split_map.pkl into a dense (hemisphere, parcel) -> label table.
 
-    with open(os.path.join(script_dir, "split_map.pkl"), "rb") as tf:
+    Pairs missing from the map stay 0, like the voxels the per-key loop never
+    assigned. The table is built once per process and shared by all subjects.
+    """
+    with open(path, "rb") as tf:
         dictionary = pickle.load(tf)
+    keys = np.array(list(dictionary.keys()))
+    lut = np.zeros(keys.max(axis=0) + 1, dtype="int16")
+    for (h, p), value in dictionary.items():
+        lut[h, p] = value
+    lut.flags.writeable = False
+    return lut
+
+
+def relabel(hmap, pmap, lut):
+    """Gather labels for every voxel from the hemisphere and parcel maps.
+
+    Works on NumPy arrays or torch tensors; the result has the type and
+    device of `hmap`.
+    """
+    if isinstance(hmap, torch.Tensor):
+        lut = torch.tensor(lut, device=hmap.device)
+        return lut[hmap.long(), pmap.long()]
+    return lut[hmap, pmap]
+
+
+def postprocessing(parcellated, separated, device):
+    """Label map of the cropped 192x224x192 grid stripping() centered the brain on."""
+    lut = load_lut()
     pmap = torch.tensor(parcellated.astype("int16"), requires_grad=False).to(device)
     hmap = torch.tensor(separated.astype("int16"), requires_grad=False).to(device)
-    combined = torch.stack((torch.flatten(hmap), torch.flatten(pmap)), axis=-1)
-    output = torch.zeros_like(hmap).ravel()
+    output = relabel(hmap, pmap, lut)
 
-    for key, value in dictionary.items():
-        key = torch.tensor(key, requires_grad=False).to(device)
-        mask = torch.all(combined == key, axis=1)
-        output[mask] = value
-
-    output = output.reshape(hmap.shape)
     output = output.cpu().detach().numpy()
     output = output * (
         np.logical_or(
@@ -26,8 +55,11 @@ def postprocessing(parcellated, separated, shift, device):
             parcellated == 138
         )
     )
-    output = np.pad(
-        output, [(32, 32), (16, 16), (32, 32)], "constant", constant_values=0
-    )
+    return output
+
+
+def uncrop(output, shift):
+    """Put a cropped label map back on the conformed 256^3 grid."""
+    output = np.pad(output, CROP, "constant", constant_values=0)
     output = np.roll(output, (-shift[0], -shift[1], -shift[2]), axis=(0, 1, 2))
     return output
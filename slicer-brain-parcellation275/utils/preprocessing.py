@@ -1,32 +1,129 @@
 import os
 
 import nibabel as nib
+import numpy as np
 import SimpleITK as sitk
 from nibabel import processing
 from nibabel.orientations import aff2axcodes, axcodes2ornt, ornt_transform
 
+# nibabel affines map to RAS+, SimpleITK geometry is LPS+. The flip is applied
+# elementwise, as ITK's NIfTI IO does, so zeros keep the same sign.
+RAS_TO_LPS = np.array([-1.0, -1.0, 1.0])
 
-def N4_Bias_Field_Correction(input_path, output_path):
-    raw_img_sitk = sitk.ReadImage(input_path, sitk.sitkFloat32)
+# Everything that changes the N4 output for a given input; part of the cache key.
+N4_PARAMS = {"shrink_factor": 4, "rescale": [0, 255], "mask": "li_threshold"}
+
+
+def nibabel_to_sitk(image, geometry=None):
+    """3D nibabel image -> float32 SimpleITK image with the same geometry.
+
+    With `geometry`, the file `image` was read from, origin, spacing and
+    direction are those sitk.ReadImage gives that file: ITK's NIfTI reader
+    chooses between qform and sform and orthonormalises the direction, which
+    the affine alone does not reproduce for shears or a qform that differs
+    from the sform. Only the header is read. Without it they come from the
+    affine, which agrees with ITK for orthogonal affines.
+    """
+    voxels = np.asanyarray(image.dataobj, dtype=np.float32)
+    # SimpleITK arrays are indexed (k, j, i).
+    sitk_image = sitk.GetImageFromArray(voxels.T)
+    if geometry is not None:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(geometry)
+        reader.ReadImageInformation()
+        # Trailing singleton dimensions nibabel squeezed away.
+        dimension = reader.GetDimension()
+        direction = np.array(reader.GetDirection()).reshape(dimension, dimension)
+        sitk_image.SetSpacing(reader.GetSpacing()[:3])
+        sitk_image.SetDirection(direction[:3, :3].ravel().tolist())
+        sitk_image.SetOrigin(reader.GetOrigin()[:3])
+        return sitk_image
+    affine = image.affine.astype(np.float64)
+    norms = np.linalg.norm(affine[:3, :3], axis=0)
+    # Spacing comes from the float32 pixdim fields, as in sitk.ReadImage.
+    spacing = np.array(image.header.get_zooms()[:3], dtype=np.float64)
+    sitk_image.SetSpacing(spacing.tolist())
+    sitk_image.SetDirection((RAS_TO_LPS[:, None] * affine[:3, :3] / norms).ravel().tolist())
+    sitk_image.SetOrigin((RAS_TO_LPS * affine[:3, 3]).tolist())
+    return sitk_image
+
+
+def sitk_to_nibabel(sitk_image):
+    """SimpleITK image -> in-memory nibabel image with the same geometry.
+
+    The affine goes through the float32 header fields, as in a file, but
+    sitk.WriteImage derives the stored sform and quaternion its own way: for
+    oblique directions the two affines agree to about 1e-6, not bit for bit.
+    """
+    voxels = sitk.GetArrayFromImage(sitk_image).T
+    direction = np.array(sitk_image.GetDirection()).reshape(3, 3)
+    affine = np.eye(4)
+    affine[:3, :3] = RAS_TO_LPS[:, None] * direction * np.array(sitk_image.GetSpacing())
+    affine[:3, 3] = RAS_TO_LPS * np.array(sitk_image.GetOrigin())
+    image = nib.Nifti1Image(voxels, affine)
+    return nib.Nifti1Image(voxels, image.header.get_best_affine(), image.header)
+
+
+def N4_Bias_Field_Correction(input_path, output_path=None):
+    if isinstance(input_path, sitk.Image):
+        raw_img_sitk = sitk.Cast(input_path, sitk.sitkFloat32)
+    else:
+        raw_img_sitk = sitk.ReadImage(input_path, sitk.sitkFloat32)
     transformed = sitk.RescaleIntensity(raw_img_sitk, 0, 255)
     transformed = sitk.LiThreshold(transformed, 0, 1)
     head_mask = transformed
-    shrinkFactor = 4
+    shrinkFactor = N4_PARAMS["shrink_factor"]
     inputImage = sitk.Shrink(raw_img_sitk, [shrinkFactor] * raw_img_sitk.GetDimension())
     maskImage = sitk.Shrink(head_mask, [shrinkFactor] * raw_img_sitk.GetDimension())
     bias_corrector = sitk.N4BiasFieldCorrectionImageFilter()
     corrected = bias_corrector.Execute(inputImage, maskImage)
     log_bias_field = bias_corrector.GetLogBiasFieldAsImage(raw_img_sitk)
     corrected_image_full_resolution = raw_img_sitk / sitk.Exp(log_bias_field)
-    sitk.WriteImage(corrected_image_full_resolution, output_path)
-    return
+    if output_path is not None:
+        sitk.WriteImage(corrected_image_full_resolution, output_path)
+    return corrected_image_full_resolution
+
+
+def bias_corrected(ipath, save, tmp_dir=None, cache=None, key=None, geometry=None):
+    """N4-corrected input reoriented to RAS, the native-space volume `preprocessing()` conforms.
+
+    Arguments as for `preprocessing()`.
+    """
+    if isinstance(ipath, nib.spatialimages.SpatialImage):
+        image = nib.squeeze_image(ipath)
+    else:
+        image = nib.squeeze_image(nib.load(ipath))
+        geometry = geometry or ipath
+        if cache is not None and key is None:
+            key = cache.key(ipath, N4_PARAMS)
+    opath = None
+    if tmp_dir is not None:
+        os.makedirs(tmp_dir, exist_ok=True)
+        opath = os.path.join(tmp_dir, f"{save}.nii")
+
+    corrected = cache.get(key) if cache is not None else None
+    if corrected is None:
+        sitk_corrected = N4_Bias_Field_Correction(nibabel_to_sitk(image, geometry), opath)
+        if cache is not None:
+            corrected = cache.put(key, sitk_corrected)
+        else:
+            corrected = sitk_to_nibabel(sitk_corrected)
+    elif opath is not None:
+        nib.save(corrected, opath)
+    return nib.squeeze_image(nib.as_closest_canonical(corrected))
+
 
+def preprocessing(ipath, save, tmp_dir=None, cache=None, key=None, geometry=None):
+    """N4-correct and conform one input, without touching the disk.
 
-def preprocessing(ipath, save):
-    opath = f"N4/{save}.nii"
-    os.makedirs("N4", exist_ok=True)
-    N4_Bias_Field_Correction(ipath, opath)
-    odata = nib.squeeze_image(nib.as_closest_canonical(nib.load(opath)))
+    `ipath` is a file path or an already decoded nibabel image. For an image,
+    `geometry` is the file it was decoded from, whose header gives N4 the
+    geometry sitk.ReadImage would; see `nibabel_to_sitk()`. The corrected
+    volume is only written to `{tmp_dir}/{save}.nii` when `tmp_dir` is given.
+    With an `N4Cache`, a cached correction for `key` (by default derived from
+    the file at `ipath`) skips N4 entirely.
+    """
+    odata = bias_corrected(ipath, save, tmp_dir, cache, key, geometry)
     data = processing.conform(
         odata, out_shape=(256, 256, 256), voxel_size=(1.0, 1.0, 1.0), order=1
     )
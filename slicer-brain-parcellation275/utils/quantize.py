@@ -0,0 +1,139 @@
+import copy
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from utils.make_csv import count_regions, load_regions
+from utils.network import UNet
+
+REPORT = "quantization.json"
+
+# Acceptance thresholds of the validation harness (utils/calibrate.py).
+THRESHOLDS = {
+    "min_mean_dice": 0.95,
+    "min_label_dice": 0.80,
+    "max_volume_error": 0.05,
+    # Labels smaller than this in the float32 output are not held to the
+    # per-label thresholds; a few voxels flipping would dominate them.
+    "min_voxels": 100,
+}
+
+
+def default_backend():
+    engines = torch.backends.quantized.supported_engines
+    return "x86" if "x86" in engines else "qnnpack"
+
+
+def _prepare(model, example, backend):
+    model = copy.deepcopy(model).eval()
+    return prepare_fx(model, get_default_qconfig_mapping(backend), (example,))
+
+
+def quantize_model(model, batches, backend=None):
+    """Static INT8 post-training quantization of an (unfused) UNet.
+
+    Observers are calibrated on `batches`, the float inputs the network sees
+    in the pipeline. Conv/BatchNorm/ReLU are fused by the FX quantizer.
+    """
+    backend = backend or default_backend()
+    torch.backends.quantized.engine = backend
+    batches = iter(batches)
+    first = next(batches)
+    prepared = _prepare(model, first, backend)
+    with torch.inference_mode():
+        prepared(first)
+        for batch in batches:
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def build_quantized(path, ch_in, ch_out, backend=None):
+    """INT8 UNet from a state dict saved by `quantize_model(...).state_dict()`."""
+    backend = backend or default_backend()
+    torch.backends.quantized.engine = backend
+    example = torch.zeros(1, ch_in, 32, 32)
+    model = convert_fx(_prepare(UNet(ch_in, ch_out), example, backend))
+    model.load_state_dict(torch.load(path, map_location="cpu", weights_only=True))
+    return model.eval()
+
+
+class Recorder(nn.Module):
+    """Passes inputs through to `model`, keeping every `every`-th slice for calibration."""
+
+    def __init__(self, model, every=16):
+        super(Recorder, self).__init__()
+        self.model = model
+        self.every = every
+        self.seen = 0
+        self.slices = []
+
+    def forward(self, x):
+        index = torch.arange(self.seen, self.seen + len(x))
+        self.seen += len(x)
+        keep = x[index % self.every == 0]
+        if len(keep):
+            self.slices.append(keep.detach().cpu().clone())
+        return self.model(x)
+
+    def batches(self, size=8):
+        slices = torch.cat(self.slices)
+        return [slices[start:start + size] for start in range(0, len(slices), size)]
+
+
+def dice_per_label(reference, test, labels=280):
+    """Dice of every label 0..labels between two label maps, NaN where both are empty."""
+    reference = np.ravel(reference).astype(np.int64)
+    test = np.ravel(test).astype(np.int64)
+    overlap = np.bincount(reference[reference == test], minlength=labels + 1)[: labels + 1]
+    sizes = count_regions(reference, labels)[: labels + 1] + count_regions(test, labels)[: labels + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 2 * overlap / sizes
+
+
+def compare(reference, test, thresholds=THRESHOLDS):
+    """Agreement of an INT8 label map with the float32 one, per Level5 region."""
+    numbers, regions = load_regions()
+    numbers = list(numbers)
+    dice = dice_per_label(reference, test, max(numbers))[numbers]
+    reference_volumes = count_regions(reference, max(numbers))[numbers]
+    test_volumes = count_regions(test, max(numbers))[numbers]
+    large = reference_volumes >= thresholds["min_voxels"]
+    error = np.abs(test_volumes - reference_volumes) / np.maximum(reference_volumes, 1)
+    result = {
+        "mean_dice": float(np.nanmean(dice)),
+        "min_label_dice": float(np.min(dice[large])) if large.any() else 1.0,
+        "worst_label": regions[int(np.argmin(np.where(large, dice, np.inf)))] if large.any() else None,
+        "max_volume_error": float(np.max(error[large])) if large.any() else 0.0,
+        "label_agreement": float(np.mean(np.asarray(reference) == np.asarray(test))),
+    }
+    result["accepted"] = (
+        result["mean_dice"] >= thresholds["min_mean_dice"]
+        and result["min_label_dice"] >= thresholds["min_label_dice"]
+        and result["max_volume_error"] <= thresholds["max_volume_error"]
+    )
+    return result
+
+
+def save_report(folder, report):
+    with open(os.path.join(folder, REPORT), "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_report(folder):
+    """Validation report of INT8 networks, refusing ones that failed or were never validated."""
+    path = os.path.join(folder, REPORT)
+    if not os.path.exists(path):
+        raise RuntimeError(f"{folder} has no {REPORT}; run utils/calibrate.py to validate the INT8 networks")
+    with open(path) as f:
+        report = json.load(f)
+    if not report.get("accepted"):
+        raise RuntimeError(
+            f"INT8 networks in {folder} did not agree with float32 within the thresholds "
+            f"{report.get('thresholds')}; see {path}"
+        )
+    return report
@@ -0,0 +1,144 @@
+"""Per-region intensity, position and extent statistics of a label map.
+
+Computed by the pipeline while the native-space label map and the
+N4-corrected volume are still in memory (--region-stats), written as one row
+per subject to `{save}_stats.csv` or `{save}_stats.parquet`. Gather the
+rows of a whole output folder into one table with:
+
+    python utils/region_stats.py -o OUTPUT cohort.parquet
+"""
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+from utils.make_csv import load_regions
+from utils.outputs import tmp_path
+
+# Formats of the per-subject table; "none" skips the statistics.
+STATS_FORMATS = ("none", "csv", "parquet")
+
+# Per region: voxel count, mean and SD (population) of the intensity, centroid
+# in scanner RAS mm, and inclusive bounding box in voxel indices of the label map.
+STATISTICS = (
+    "voxels", "mean", "sd", "centroid_x", "centroid_y", "centroid_z",
+    "min_i", "max_i", "min_j", "max_j", "min_k", "max_k",
+)
+
+
+def region_stats(labels, intensity, affine, planes=16):
+    """`STATISTICS` of every label 0..max, each an array indexed by label.
+
+    The volumes are reduced slab by slab along their slowest axis, `planes`
+    at a time. Per slab, bincounts weighted by the intensity and its square
+    give the sums behind the mean and SD, and bincounts of label * size +
+    position give each label's histogram of positions along every axis, from
+    which both the centroid and the bounding box follow. Labels without a
+    voxel get NaN.
+    """
+    labels = np.asarray(labels)
+    intensity = np.asarray(intensity)
+    n = int(labels.max()) + 1
+    # Slab along the slowest axis of the intensity volume, e.g. the last one
+    # of the Fortran-ordered arrays SimpleITK volumes come as.
+    axes = tuple(int(a) for a in np.argsort(intensity.strides, kind="stable")[::-1])
+    labels, intensity = labels.transpose(axes), intensity.transpose(axes)
+    shape = labels.shape
+    total = np.zeros(n)
+    squares = np.zeros(n)
+    positions = [np.zeros((n, size), dtype=np.int64) for size in shape]
+    offsets = [np.arange(shape[1])[:, None], np.arange(shape[2])[None, :]]
+    for start in range(0, shape[0], planes):
+        stop = min(start + planes, shape[0])
+        label = labels[start:stop].astype(np.intp)
+        value = intensity[start:stop].astype(np.float64).ravel()
+        flat = label.ravel()
+        total += np.bincount(flat, weights=value, minlength=n)
+        squares += np.bincount(flat, weights=value * value, minlength=n)
+        plane = (label + n * np.arange(stop - start)[:, None, None]).ravel()
+        positions[0][:, start:stop] = np.bincount(plane, minlength=n * (stop - start)).reshape(-1, n).T
+        for axis in (1, 2):
+            index = (label * shape[axis] + offsets[axis - 1]).ravel()
+            positions[axis] += np.bincount(index, minlength=n * shape[axis]).reshape(n, shape[axis])
+    positions = [positions[axes.index(axis)] for axis in range(3)]
+
+    count = positions[0].sum(axis=1)
+    stats = {"voxels": count.astype(np.float64)}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats["mean"] = total / count
+        stats["sd"] = np.sqrt(np.maximum(squares / count - stats["mean"] ** 2, 0))
+        centroid = np.stack([histogram @ np.arange(histogram.shape[1]) / count for histogram in positions])
+    world = np.asarray(affine, dtype=np.float64)[:3, :3] @ centroid + np.asarray(affine, dtype=np.float64)[:3, 3:]
+    for axis, name in enumerate("xyz"):
+        stats[f"centroid_{name}"] = world[axis]
+    empty = count == 0
+    for axis, name in enumerate("ijk"):
+        present = positions[axis] > 0
+        first = np.argmax(present, axis=1).astype(np.float64)
+        last = (present.shape[1] - 1 - np.argmax(present[:, ::-1], axis=1)).astype(np.float64)
+        first[empty] = last[empty] = np.nan
+        stats[f"min_{name}"], stats[f"max_{name}"] = first, last
+    return stats
+
+
+def stats_table(stats, save):
+    """One-row table of `region_stats()` for subject `save`, for the regions of Level5.txt.
+
+    Columns are "{statistic}_{region}", grouped by statistic.
+    """
+    numbers, regions = load_regions()
+    row = {"uid": [save]}
+    for name in STATISTICS:
+        # Labels above the label map's maximum have no voxels and no statistics.
+        missing = max(0, max(numbers) + 1 - len(stats[name]))
+        values = np.concatenate([stats[name], np.full(missing, 0.0 if name == "voxels" else np.nan)])[list(numbers)]
+        row.update((f"{name}_{region}", [value]) for region, value in zip(regions, values))
+    return pd.DataFrame(row)
+
+
+def stats_path(output_dir, save, fmt):
+    return os.path.join(output_dir, f"{save}_stats.{fmt}")
+
+
+def write_stats(df, path):
+    """Write `df` as .csv or .parquet, by the extension of `path`, under a temporary name."""
+    tmp = tmp_path(path)
+    if path.endswith(".parquet"):
+        if pyarrow is None:
+            raise ImportError("parquet region statistics need the pyarrow package")
+        df.to_parquet(tmp, index=False)
+    else:
+        df.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def read_stats(path):
+    return pd.read_parquet(path) if path.endswith(".parquet") else pd.read_csv(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gather the per-subject region statistics of an output folder into one table.")
+    parser.add_argument("-o", required=True, help="Output folder of the pipeline.")
+    parser.add_argument("table", help="Cohort table to write, .csv or .parquet.")
+    opt = parser.parse_args(argv)
+    paths = sorted(glob.glob(os.path.join(opt.o, "*", "*_stats.csv")) + glob.glob(os.path.join(opt.o, "*", "*_stats.parquet")))
+    if not paths:
+        parser.error(f"no region statistics under {opt.o}; run the pipeline with --region-stats")
+    write_stats(pd.concat([read_stats(path) for path in paths], ignore_index=True), opt.table)
+    print(f"{len(paths)} subjects written to {opt.table}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import torch
+from nibabel.affines import rescale_affine, to_matvec
+from nibabel.orientations import axcodes2ornt, inv_ornt_aff, io_orientation, ornt_transform
+
+from utils.postprocessing import CROP
+
+
+def native_grid(odata, data):
+    """Shape and affine of the input's voxel grid, and the voxel mapping onto `data`.
+
+    Computed the way nibabel's `processing.conform()` does when resampling
+    an image on the conformed grid of `data` back to the grid of `odata`:
+    returns (shape, affine, rzs, trans), where a native voxel ijk samples
+    the conformed voxel rzs @ ijk + trans.
+    """
+    header = odata.header
+    shape = (header["dim"][1], header["dim"][2], header["dim"][3])
+    zooms = (header["pixdim"][1], header["pixdim"][2], header["pixdim"][3])
+    transform = ornt_transform(io_orientation(data.affine), axcodes2ornt("RAS"))
+    affine, conformed_shape = data.affine, data.shape[:3]
+    if not np.array_equal(transform, [[0, 1], [1, 1], [2, 1]]):
+        affine = affine.dot(inv_ornt_aff(transform, conformed_shape))
+        conformed_shape = tuple(np.array(conformed_shape)[np.argsort(transform[:, 0])])
+    affine = rescale_affine(affine, conformed_shape, zooms, shape)
+    rzs, trans = to_matvec(np.linalg.inv(data.affine).dot(affine))
+    return tuple(int(n) for n in shape), affine, rzs, trans
+
+
+def _lookup(size, shift, offset, length, stride):
+    """Flat offset into the padded cropped grid of each conformed voxel 0..size.
+
+    Conformed voxel `size` stands for "outside the volume". The others undo
+    np.roll(..., -shift) and the crop padding; voxels outside the crop read
+    the zero plane at index `length`.
+    """
+    voxel = (np.arange(size + 1) + shift) % size - offset
+    voxel = np.where((voxel >= 0) & (voxel < length), voxel, length)
+    voxel[size] = length
+    return voxel * stride
+
+
+def _nearest(coordinate, lookup):
+    """`lookup` of the conformed voxel nearest to each coordinate, as scipy rounds."""
+    size = len(lookup) - 1
+    inside = (coordinate >= 0) & (coordinate <= size - 1)
+    voxel = np.floor(coordinate + 0.5, out=coordinate)
+    return lookup[np.where(inside, voxel, size).astype(np.intp)]
+
+
+def to_native(labels, shift, odata, data, planes=4, workers=None):
+    """Label map of the cropped grid, resampled straight onto the input's grid.
+
+    Bit-exact with undoing the crop (`uncrop()`) and resampling the 256^3
+    map with `conform(order=0)`: each native voxel's conformed coordinate is
+    computed with the same floating-point operations as
+    scipy.ndimage.affine_transform, rounded to the nearest voxel (0 outside
+    the volume), and looked up on the cropped grid through the centering
+    shift and crop offset, where a single gather reads the labels. No 256^3
+    intermediate is built.
+
+    When the native and conformed axes are aligned, each index only depends
+    on its own axis and is computed once per plane; oblique grids are
+    processed `planes` native planes at a time on `workers` threads
+    (default: the torch intra-op thread count).
+    """
+    shape, affine, rzs, trans = native_grid(odata, data)
+    size = data.shape[:3]
+    # One plane of zeros after each axis: where voxels without a label read.
+    padded = np.pad(labels.astype(np.uint16, copy=False), [(0, 1)] * 3)
+    strides = [stride // padded.itemsize for stride in padded.strides]
+    lookups = [
+        _lookup(size[axis], shift[axis], CROP[axis][0], labels.shape[axis], strides[axis]) for axis in range(3)
+    ]
+    padded = padded.ravel()
+
+    def index(axis, i, j, k):
+        # Same summation order as scipy: offset first, then each output axis.
+        coordinate = ((trans[axis] + rzs[axis, 0] * i) + rzs[axis, 1] * j) + rzs[axis, 2] * k
+        return _nearest(np.asarray(coordinate, dtype=np.float64), lookups[axis])
+
+    grid = [np.arange(n, dtype=np.float64) for n in shape]
+    if not np.any(rzs - np.diag(np.diagonal(rzs))):
+        # Adding the zero terms of the other axes leaves a coordinate unchanged.
+        i, j, k = (index(axis, *[grid[a] if a == axis else 0.0 for a in range(3)]) for axis in range(3))
+        native = padded[(i[:, None, None] + j[:, None]) + k]
+    else:
+        native = np.empty(shape, dtype=np.uint16)
+        j, k = grid[1][:, None], grid[2]
+
+        def fill(start):
+            i = grid[0][start : start + planes, None, None]
+            flat = index(0, i, j, k)
+            flat += index(1, i, j, k)
+            flat += index(2, i, j, k)
+            native[start : start + planes] = padded[flat]
+
+        # NumPy releases the GIL in these loops, so slabs run in parallel.
+        with ThreadPoolExecutor(workers or torch.get_num_threads()) as pool:
+            list(pool.map(fill, range(0, shape[0], planes)))
+    # The header conform() would have carried over from the label image.
+    header = nib.Nifti1Image(np.zeros((1, 1, 1), dtype=np.uint16), affine=data.affine).header
+    return nib.Nifti1Image(native, affine, header)
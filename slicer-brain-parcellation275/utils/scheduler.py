@@ -0,0 +1,106 @@
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import torch
+
+from utils.inference import counting, memory_share, skip_counter
+from utils.trace import activate, current, span
+
+# A step of the per-subject graph: `run` is called with the results of the
+# stages named in `requires`, in that order; `args` annotate its trace span.
+Stage = namedtuple("Stage", ["name", "requires", "run", "args"], defaults=(None,))
+
+
+def order(stages, given=()):
+    """`stages` sorted so that each comes after the stages it requires.
+
+    Ties keep the given order. `given` names results that already exist.
+    Raises ValueError for a missing or circular dependency.
+    """
+    done = set(given)
+    waiting = list(stages)
+    ordered = []
+    while waiting:
+        ready = next((s for s in waiting if all(r in done for r in s.requires)), None)
+        if ready is None:
+            missing = {r for s in waiting for r in s.requires} - done - {s.name for s in waiting}
+            raise ValueError(
+                f"stages {[s.name for s in waiting]} need {sorted(missing)}" if missing
+                else f"circular dependency between {[s.name for s in waiting]}"
+            )
+        waiting.remove(ready)
+        ordered.append(ready)
+        done.add(ready.name)
+    return ordered
+
+
+def _run(stage, inputs, threads=None, share=1, previous=None):
+    if threads is not None:
+        # set_num_threads() also changes the process-wide default that threads
+        # started later (e.g. the writers) take on their first parallel op, so
+        # the caller's count, `previous`, is put back once the stage is done.
+        torch.set_num_threads(threads)
+    try:
+        with memory_share(share), span(stage.name, memory=True, **(stage.args or {})):
+            return stage.run(*inputs)
+    finally:
+        if threads is not None:
+            torch.set_num_threads(previous)
+
+
+def run_stages(stages, results, concurrent=True, threads=None, on_stage=None):
+    """Run `stages` as soon as the results they require exist.
+
+    `results` maps the names of results that already exist to them, and
+    receives the result of every stage. With `concurrent`, stages that are
+    ready at the same time (e.g. parcellation and hemisphere, which both
+    only need the stripped brain) run on worker threads. The `threads`
+    torch intra-op threads (default: this thread's) and the inference
+    memory budget are split evenly between them. A stage that is ready on
+    its own runs on the calling thread with all of them.
+
+    `on_stage(name)` is called on the calling thread as each stage starts.
+    If it or a stage raises, the stages already running are waited for
+    before the exception propagates.
+    """
+    on_stage = on_stage or (lambda name: None)
+    waiting = order(stages, results)
+    previous = torch.get_num_threads()
+    threads = threads or previous
+    tracer = current()
+    counter = skip_counter()
+    running = {}
+    pool = None
+
+    def submit(stage, inputs, width):
+        def work():
+            with activate(tracer), counting(counter):
+                return _run(stage, inputs, max(1, threads // width), width, previous)
+
+        running[pool.submit(work)] = stage
+
+    try:
+        while waiting or running:
+            ready = [s for s in waiting if all(r in results for r in s.requires)]
+            if not concurrent:
+                ready = ready[:1]
+            for stage in ready:
+                waiting.remove(stage)
+                on_stage(stage.name)
+            if len(ready) == 1 and not running:
+                stage = ready[0]
+                results[stage.name] = _run(stage, [results[r] for r in stage.requires])
+                continue
+            if ready:
+                if pool is None:
+                    pool = ThreadPoolExecutor(len(stages))
+                width = len(running) + len(ready)
+                for stage in ready:
+                    submit(stage, [results[r] for r in stage.requires], width)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future).name] = future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+    return results
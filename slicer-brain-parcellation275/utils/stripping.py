@@ -2,33 +2,20 @@ import numpy as np
 import torch
 from scipy import ndimage
 
-from utils.functions import normalize
+from utils.inference import infer
+from utils.volume import Volume
 
 
-def strip(voxel, model, device):
-    model.eval()
-    with torch.inference_mode():
-        output = torch.zeros(256, 256, 256).to(device)
-        for i, v in enumerate(voxel):
-            image = v.reshape(1, 1, 256, 256)
-            image = torch.tensor(image).to(device)
-            x_out = torch.sigmoid(model(image)).detach()
-            if i == 0:
-                output[0] = x_out
-            else:
-                output[i] = x_out
-        return output.reshape(256, 256, 256)
+def strip(voxel, model, device, batch=None):
+    output = torch.zeros(256, 256, 256).to(device)
+    return infer(voxel, model, device, torch.sigmoid, output, batch)
 
 
-def stripping(voxel, data, ssnet, device):
-    voxel = normalize(voxel)
-
-    coronal = voxel.transpose(1, 2, 0)
-    sagittal = voxel
-    axial = voxel.transpose(2, 1, 0)
-    out_c = strip(coronal, ssnet, device).permute(2, 0, 1)
-    out_s = strip(sagittal, ssnet, device)
-    out_a = strip(axial, ssnet, device).permute(2, 1, 0)
+def stripping(voxel, data, ssnet, device, batch=None):
+    volume = Volume(voxel)
+    out_c = strip(volume.stack("coronal"), ssnet, device, batch).permute(2, 0, 1)
+    out_s = strip(volume.stack("sagittal"), ssnet, device, batch)
+    out_a = strip(volume.stack("axial"), ssnet, device, batch).permute(2, 1, 0)
     out_e = ((out_c + out_s + out_a) / 3) > 0.5
     out_e = out_e.cpu().numpy()
     stripped = data.get_fdata() * out_e
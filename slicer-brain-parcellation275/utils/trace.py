@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from utils.functions import current_rss, peak_rss_since_reset, reset_peak_rss
+
+_local = threading.local()
+
+# Numeric span arguments that summaries add up, e.g. the slices skip_empty skipped.
+COUNTERS = ("slices", "skipped_slices")
+
+# Memory spans open in this process, and how many were ever opened. The
+# peak RSS and CUDA memory counters are process-wide: they are only reset
+# when the first of overlapping memory spans opens.
+_memory = {"open": 0, "opened": 0}
+_memory_lock = threading.Lock()
+
+
+class Tracer:
+    """Chrome-trace events ("X" complete events) for one subject.
+
+    Load the saved file in chrome://tracing or https://ui.perfetto.dev.
+    A span costs two perf_counter_ns() calls and a dict append; memory is
+    only sampled for spans opened with `memory=True`. Those record the RSS
+    at entry and exit and the peak RSS (and CUDA memory) during the span.
+    Spans that overlap other memory spans, e.g. of stages the scheduler
+    runs concurrently, share one peak since the first of them opened and
+    are marked `peak_shared`.
+    """
+
+    def __init__(self, name, origin=None):
+        self.name = name
+        self.events = []
+        # Tracers of one subject in other processes share the parent's origin.
+        self.origin = time.perf_counter_ns() if origin is None else origin
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, memory=False, **args):
+        if memory:
+            with _memory_lock:
+                shared = _memory["open"] > 0
+                if not shared:
+                    reset_peak_rss()
+                    if torch.cuda.is_available():
+                        torch.cuda.reset_peak_memory_stats()
+                _memory["open"] += 1
+                _memory["opened"] += 1
+                opened = _memory["opened"]
+            args["rss_start_mib"] = current_rss()
+        start = time.perf_counter_ns()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter_ns()
+            if memory:
+                args["rss_end_mib"] = current_rss()
+                args["peak_rss_mib"] = peak_rss_since_reset()
+                args["torch_threads"] = torch.get_num_threads()
+                if torch.cuda.is_available():
+                    args["cuda_peak_mib"] = torch.cuda.max_memory_allocated() / 1024**2
+                with _memory_lock:
+                    _memory["open"] -= 1
+                    if shared or _memory["opened"] > opened:
+                        args["peak_shared"] = True
+            event = {
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.origin) / 1000,
+                "dur": (end - start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def extend(self, events):
+        """Merge events recorded by another process (e.g. a prepare worker)."""
+        with self._lock:
+            self.events.extend(events)
+
+    def summary(self):
+        """Count, total milliseconds and summed COUNTERS per span name."""
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event["name"], {"count": 0, "total_ms": 0.0})
+            total["count"] += 1
+            total["total_ms"] += event["dur"] / 1000
+            for counter in COUNTERS:
+                if counter in event["args"]:
+                    total[counter] = total.get(counter, 0) + event["args"][counter]
+        return totals
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {"traceEvents": self.events, "otherData": {"subject": self.name}}, f
+            )
+
+
+def current():
+    return getattr(_local, "tracer", None)
+
+
+@contextmanager
+def activate(tracer):
+    """Make `tracer` receive the `span()` calls of this thread."""
+    previous = current()
+    _local.tracer = tracer
+    try:
+        yield tracer
+    finally:
+        _local.tracer = previous
+
+
+def span(name, memory=False, **args):
+    """Time a block in the active tracer of this thread; a no-op without one."""
+    tracer = current()
+    if tracer is None:
+        return nullcontext(args)
+    return tracer.span(name, memory, **args)
+
+
+def summarize(summaries):
+    """Cohort summary from the per-subject `Tracer.summary()` dicts."""
+    stages = {}
+    counters = {}
+    for summary in summaries.values():
+        for name, total in summary.items():
+            stages.setdefault(name, []).append(total["total_ms"])
+            for counter in COUNTERS:
+                if counter in total:
+                    counts = counters.setdefault(name, {})
+                    counts[counter] = counts.get(counter, 0) + total[counter]
+    result = {
+        "subjects": len(summaries),
+        "stages": {
+            name: {
+                "subjects": len(times),
+                "mean_ms": sum(times) / len(times),
+                "max_ms": max(times),
+                "total_ms": sum(times),
+                **counters.get(name, {}),
+            }
+            for name, times in stages.items()
+        },
+        "per_subject": summaries,
+    }
+    skip = result["stages"].get("skip_empty")
+    if skip:
+        skip["skipped_fraction"] = skip["skipped_slices"] / skip["slices"]
+    return result
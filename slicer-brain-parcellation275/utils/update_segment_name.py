@@ -5,14 +5,15 @@ import vtk
 script_dir = os.path.dirname(os.path.realpath(__file__))
 txt_path = os.path.join(script_dir, "..", "level", "Level5.txt")
 
-def update_segment_names(outputFolder, txt_file_path=txt_path):
-    subfolders = [f for f in os.listdir(outputFolder) if os.path.isdir(os.path.join(outputFolder, f))]
+def update_segment_names(outputFolder, txt_file_path=txt_path, subfolders=None):
+    if subfolders is None:
+        subfolders = [f for f in os.listdir(outputFolder) if os.path.isdir(os.path.join(outputFolder, f))]
     for subfolder in subfolders:
         subfolder_path = os.path.join(outputFolder, subfolder)
 
         segmentation_node = None
         for j in os.listdir(subfolder_path):
-            if j.endswith('.nii') and "_280" in j:
+            if j.endswith(('.nii', '.nii.gz')) and "_280" in j:
                 nii_segment_file_path = os.path.join(subfolder_path, j)
                 segmentation_node = slicer.util.loadSegmentation(nii_segment_file_path)
                 if not segmentation_node:
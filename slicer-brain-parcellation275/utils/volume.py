@@ -0,0 +1,59 @@
+import numpy as np
+
+from utils.functions import normalize
+from utils.inference import SliceWindows
+
+# Axis order that turns the (sagittal, coronal, axial) volume into a stack of
+# slices of each view.
+VIEWS = {
+    "coronal": (1, 2, 0),
+    "sagittal": (0, 1, 2),
+    "axial": (2, 1, 0),
+}
+
+
+class Volume:
+    """Normalized volume of one subject with its slice stacks, made once.
+
+    Every stage that looks at the same volume (parcellation and hemisphere
+    both see the stripped brain) shares one `Volume`: `normalize()` runs
+    once, and each view is transposed once into a contiguous float32 stack
+    with `context` background planes on both ends. `stack()` and
+    `windows()` are views into it, so the slice batches `infer()` takes
+    from them are never copied.
+    """
+
+    def __init__(self, voxel, context=1, normalized=False):
+        self.normalized = voxel.astype("float32", copy=False) if normalized else normalize(voxel)
+        self.context = context
+        self.background = float(self.normalized.min())
+        self._stacks = {}
+
+    @property
+    def shape(self):
+        return self.normalized.shape
+
+    def padded(self, view):
+        """Contiguous (N + 2 * context, H, W) stack of `view`, padded with background."""
+        if view not in self._stacks:
+            source = self.normalized.transpose(VIEWS[view])
+            pad = self.context
+            stack = np.empty((len(source) + 2 * pad,) + source.shape[1:], dtype="float32")
+            stack[:pad] = self.background
+            stack[len(stack) - pad :] = self.background
+            stack[pad : len(stack) - pad] = source
+            self._stacks[view] = stack
+        return self._stacks[view]
+
+    def stack(self, view):
+        """(N, H, W) slices of `view`."""
+        stack = self.padded(view)
+        return stack[self.context : len(stack) - self.context]
+
+    def windows(self, view):
+        """`SliceWindows` of `view` with this volume's context."""
+        return SliceWindows(self.padded(view), self.context, padded=True)
+
+
+def as_volume(voxel):
+    return voxel if isinstance(voxel, Volume) else Volume(voxel)
@@ -0,0 +1,352 @@
+"""Share one cohort between several machines through the output folder.
+
+Every node runs the same command on the same input and output folders,
+which only have to be on a shared filesystem (NFS v3 or later, SMB, Lustre):
+
+    python utils/cli.py -i INPUT -o OUTPUT -m MODEL_FOLDER --queue
+
+A node claims a subject by creating `{output_dir}/.lease` with O_EXCL,
+which exactly one node can do, and keeps the lease's mtime fresh from a
+heartbeat thread. A lease whose mtime is older than the lease timeout
+belongs to a node that died; another node moves it aside with a rename,
+which also exactly one node can do, and claims the subject again. A subject
+is complete once it has the usual completion marker, so finished subjects
+are skipped by every node, with or without --queue.
+
+Each node records its throughput in `OUTPUT/.queue/nodes/{node}.json`.
+Run this file to print the state of the cohort:
+
+    python utils/work_queue.py -i INPUT -o OUTPUT
+"""
+import argparse
+import glob
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from utils.outputs import tmp_path
+from utils.pipeline import find_inputs, is_complete, subject
+
+QUEUE_DIR = ".queue"
+LEASE = ".lease"
+SUMMARY = "queue_summary.json"
+
+
+def write_json(path, value):
+    tmp = tmp_path(path)
+    with open(tmp, "w") as f:
+        json.dump(value, f, indent=2)
+    os.replace(tmp, path)
+
+
+def filesystem_time(path):
+    """Current time of the filesystem `path` is on, as the mtime it gives `path` when touched."""
+    with open(path, "a"):
+        pass
+    os.utime(path)
+    return os.stat(path).st_mtime
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        # Gone, or replaced while being read.
+        return None
+
+
+class WorkQueue:
+    """Claims the subjects of `paths` that no other node is working on.
+
+    `claims()` yields one claimed input path at a time and is meant to be
+    consumed lazily by `run_pipeline()`, so a node never holds more leases
+    than it has subjects in flight. Call `release()` once a subject is
+    marked complete, `wait_for_others()` when `claims()` runs out and
+    `close()` at the end, which also gives back the leases of subjects that
+    were claimed but not finished.
+
+    With `fingerprints`, subjects whose outputs are out of date count as
+    not complete; see `pipeline.is_complete()`. Staleness of leases is
+    judged against the filesystem's clock, read from the mtime of this
+    node's own status file, so the nodes' clocks need not agree.
+    """
+
+    def __init__(self, paths, output_root, node=None, heartbeat=30, timeout=300, wait=True, fingerprints=None):
+        self.paths = list(paths)
+        self.output_root = output_root
+        self.node = node or f"{socket.gethostname()}-{os.getpid()}"
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.wait = wait
+        self.fingerprints = fingerprints
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = None
+        self.started = time.time()
+        self.claimed = {}
+        self.seconds = []
+        self.lost = 0
+        self.taken_over = 0
+        nodes = os.path.join(output_root, QUEUE_DIR, "nodes")
+        os.makedirs(nodes, exist_ok=True)
+        self.status_path = os.path.join(nodes, f"{self.node}.json")
+        self.write_status()
+
+    def now(self):
+        """Current time of the shared filesystem."""
+        return filesystem_time(self.status_path)
+
+    def claims(self, pending=None):
+        """Claim and yield the input paths left to segment, in input order.
+
+        One pass: subjects leased by live nodes are passed over, see
+        `wait_for_others()`. With `pending`, a predicate on input paths,
+        the paths it holds for are claimed instead, e.g. those whose tables
+        alone are out of date (see `pipeline.stale_tables()`); they do not
+        count towards this node's throughput.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._beat, name="lease-heartbeat", daemon=True)
+            self.thread.start()
+        for path in self.paths:
+            if self.pending(path, pending) and self.claim(path, pending):
+                yield path
+
+    def pending(self, path, pending=None):
+        if pending is not None:
+            return pending(path)
+        save, output_dir = subject(path, self.output_root)
+        return not is_complete(output_dir, save, path, self.fingerprints)
+
+    def wait_for_others(self):
+        """Wait while the only unfinished subjects are leased by live nodes.
+
+        True as soon as one of them can be claimed again, because its lease
+        went stale or was given back unfinished; False once all are complete,
+        and right away without `wait`. Waiting lets this node take over the
+        subjects of a node that dies before the cohort is done.
+        """
+        while self.wait:
+            unfinished = False
+            for path in self.paths:
+                save, output_dir = subject(path, self.output_root)
+                if is_complete(output_dir, save, path, self.fingerprints):
+                    continue
+                unfinished = True
+                try:
+                    if self.now() - os.stat(os.path.join(output_dir, LEASE)).st_mtime > self.timeout:
+                        return True
+                except FileNotFoundError:
+                    return True
+            if not unfinished:
+                return False
+            time.sleep(self.heartbeat)
+        return False
+
+    def claim(self, path, pending=None):
+        save, output_dir = subject(path, self.output_root)
+        os.makedirs(output_dir, exist_ok=True)
+        lease = os.path.join(output_dir, LEASE)
+        # A second attempt after taking over a stale lease.
+        for _ in range(2):
+            try:
+                fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self.take_over(lease):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"node": self.node, "host": socket.gethostname(), "pid": os.getpid(), "input": os.path.abspath(path)}, f)
+            if not self.pending(path, pending):
+                # Finished and released by another node since the check.
+                os.remove(lease)
+                return False
+            with self.lock:
+                self.leases[save] = lease
+                if pending is None:
+                    self.claimed[save] = time.time()
+            return True
+        return False
+
+    def take_over(self, lease):
+        """Remove `lease` if it is stale; True when it is gone."""
+        try:
+            if self.now() - os.stat(lease).st_mtime <= self.timeout:
+                return False
+        except FileNotFoundError:
+            return True
+        stale = f"{lease}.{self.node}.stale"
+        try:
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            # Another node moved it first.
+            return True
+        try:
+            if self.now() - os.stat(stale).st_mtime <= self.timeout:
+                # Its owner refreshed it between the check and the rename: put it back.
+                try:
+                    os.link(stale, lease)
+                except FileExistsError:
+                    # A third node claimed it meanwhile; its owner's heartbeat
+                    # sees the foreign lease and gives the subject up.
+                    print(f"{self.node}: {lease} was claimed by another node while being checked")
+                return False
+            owner = read_json(stale) or {}
+        finally:
+            os.remove(stale)
+        print(f"{self.node}: took over {lease} from {owner.get('node', 'an unknown node')}")
+        with self.lock:
+            self.taken_over += 1
+        return True
+
+    def release(self, save):
+        """Drop the lease of `save` after it was marked complete."""
+        with self.lock:
+            lease = self.leases.pop(save, None)
+            claimed = self.claimed.pop(save, None)
+            if claimed is not None:
+                self.seconds.append(time.time() - claimed)
+        if lease is not None and (read_json(lease) or {}).get("node") == self.node:
+            try:
+                os.remove(lease)
+            except FileNotFoundError:
+                pass
+        self.write_status()
+
+    def close(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            unfinished = list(self.leases)
+        for save in unfinished:
+            with self.lock:
+                self.claimed.pop(save, None)
+            self.release(save)
+        self.write_status(finished=time.time())
+
+    def _beat(self):
+        while not self.stop.wait(self.heartbeat):
+            with self.lock:
+                leases = dict(self.leases)
+            for save, lease in leases.items():
+                if (read_json(lease) or {}).get("node") == self.node:
+                    try:
+                        os.utime(lease)
+                        continue
+                    except FileNotFoundError:
+                        pass
+                # Gone, or replaced by another node's lease. That node now
+                # segments it too; both write the same outputs atomically.
+                print(f"{self.node}: lost the lease of {save}")
+                with self.lock:
+                    self.leases.pop(save, None)
+                    self.lost += 1
+            self.write_status()
+
+    def write_status(self, finished=None):
+        with self.lock:
+            seconds = list(self.seconds)
+            status = {
+                "node": self.node,
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "started": self.started,
+                "finished": finished,
+                "subjects": len(seconds),
+                "in_progress": sorted(self.leases),
+                "taken_over": self.taken_over,
+                "lost": self.lost,
+            }
+        elapsed = (finished or time.time()) - self.started
+        status["seconds_per_subject"] = sum(seconds) / len(seconds) if seconds else None
+        status["subjects_per_hour"] = 3600 * len(seconds) / elapsed if elapsed > 0 else None
+        write_json(self.status_path, status)
+
+
+def summary(paths, output_root, timeout=300):
+    """Completion of the cohort and the throughput of every node that worked on it."""
+    queue_dir = os.path.join(output_root, QUEUE_DIR)
+    nodes = {}
+    for path in sorted(glob.glob(os.path.join(queue_dir, "nodes", "*.json"))):
+        status = read_json(path)
+        if status is not None:
+            nodes[status["node"]] = status
+    complete, leased, stale, pending = [], {}, [], []
+    os.makedirs(queue_dir, exist_ok=True)
+    # Leases are aged on the filesystem's clock, like WorkQueue does.
+    clock = filesystem_time(os.path.join(queue_dir, "clock"))
+    now = time.time()
+    for path in paths:
+        save, output_dir = subject(path, output_root)
+        lease = os.path.join(output_dir, LEASE)
+        if is_complete(output_dir, save):
+            complete.append(save)
+        elif os.path.exists(lease):
+            try:
+                age = clock - os.stat(lease).st_mtime
+            except FileNotFoundError:
+                pending.append(save)
+                continue
+            if age > timeout:
+                stale.append(save)
+            else:
+                leased[save] = (read_json(lease) or {}).get("node")
+        else:
+            pending.append(save)
+    # Cohort throughput: everything the nodes did, over the time from the first start to the last finish.
+    done = sum(node["subjects"] for node in nodes.values())
+    span = max((node["finished"] or now for node in nodes.values()), default=now) - min(
+        (node["started"] for node in nodes.values()), default=now
+    )
+    return {
+        "subjects": len(paths),
+        "complete": len(complete),
+        "in_progress": leased,
+        "stale": stale,
+        "pending": pending,
+        "subjects_per_hour": 3600 * done / span if span > 0 else None,
+        "nodes": nodes,
+    }
+
+
+def save_summary(output_root, result):
+    write_json(os.path.join(output_root, SUMMARY), result)
+
+
+def describe(result):
+    lines = [
+        f"{result['complete']}/{result['subjects']} complete, {len(result['in_progress'])} in progress, "
+        f"{len(result['stale'])} with stale leases, {len(result['pending'])} pending"
+        + (f", {result['subjects_per_hour']:.1f} subjects/h" if result["subjects_per_hour"] else "")
+    ]
+    for name, node in result["nodes"].items():
+        rate = node["subjects_per_hour"]
+        lines.append(
+            f"  {name}: {node['subjects']} subjects, "
+            + (f"{rate:.1f}/h" if rate else "-/h")
+            + (", finished" if node["finished"] else f", working on {', '.join(node['in_progress']) or 'nothing'}")
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print the state of a cohort shared with --queue.")
+    parser.add_argument("-i", required=True, help="Input folder the nodes were started on.")
+    parser.add_argument("-o", required=True, help="Output folder the nodes share.")
+    parser.add_argument("--lease-timeout", type=float, default=300, help="Seconds after which a lease counts as stale.")
+    opt = parser.parse_args(argv)
+    print(describe(summary(find_inputs(opt.i), opt.o, opt.lease_timeout)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())